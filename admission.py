@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from jobs import queued_jobs
+
+# Admission control in front of the query endpoints. Every query request is
+# counted while it runs, and each new one is checked against three signals:
+#
+#   - queries in flight
+#   - jobs waiting in the background job queue
+#   - calls waiting for a thread of the execution pool (asyncio.to_thread)
+#
+# Past the ADMISSION_DEGRADE_* thresholds, or with the job queue full, a
+# request is admitted in degraded mode and answered without model calls: an
+# earlier answer to the same question on the same data, else a chart
+# template, a compiled query or the sample-row fallback. Past the ADMISSION_MAX_*
+# thresholds it is rejected before doing any work, with a Retry-After
+# estimated from how long requests have been taking. New jobs are rejected
+# once ADMISSION_MAX_QUEUED_JOBS are waiting.
+
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "64"))
+ADMISSION_DEGRADE_IN_FLIGHT = int(os.environ.get("ADMISSION_DEGRADE_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUED_JOBS = int(os.environ.get("ADMISSION_MAX_QUEUED_JOBS", "100"))
+ADMISSION_MAX_POOL_BACKLOG = int(os.environ.get("ADMISSION_MAX_POOL_BACKLOG", "64"))
+ADMISSION_DEGRADE_POOL_BACKLOG = int(os.environ.get("ADMISSION_DEGRADE_POOL_BACKLOG", "16"))
+# Retry-After bounds, in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+# Full answers kept for degraded requests, least recently used evicted first
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "512"))
+
+_in_flight = 0
+_answers = OrderedDict()  # answer_key -> answer
+_lock = threading.Lock()
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"The server is overloaded ({reason}). Retry in {retry_after}s.")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+# Calls waiting for a thread of the loop's default executor. The executor
+# keeps its backlog in a private queue; there is no public way to read it.
+def pool_backlog():
+    executor = getattr(asyncio.get_running_loop(), "_default_executor", None)
+    return executor._work_queue.qsize() if executor is not None else 0
+
+
+# Seconds until enough of `load` over `limit` has drained, each unit taking
+# about `seconds`; at least one unit's worth
+def retry_after(load, limit, seconds):
+    waves = max(1.0, (load - limit + 1) / max(limit, 1))
+    return min(MAX_RETRY_AFTER, max(MIN_RETRY_AFTER, math.ceil(waves * seconds)))
+
+
+# Admit a query request, or raise Overloaded; returns its ticket, whose
+# "degraded" says how to answer it. Release the ticket when it finishes.
+def admit():
+    global _in_flight
+    backlog = pool_backlog()
+    # A full job queue leaves little of the model rate limit for new queries
+    jobs_full = queued_jobs() >= ADMISSION_MAX_QUEUED_JOBS
+    request_seconds = metrics.mean("admission.request_seconds", 5.0)
+    with _lock:
+        if _in_flight >= ADMISSION_MAX_IN_FLIGHT:
+            overloaded = Overloaded("too many requests in flight", retry_after(_in_flight, ADMISSION_MAX_IN_FLIGHT, request_seconds))
+        elif backlog >= ADMISSION_MAX_POOL_BACKLOG:
+            overloaded = Overloaded("the execution pool is saturated", retry_after(backlog, ADMISSION_MAX_POOL_BACKLOG, request_seconds))
+        else:
+            overloaded = None
+            _in_flight += 1
+            degraded = _in_flight > ADMISSION_DEGRADE_IN_FLIGHT or backlog >= ADMISSION_DEGRADE_POOL_BACKLOG or jobs_full
+    if overloaded is not None:
+        metrics.increment("admission.rejected")
+        raise overloaded
+    metrics.increment("admission.degraded" if degraded else "admission.admitted")
+    return {"degraded": degraded, "started_at": time.monotonic()}
+
+
+def release(ticket):
+    global _in_flight
+    with _lock:
+        _in_flight -= 1
+    metrics.observe("admission.request_seconds", time.monotonic() - ticket["started_at"])
+
+
+# Check a new background job fits in the job queue, else raise Overloaded
+def admit_job():
+    queued = queued_jobs()
+    if queued >= ADMISSION_MAX_QUEUED_JOBS:
+        metrics.increment("admission.rejected_jobs")
+        raise Overloaded("the job queue is full", retry_after(queued, ADMISSION_MAX_QUEUED_JOBS, metrics.mean("jobs.run_seconds", 30.0)))
+
+
+# The data an answer was computed from (the dataset's content, or the sample
+# rows sent without one) and the question up to case, spacing and trailing
+# punctuation; signs and decimal points in it still tell questions apart
+def answer_key(dataset, sampleData, user_query):
+    if dataset is not None:
+        data = dataset.content_hash
+    else:
+        data = hashlib.sha256(json.dumps(sampleData, sort_keys=True, default=str).encode()).hexdigest()
+    return data, " ".join(re.sub(r"[?!.]+\s*$", "", user_query.strip()).lower().split())
+
+
+def remember_answer(key, answer):
+    with _lock:
+        _answers[key] = answer
+        _answers.move_to_end(key)
+        while len(_answers) > ANSWER_CACHE_SIZE:
+            _answers.popitem(last=False)
+
+
+def cached_answer(key):
+    with _lock:
+        answer = _answers.get(key)
+        if answer is not None:
+            _answers.move_to_end(key)
+        return answer
+
+
+def admission_report():
+    with _lock:
+        in_flight = _in_flight
+    return {
+        "in_flight": in_flight,
+        "queued_jobs": queued_jobs(),
+        "pool_backlog": pool_backlog(),
+        "admitted": metrics.get("admission.admitted"),
+        "degraded": metrics.get("admission.degraded"),
+        "cached_answers": metrics.get("admission.cached_answers"),
+        "rejected": metrics.get("admission.rejected") + metrics.get("admission.rejected_jobs"),
+    }
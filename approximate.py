@@ -0,0 +1,227 @@
+import logging
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import metrics
+
+# Approximate-first answers for large datasets. Each dataset over
+# APPROXIMATE_MIN_ROWS gets a sample built in the background by one pass over
+# its table:
+#
+#   - a uniform Bernoulli sample of about APPROXIMATE_SAMPLE_ROWS rows
+#   - for every low-cardinality string column, the exact row count of each
+#     value and every row of the values with at most SMALL_GROUP_ROWS rows
+#
+# A query grouped by one of those columns is estimated with that column as
+# the strata: small groups are answered from all their rows, the others from
+# the uniform rows weighted by the value's known count. Other queries use the
+# uniform rows, weighted by rows / sample size. Counts, sums and means carry a
+# 95% error bound from the stratified-sampling variance; the other aggregates
+# are the sample's values without a bound.
+
+APPROXIMATE_ANSWERS = os.environ.get("APPROXIMATE_ANSWERS", "0") == "1"
+APPROXIMATE_MIN_ROWS = int(os.environ.get("APPROXIMATE_MIN_ROWS", "1000000"))
+APPROXIMATE_SAMPLE_ROWS = int(os.environ.get("APPROXIMATE_SAMPLE_ROWS", "100000"))
+SMALL_GROUP_ROWS = 100
+# String columns with more distinct values than this are not used as strata
+STRATA_MAX_VALUES = 100
+Z_95 = 1.96
+
+WEIGHT = "__weight__"
+STRATUM = "__stratum__"
+META_COLUMNS = [WEIGHT, STRATUM]
+# Aggregates estimated with weights and a bound; the rest come from the sample as-is
+ESTIMATED_FUNCTIONS = {"size", "count", "sum", "mean"}
+
+_samples = {}  # dataset_id -> (version, DatasetSample or None while building)
+_lock = threading.Lock()
+
+
+class DatasetSample:
+    def __init__(self, num_rows, uniform, counts, small_groups):
+        self.num_rows = num_rows
+        self.uniform = uniform  # Uniformly sampled rows
+        self.counts = counts  # {column: {value: rows}} for every strata column
+        self.small_groups = small_groups  # {column: all rows of its values with <= SMALL_GROUP_ROWS rows}
+
+    @property
+    def rows(self):
+        return len(self.uniform)
+
+    # Sample rows with their weight and stratum, stratified by `column` when it
+    # is one of the strata columns. Returns (frame, strata) where strata maps
+    # stratum -> (population rows, sample rows).
+    def weighted(self, column=None):
+        if column not in self.counts:
+            frame = self.uniform.assign(**{WEIGHT: self.num_rows / max(self.rows, 1), STRATUM: -1})
+            return frame, {-1: (self.num_rows, self.rows)}
+        counts = self.counts[column]
+        parts, strata = [], {}
+        for stratum, (value, population) in enumerate(counts.items()):
+            if population <= SMALL_GROUP_ROWS:
+                rows = self.small_groups[column][self.small_groups[column][column] == value]
+            else:
+                rows = self.uniform[self.uniform[column] == value]
+            if not len(rows):
+                continue
+            parts.append(rows.assign(**{WEIGHT: population / len(rows), STRATUM: stratum}))
+            strata[stratum] = (population, len(rows))
+        # Rows with a missing value stand for the rows not in any counted value
+        missing = self.uniform[self.uniform[column].isna()]
+        if len(missing):
+            population = self.num_rows - sum(counts.values())
+            parts.append(missing.assign(**{WEIGHT: population / len(missing), STRATUM: -1}))
+            strata[-1] = (population, len(missing))
+        frame = pd.concat(parts, ignore_index=True) if parts else self.uniform.assign(**{WEIGHT: 0.0, STRATUM: -1})
+        return frame, strata
+
+
+def build_sample(dataset, seed=0):
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    rate = min(1.0, APPROXIMATE_SAMPLE_ROWS / max(dataset.num_rows, 1))
+    strata_columns = []
+    for column, dtype in dataset.schema.items():
+        values = dataset.distinct_values(column) if dtype == "object" else None
+        if values is not None and len(values) <= STRATA_MAX_VALUES:
+            strata_columns.append(column)
+    uniform, counts = [], {column: {} for column in strata_columns}
+    kept = {column: {} for column in strata_columns}  # value -> frames, while the value is small
+    for chunk in dataset.iter_chunks():
+        uniform.append(chunk[rng.random(len(chunk)) < rate])
+        for column in strata_columns:
+            for value, count in chunk[column].value_counts().items():
+                total = counts[column].get(value, 0) + int(count)
+                counts[column][value] = total
+                if total <= SMALL_GROUP_ROWS:
+                    kept[column].setdefault(value, []).append(chunk[chunk[column] == value])
+                else:
+                    kept[column].pop(value, None)
+    small_groups = {}
+    for column in strata_columns:
+        frames = [frame for frames in kept[column].values() for frame in frames]
+        small_groups[column] = pd.concat(frames, ignore_index=True) if frames else dataset.empty_frame()
+    sample = DatasetSample(dataset.num_rows, pd.concat(uniform, ignore_index=True) if uniform else dataset.empty_frame(), counts, small_groups)
+    metrics.observe("approximate.sample_seconds", time.perf_counter() - started)
+    logging.info(f"Built a {sample.rows}-row sample of dataset {dataset.dataset_id} v{dataset.version} ({len(strata_columns)} strata columns).")
+    return sample
+
+
+# Start building the sample of a large dataset in the background
+def prepare_sample(dataset):
+    if dataset.num_rows < APPROXIMATE_MIN_ROWS:
+        return
+    with _lock:
+        current = _samples.get(dataset.dataset_id)
+        if current is not None and current[0] == dataset.version:
+            return
+        _samples[dataset.dataset_id] = (dataset.version, None)
+
+    def build():
+        try:
+            sample = build_sample(dataset)
+        except Exception as e:
+            logging.error(f"Building the sample of dataset {dataset.dataset_id} failed: {e!r}")
+            sample = None
+        with _lock:
+            if _samples.get(dataset.dataset_id, (None,))[0] == dataset.version:
+                if sample is None:
+                    _samples.pop(dataset.dataset_id)
+                else:
+                    _samples[dataset.dataset_id] = (dataset.version, sample)
+
+    threading.Thread(target=build, daemon=True).start()
+
+
+# The dataset's sample if it is large enough to have one and it is built;
+# starts building it otherwise
+def sample_for(dataset):
+    if dataset is None or dataset.num_rows < APPROXIMATE_MIN_ROWS:
+        return None
+    with _lock:
+        current = _samples.get(dataset.dataset_id)
+    if current is not None and current[0] == dataset.version:
+        return current[1]
+    prepare_sample(dataset)
+    return None
+
+
+# Per-group sums of z and z squared within each stratum, turned into the
+# 95% bound of the group's estimated total (divided by `scale` for means)
+def error_bound(frame, keys, z, strata, scale=None):
+    parts = frame[keys + [STRATUM]].assign(z=z, z2=z ** 2)
+    sums = parts.groupby(keys + [STRATUM], sort=False, dropna=False).agg(s1=("z", "sum"), s2=("z2", "sum")).reset_index()
+    population = sums[STRATUM].map(lambda stratum: strata[stratum][0])
+    size = sums[STRATUM].map(lambda stratum: strata[stratum][1])
+    spread = ((sums["s2"] - sums["s1"] ** 2 / size) / (size - 1)).where(size > 1, 0.0).clip(lower=0)
+    sums["variance"] = population ** 2 * (1 - size / population) * spread / size
+    variance = sums.groupby(keys, sort=False, dropna=False)["variance"].sum()
+    bound = Z_95 * np.sqrt(variance)
+    return bound if scale is None else bound / scale
+
+
+# Weighted grouped aggregates with "<name>_error" bounds for counts, sums and
+# means; `aggregations` are (output, column, function) as in out_of_core
+def aggregate(frame, strata, by, aggregations):
+    keys = list(by) if by else ["__all_rows__"]
+    if not by:
+        frame = frame.assign(__all_rows__=0)
+    grouped = frame.groupby(keys, sort=False, dropna=False, observed=True)
+    output = grouped.size().reset_index()[keys]
+    index = pd.MultiIndex.from_frame(output) if len(keys) > 1 else pd.Index(output[keys[0]])
+    weight = frame[WEIGHT]
+    groups = [frame[key] for key in keys]
+    for name, column, function in aggregations:
+        if function not in ESTIMATED_FUNCTIONS:
+            output[name] = grouped[column].agg(function).reindex(index).to_numpy()
+            continue
+        present = pd.Series(1.0, index=frame.index) if function == "size" else frame[column].notna().astype(float)
+        values = frame[column].astype(float).fillna(0.0) if function in ("sum", "mean") else present
+        if function == "mean":
+            rows = (weight * present).groupby(groups, sort=False, dropna=False).sum()
+            estimate = (weight * values).groupby(groups, sort=False, dropna=False).sum() / rows
+            means = frame[keys].merge(estimate.rename("mean").reset_index(), on=keys, how="left")["mean"].to_numpy()
+            bound = error_bound(frame, keys, (values - means) * present, strata, rows)
+        else:
+            estimate = (weight * values).groupby(groups, sort=False, dropna=False).sum()
+            bound = error_bound(frame, keys, values, strata)
+        output[name] = estimate.reindex(index).to_numpy()
+        output[f"{name}_error"] = bound.reindex(index).to_numpy()
+    return output if by else output.drop(columns=keys)
+
+
+# Weighted row counts per equal-width bin between the sample's minimum and maximum
+def histogram(frame, strata, column, bins):
+    values = frame[column].astype(float)
+    present = values.notna()
+    edges = np.histogram_bin_edges(values[present], bins=bins)
+    positions = np.clip(np.searchsorted(edges, values[present], side="right") - 1, 0, bins - 1)
+    binned = frame[present].assign(__bin__=positions)
+    counts = aggregate(binned, strata, ["__bin__"], [("count", None, "size")]).set_index("__bin__").reindex(range(bins))
+    return pd.DataFrame({
+        "bin_start": edges[:-1], "bin_end": edges[1:],
+        "count": counts["count"].fillna(0.0).to_numpy(), "count_error": counts["count_error"].fillna(0.0).to_numpy(),
+    })
+
+
+# Weighted describe(): count, mean and std from the weights, quantiles from
+# the weighted empirical distribution
+def describe(frame, columns):
+    data = {}
+    for column in columns:
+        values = frame[column].astype(float)
+        present = values.notna()
+        x, w = values[present].to_numpy(), frame.loc[present, WEIGHT].to_numpy()
+        if not len(x):
+            data[column] = [0.0] + [np.nan] * 7
+            continue
+        mean = np.average(x, weights=w)
+        total = w.sum()
+        std = np.sqrt(np.sum(w * (x - mean) ** 2) / (total - 1)) if total > 1 else np.nan
+        order = np.argsort(x, kind="stable")
+        cumulative = np.cumsum(w[order]) / total
+        quantiles = [x[order][min(np.searchsorted(cumulative, q), len(x) - 1)] for q in (0.25, 0.5, 0.75)]
+        data[column] = [total, mean, std, x.min(), *quantiles, x.max()]
+    return pd.DataFrame(data, index=["count", "mean", "std", "min", "25%", "50%", "75%", "max"])
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from chart_templates import match_chart_template
+
+# Compares the template fast path against LLM spec generation on a fixed set of
+# queries. The LLM half only runs when OPENAI_API_KEY is set:
+#   python benchmarks/bench_chart_templates.py
+
+COLUMNS = ["region", "product", "order_date", "year", "sales", "quantity", "unit_price"]
+DATA_TYPES = {
+    "region": "nominal", "product": "nominal", "order_date": "temporal", "year": "quantitative",
+    "sales": "quantitative", "quantity": "quantitative", "unit_price": "quantitative",
+}
+SAMPLE_DATA = [
+    {"region": "East", "product": "A", "order_date": "2023-01-05", "year": 2023, "sales": 120.5, "quantity": 3, "unit_price": 40.2},
+    {"region": "West", "product": "B", "order_date": "2023-02-11", "year": 2023, "sales": 80.0, "quantity": 2, "unit_price": 40.0},
+    {"region": "East", "product": "B", "order_date": "2024-03-20", "year": 2024, "sales": 45.0, "quantity": 1, "unit_price": 45.0},
+]
+QUERIES = [
+    "bar chart of sales by region",
+    "bar chart of average unit price by product",
+    "bar chart of the number of orders per region",
+    "scatter of sales vs quantity",
+    "scatter plot of unit price against quantity colored by region",
+    "histogram of sales",
+    "distribution of quantity",
+    "line chart of sales over order date",
+    "line of total sales by year",
+    # Ambiguous or unsupported: these must fall back to the LLM
+    "bar chart of sales and quantity by region",
+    "compare regions",
+]
+
+
+def encoding_fields(vega_spec):
+    encoding = vega_spec.get("encoding", {}) if vega_spec else {}
+    return {channel: (value.get("field"), value.get("aggregate")) for channel, value in encoding.items() if isinstance(value, dict)}
+
+
+def bench_templates(repeat=200):
+    results = {}
+    for query in QUERIES:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            matched = match_chart_template(query, COLUMNS, DATA_TYPES, SAMPLE_DATA)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+        results[query] = (matched, elapsed_ms)
+    return results
+
+
+async def bench_llm(queries):
+    from main import generate_chart
+    results = {}
+    for query in queries:
+        start = time.perf_counter()
+        vega_spec, _, _ = await generate_chart(query, COLUMNS, DATA_TYPES, SAMPLE_DATA)
+        results[query] = (vega_spec, (time.perf_counter() - start) * 1000)
+    return results
+
+
+def main():
+    template_results = bench_templates()
+    matched_queries = [query for query, (matched, _) in template_results.items() if matched]
+    llm_results = asyncio.run(bench_llm(matched_queries)) if os.environ.get("OPENAI_API_KEY") else {}
+
+    print(f"{'query':<62} {'template':>10} {'llm':>10}  same encoding")
+    for query, (matched, template_ms) in template_results.items():
+        template_cell = f"{template_ms:.3f}ms" if matched else "fallback"
+        llm_cell, same = "-", "-"
+        if query in llm_results:
+            llm_spec, llm_ms = llm_results[query]
+            llm_cell = f"{llm_ms:.0f}ms"
+            same = "yes" if llm_spec and encoding_fields(llm_spec) == encoding_fields(matched[0]) else "no"
+        print(f"{query:<62} {template_cell:>10} {llm_cell:>10}  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from nl_compiler import compile_query, run_compiled
+
+# Labelled accuracy/latency suite for the NL-to-pandas compiler. Each case pairs
+# a question with the hand-written pandas answer, or None when the question
+# must fall through to the LLM:
+#   python benchmarks/bench_nl_compiler.py [rows]
+
+
+def make_frame(rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "region": rng.choice(["North", "South", "East", "West"], rows),
+        "customer": rng.choice([f"c{i}" for i in range(500)], rows),
+        "status": rng.choice(["open", "closed", "pending"], rows),
+        "price": rng.gamma(2.0, 20.0, rows).round(2),
+        "revenue": rng.gamma(3.0, 100.0, rows).round(2),
+        "x": rng.normal(size=rows),
+        "y": rng.normal(size=rows),
+    })
+
+
+CASES = [
+    ("average price by region", lambda df: df.groupby("region")["price"].mean()),
+    ("What is the total revenue per region?", lambda df: df.groupby("region")["revenue"].sum()),
+    ("max price", lambda df: df["price"].max()),
+    ("median revenue for each status", lambda df: df.groupby("status")["revenue"].median()),
+    ("top 10 customers by revenue", lambda df: df.groupby("customer")["revenue"].sum().nlargest(10)),
+    ("bottom 3 regions by average price", lambda df: df.groupby("region")["price"].mean().nsmallest(3)),
+    ("count of rows where status is open", lambda df: int((df["status"] == "open").sum())),
+    ("how many rows have region North", lambda df: int((df["region"] == "North").sum())),
+    ("number of rows by status", lambda df: df.groupby("status").size()),
+    ("correlation between x and y", lambda df: df["x"].corr(df["y"])),
+    # Out of grammar: must not compile
+    ("average price by region for open orders", None),
+    ("which region grew fastest", None),
+    ("average status", None),
+    ("count of rows where status is archived", None),
+]
+
+
+def values_of(result):
+    if isinstance(result, pd.DataFrame):
+        return result.iloc[:, -1].to_numpy(dtype=float)
+    numbers = [float(token.replace(",", "")) for token in re.findall(r"-?[\d,]*\.?\d+", result)]
+    return np.array(numbers[-1:])
+
+
+def expected_values(expected):
+    if isinstance(expected, pd.Series):
+        return expected.to_numpy(dtype=float)
+    return np.array([float(expected)])
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    frame = make_frame(rows)
+    correct = 0
+    print(f"{'question':<45} {'compile':>9} {'execute':>9}  ok")
+    for question, reference in CASES:
+        start = time.perf_counter()
+        plan = compile_query(question, frame)
+        compile_ms = (time.perf_counter() - start) * 1000
+        if reference is None:
+            ok = plan is None
+            execute_cell = "-"
+        elif plan is None:
+            ok = False
+            execute_cell = "missed"
+        else:
+            start = time.perf_counter()
+            result = run_compiled(plan, frame)
+            execute_cell = f"{(time.perf_counter() - start) * 1000:.1f}ms"
+            ok = np.allclose(values_of(result), expected_values(reference(frame)), rtol=1e-3, atol=1e-4)
+        correct += ok
+        print(f"{question:<45} {compile_ms:>7.2f}ms {execute_cell:>9}  {'yes' if ok else 'NO'}")
+    print(f"\naccuracy: {correct}/{len(CASES)} on {rows:,} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import glob
+import os
+import re
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from main import render_analysis_result, run_panda_dataframe_code
+from vectorize import vectorize_code
+
+# Runs every snippet in vectorize_corpus/ (analysis code in the shape the model
+# generates) before and after the vectorising rewrite, checks the rendered
+# results match and reports the speed-up:
+#   python benchmarks/bench_vectorize.py [rows]
+
+CORPUS = os.path.join(os.path.dirname(__file__), "vectorize_corpus")
+
+
+def make_frame(rows):
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "region": rng.choice(["North", "South", "East", "West"], rows),
+        "status": rng.choice(["open", "closed", "pending"], rows),
+        "customer": rng.choice(["alice", "bob", "carol", "dave"], rows),
+        "price": rng.gamma(2.0, 20.0, rows).round(2),
+        "quantity": rng.integers(1, 10, rows),
+        "discount": rng.uniform(0, 0.4, rows).round(2),
+    })
+
+
+# Rendered results match, allowing for floating-point summation order
+def same_result(before, after):
+    if before == after:
+        return True
+    number = r"-?\d+\.?\d*(?:e[-+]?\d+)?"
+    if re.sub(number, "#", before) != re.sub(number, "#", after):
+        return False
+    return np.allclose([float(x) for x in re.findall(number, before)], [float(x) for x in re.findall(number, after)])
+
+
+def timed(code, frame):
+    start = time.perf_counter()
+    value, failed = run_panda_dataframe_code(code, frame)
+    return render_analysis_result(value), failed, time.perf_counter() - start
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    frame = make_frame(rows)
+    print(f"{'snippet':<32} {'rewrites':>8} {'before':>9} {'after':>9} {'speed-up':>9}  same")
+    for path in sorted(glob.glob(os.path.join(CORPUS, "*.py"))):
+        with open(path) as handle:
+            code = handle.read()
+        rewritten, rewrites, warnings = vectorize_code(code)
+        before, failed, before_seconds = timed(code, frame)
+        after, _, after_seconds = timed(rewritten, frame)
+        same = "original failed" if failed else ("yes" if same_result(before, after) else "NO")
+        print(f"{os.path.basename(path):<32} {len(rewrites):>8} {before_seconds:>8.3f}s {after_seconds:>8.3f}s "
+              f"{before_seconds / after_seconds:>8.1f}x  {same}")
+        for warning in warnings:
+            print(f"    warning: {warning}")
+
+
+if __name__ == "__main__":
+    main()
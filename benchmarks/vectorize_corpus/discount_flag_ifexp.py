@@ -0,0 +1,5 @@
+import pandas as pd
+
+# Flag orders that received a large discount
+df['discount_type'] = df.apply(lambda row: 'large' if row['discount'] > 0.2 else 'small', axis=1)
+discount_counts = df['discount_type'].value_counts()
@@ -0,0 +1,7 @@
+import pandas as pd
+
+# Compute the net price of every order
+net_prices = []
+for index, row in df.iterrows():
+    net_prices.append(row['price'] * (1 - row['discount']))
+result = pd.DataFrame({'net_price': net_prices}).describe()
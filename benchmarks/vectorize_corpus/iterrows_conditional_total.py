@@ -0,0 +1,8 @@
+import pandas as pd
+
+# Total revenue from open orders in the North region
+total = 0
+for _, row in df.iterrows():
+    if row['status'] == 'open' and row['region'] == 'North':
+        total += row['price'] * row['quantity']
+print(f'Total open revenue in North: {total}')
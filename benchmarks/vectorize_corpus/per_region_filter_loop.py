@@ -0,0 +1,8 @@
+import pandas as pd
+
+# Average price in each region
+rows = []
+for region in df['region'].unique():
+    region_df = df[df['region'] == region]
+    rows.append({'region': region, 'average_price': region_df['price'].mean()})
+average_prices = pd.DataFrame(rows)
@@ -0,0 +1,6 @@
+import pandas as pd
+
+# Map regions to their sales territory codes
+codes = {'North': 'N1', 'South': 'S1', 'East': 'E1', 'West': 'W1'}
+df['territory'] = df['region'].apply(lambda r: codes[r])
+territory_counts = df['territory'].value_counts()
@@ -0,0 +1,5 @@
+import pandas as pd
+
+# Calculate revenue for each order and the total revenue per region
+df['revenue'] = df.apply(lambda row: row['price'] * row['quantity'], axis=1)
+revenue_by_region = df.groupby('region')['revenue'].sum().reset_index()
@@ -0,0 +1,5 @@
+import pandas as pd
+
+# Price including 8% tax, rounded to cents
+df['price_with_tax'] = df['price'].apply(lambda x: round(x * 1.08, 2))
+tax_summary = df[['price', 'price_with_tax']].describe()
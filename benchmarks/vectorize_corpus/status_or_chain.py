@@ -0,0 +1,5 @@
+import pandas as pd
+
+# Orders that are still in progress
+in_progress = df[(df['status'] == 'open') | (df['status'] == 'pending')]
+summary = in_progress.groupby('region')['quantity'].sum().reset_index()
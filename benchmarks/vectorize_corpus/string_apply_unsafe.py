@@ -0,0 +1,5 @@
+import pandas as pd
+
+# Customer initials (row-wise string work is reported, not rewritten)
+df['initial'] = df.apply(lambda row: row['customer'][0].upper(), axis=1)
+initial_counts = df['initial'].value_counts()
@@ -0,0 +1,125 @@
+import contextvars
+import ctypes
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+
+# Cancelling the rest of a request's work when its client disconnects. Each
+# request runs inside a CancelScope, held in a context variable so the model
+# calls it makes and the worker threads it hands code to (asyncio.to_thread
+# copies the context) can find it. Cancelling the scope:
+#
+#   - raises ExecutionCancelled in threads executing generated code or query
+#     plans, at their next Python bytecode (a long pandas call still finishes
+#     first)
+#   - runs the stop callbacks of work in other processes (session kernels)
+#
+# and the caller cancels the request's task, which closes the model streams
+# it is reading. Tokens and seconds saved are estimates against the averages
+# of calls and requests that ran to the end.
+
+DISCONNECT_POLL_SECONDS = float(os.environ.get("DISCONNECT_POLL_SECONDS", "0.5"))
+
+_scope = contextvars.ContextVar("cancel_scope", default=None)
+
+
+class ExecutionCancelled(Exception):
+    pass
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class CancelScope:
+    def __init__(self):
+        self.cancelled = False
+        self.started_at = time.monotonic()
+        self.threads = set()  # Idents of threads running the scope's code
+        self.stops = []  # Callbacks stopping the scope's work in other processes
+        self.children = []  # Scopes of parts of the request cancelled on their own
+        self.lock = threading.Lock()
+
+    # Stop the scope's work; `request` scopes also record what the cancel saved
+    def cancel(self, request=True):
+        with self.lock:
+            self.cancelled = True
+            for ident in self.threads:
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), ctypes.py_object(ExecutionCancelled))
+            stops = list(self.stops)
+            children = list(self.children)
+            metrics.increment("cancellation.executions", len(self.threads) + len(stops))
+        for stop in stops:
+            stop()
+        for child in children:
+            child.cancel(request=False)
+        if not request:
+            return
+        elapsed = time.monotonic() - self.started_at
+        metrics.increment("cancellation.requests")
+        metrics.observe("cancellation.seconds_saved", max(0.0, metrics.mean("cancellation.request_seconds", elapsed) - elapsed))
+        logging.info(f"Client disconnected after {elapsed:.2f}s; cancelled the rest of its request.")
+
+    # The request ran to the end: its duration is what a cancel saves the rest of
+    def finish(self):
+        metrics.observe("cancellation.request_seconds", time.monotonic() - self.started_at)
+
+
+def enter_scope():
+    scope = CancelScope()
+    _scope.set(scope)
+    return scope
+
+
+# Scope for one part of the current request (a stage that ran out of time),
+# to be entered in that part's own context; cancelling the request cancels it too
+def enter_child_scope():
+    parent = _scope.get()
+    scope = CancelScope()
+    _scope.set(scope)
+    if parent is not None:
+        with parent.lock:
+            parent.children.append(scope)
+            scope.cancelled = parent.cancelled
+    return scope
+
+
+def current_scope():
+    return _scope.get()
+
+
+# Whether the current request was cancelled, for work noticing it midway
+def cancelled():
+    scope = _scope.get()
+    return scope is not None and scope.cancelled
+
+
+# Mark the enclosed block as cancellable: it runs in this thread, or `stop`
+# ends it elsewhere. Outside a scope this does nothing.
+@contextmanager
+def cancellable(stop=None):
+    scope = _scope.get()
+    if scope is None:
+        yield
+        return
+    ident = threading.get_ident()
+    with scope.lock:
+        if scope.cancelled:
+            raise ExecutionCancelled()
+        if stop is None:
+            scope.threads.add(ident)
+        else:
+            scope.stops.append(stop)
+    try:
+        yield
+    finally:
+        with scope.lock:
+            if stop is None:
+                scope.threads.discard(ident)
+                # An exception sent just as the block ended must not hit the pool thread later
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), None)
+            else:
+                scope.stops.remove(stop)
@@ -0,0 +1,172 @@
+import re
+
+# Parametrised Vega-Lite templates for the common one-line chart requests
+# ("bar chart of X by Y", "scatter of A vs B", "histogram of C", "line of D over
+# time"). A local parser maps the chart keyword and the column names mentioned
+# in the query onto encodings using the column types; anything it cannot map
+# unambiguously returns None and the request goes to the LLM as before. Like
+# nl_compiler's grammar, only whole sentences match: a request with words
+# left over once the keywords, columns and filler are taken out ("in 2023",
+# "excluding West", "where sales > 100", "sorted descending") has qualifiers
+# a template would silently drop.
+
+VEGA_LITE_SCHEMA = "https://vega.github.io/schema/vega-lite/v5.json"
+
+CHART_KEYWORDS = {
+    "bar": r"\b(bar|bars|column chart)\b",
+    "scatter": r"\b(scatter|scatterplot|vs|versus|against)\b",
+    "histogram": r"\b(histogram|distribution)\b",
+    "line": r"\b(line|over time|trend)\b",
+}
+AGGREGATE_KEYWORDS = {
+    "mean": r"\b(average|avg|mean)\b",
+    "sum": r"\b(total|sum)\b",
+    "count": r"\b(count|number of)\b",
+    "max": r"\b(max|maximum|highest)\b",
+    "min": r"\b(min|minimum|lowest)\b",
+    "median": r"\bmedian\b",
+}
+# Words that carry no meaning in a chart request
+FILLER_WORDS = {
+    "a", "an", "the", "of", "for", "by", "per", "each", "every", "and", "with", "on", "across", "over", "time",
+    "chart", "charts", "plot", "graph", "diagram", "draw", "make", "create", "show", "me", "give", "display",
+    "visualize", "visualise", "please", "can", "you", "i", "want", "see", "what", "is", "colored", "coloured",
+    "color", "colour", "grouped",
+}
+AGGREGATE_WORDS = {"mean": "average", "sum": "total", "count": "count", "max": "maximum", "min": "minimum", "median": "median"}
+CATEGORICAL_TYPES = ("nominal", "ordinal")
+
+
+def normalize_text(text):
+    return " ".join(re.sub(r"[_\-.]+", " ", str(text).lower()).split())
+
+
+# Columns mentioned in the query, in the order they appear. Longer names win
+# when one column name is contained in another ("price" vs "unit price").
+def find_columns(user_query, columns):
+    query = f" {normalize_text(user_query)} "
+    found = []
+    taken = []
+    for column in sorted(columns, key=lambda col: -len(normalize_text(col))):
+        name = normalize_text(column)
+        if not name:
+            continue
+        match = re.search(rf"(?<![a-z0-9]){re.escape(name)}(?![a-z0-9])", query)
+        if not match or any(start < match.end() and match.start() < end for start, end in taken):
+            continue
+        taken.append((match.start(), match.end()))
+        found.append((match.start(), column))
+    return [column for _, column in sorted(found)]
+
+
+# Whether nothing is left of the query once the chart and aggregate
+# keywords, the column names and filler words are taken out
+def fully_consumed(user_query, columns):
+    query = " " + normalize_text(re.sub(r"[?!.]+\s*$", "", user_query)) + " "
+    for name in sorted((normalize_text(column) for column in columns), key=len, reverse=True):
+        if name:
+            query = re.sub(rf"(?<![a-z0-9]){re.escape(name)}(?![a-z0-9])", " ", query)
+    for pattern in list(CHART_KEYWORDS.values()) + list(AGGREGATE_KEYWORDS.values()):
+        query = re.sub(pattern, " ", query)
+    return all(word in FILLER_WORDS for word in re.findall(r"[a-z0-9]+|[^\sa-z0-9]", query))
+
+
+# Exactly one keyword group must match, otherwise the query is ambiguous
+def find_single_keyword(user_query, patterns):
+    query = normalize_text(user_query)
+    matches = [name for name, pattern in patterns.items() if re.search(pattern, query)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def field(column, field_type, **extra):
+    return dict({"field": column, "type": field_type}, **extra)
+
+
+def bar_template(user_query, mentioned, dataTypes):
+    categorical = [col for col in mentioned if dataTypes.get(col) in CATEGORICAL_TYPES]
+    quantitative = [col for col in mentioned if dataTypes.get(col) == "quantitative"]
+    if len(categorical) != 1 or len(quantitative) > 1 or len(mentioned) != len(categorical) + len(quantitative):
+        return None
+    category = categorical[0]
+    aggregate = find_single_keyword(user_query, AGGREGATE_KEYWORDS)
+    if not quantitative or aggregate == "count":
+        encoding = {"x": field(category, "nominal"), "y": {"aggregate": "count", "type": "quantitative", "title": "Count"}}
+        return "bar", encoding, f"A bar chart showing the number of rows for each {category}."
+    aggregate = aggregate or "sum"
+    measure = quantitative[0]
+    encoding = {"x": field(category, "nominal"), "y": field(measure, "quantitative", aggregate=aggregate)}
+    return "bar", encoding, f"A bar chart showing the {AGGREGATE_WORDS[aggregate]} {measure} for each {category}."
+
+
+def scatter_template(user_query, mentioned, dataTypes):
+    quantitative = [col for col in mentioned if dataTypes.get(col) == "quantitative"]
+    categorical = [col for col in mentioned if dataTypes.get(col) in CATEGORICAL_TYPES]
+    if len(quantitative) != 2 or len(categorical) > 1 or len(mentioned) != len(quantitative) + len(categorical):
+        return None
+    # "scatter of A vs B" puts A on the y axis and B on the x axis
+    y_column, x_column = quantitative
+    encoding = {"x": field(x_column, "quantitative"), "y": field(y_column, "quantitative")}
+    description = f"A scatter plot of {y_column} against {x_column}"
+    if categorical:
+        encoding["color"] = field(categorical[0], "nominal")
+        description += f", colored by {categorical[0]}"
+    return "point", encoding, description + "."
+
+
+def histogram_template(user_query, mentioned, dataTypes):
+    if len(mentioned) != 1 or dataTypes.get(mentioned[0]) != "quantitative":
+        return None
+    column = mentioned[0]
+    encoding = {"x": field(column, "quantitative", bin=True), "y": {"aggregate": "count", "type": "quantitative", "title": "Count"}}
+    return "bar", encoding, f"A histogram showing the distribution of {column}."
+
+
+def line_template(user_query, mentioned, dataTypes):
+    temporal = [col for col in mentioned if dataTypes.get(col) == "temporal"]
+    quantitative = [col for col in mentioned if dataTypes.get(col) == "quantitative"]
+    # Year-like numeric columns are a common stand-in for a temporal axis
+    if not temporal and len(quantitative) == 2:
+        years = [col for col in quantitative if re.search(r"\b(year|yr)\b", normalize_text(col))]
+        if len(years) == 1:
+            return line_encoding(user_query, years[0], "ordinal", [col for col in quantitative if col != years[0]][0])
+    if len(temporal) != 1 or len(quantitative) != 1 or len(mentioned) != 2:
+        return None
+    return line_encoding(user_query, temporal[0], "temporal", quantitative[0])
+
+
+def line_encoding(user_query, time_column, time_type, measure):
+    aggregate = find_single_keyword(user_query, AGGREGATE_KEYWORDS) or "sum"
+    if aggregate == "count":
+        return None
+    encoding = {"x": field(time_column, time_type), "y": field(measure, "quantitative", aggregate=aggregate)}
+    return "line", encoding, f"A line chart showing the {AGGREGATE_WORDS[aggregate]} {measure} over {time_column}."
+
+
+TEMPLATES = {
+    "bar": bar_template,
+    "scatter": scatter_template,
+    "histogram": histogram_template,
+    "line": line_template,
+}
+
+
+# Returns (vega_spec, description) when a template applies unambiguously, else None
+def match_chart_template(user_query, columns, dataTypes, sampleData):
+    kind = find_single_keyword(user_query, CHART_KEYWORDS)
+    if kind is None:
+        return None
+    mentioned = find_columns(user_query, columns)
+    if not mentioned or not fully_consumed(user_query, columns):
+        return None
+    filled = TEMPLATES[kind](user_query, mentioned, dataTypes)
+    if filled is None:
+        return None
+    mark, encoding, description = filled
+    vega_spec = {
+        "$schema": VEGA_LITE_SCHEMA,
+        "description": description,
+        "data": {"values": sampleData},
+        "mark": mark,
+        "encoding": encoding,
+    }
+    return vega_spec, description
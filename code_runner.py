@@ -0,0 +1,89 @@
+import logging
+import re
+from functools import partial
+from io import StringIO
+import numpy as np
+import pandas as pd
+from cancellation import cancellable
+
+# Execution of generated analysis code, shared by the request handlers and the
+# per-session kernel processes (which must not import the web app).
+
+# Sanitize input for Python REPL execution
+def sanitize_input(query: str) -> str:
+    query = re.sub(r"^(\s|`)*(?i:python)?\s*", "", query)
+    query = re.sub(r"(\s|`)*$", "", query)
+    return query
+
+# Run generated code and return what should be shown to the user: printed text,
+# the last DataFrame or Series it created, or the error. `df` is the registered
+# dataset, if any; the code gets its own copy to mutate unless the caller passes
+# a frame loaded just for this run (copy=False). With `namespace`, the code runs
+# in that dict and its variables outlive the call (session kernels); only
+# variables this run assigned count as its result. Returns (value, failed).
+def run_panda_dataframe_code(code, df=None, copy=True, namespace=None):
+    logging.info(f"Generated Python Code:\n{code}")  # Log the generated Python code
+
+    # Route print() into a per-call buffer instead of swapping sys.stdout, so
+    # executions can run in worker threads alongside other requests
+    mystdout = StringIO()
+    last_dataframe = None  # To store the last detected DataFrame
+    last_series = None  # To store the last detected Series
+
+    # Variables to ignore, e.g., 'df' is for raw data and should not be returned
+    ignore_vars = ['df']
+
+    # Check if the last line of the code contains a single quote
+    code_lines = code.strip().splitlines()
+    last_line = code_lines[-1] if code_lines else ""
+    contains_text_output = "'" in last_line
+
+    try:
+        # Define a local dictionary with 'pd' and 'np' to provide context for exec
+        local_vars = namespace if namespace is not None else {}
+        local_vars.update({'pd': pd, 'np': np})
+        if df is not None:
+            local_vars['df'] = df.copy() if copy else df
+        before = {name: id(value) for name, value in local_vars.items()}
+        cleaned_command = sanitize_input(code)
+        
+        # Execute code within this local namespace; a disconnected client's request stops it
+        with cancellable():
+            exec(cleaned_command, {'print': partial(print, file=mystdout)}, local_vars)
+
+        # Check if there was printed output (e.g., from print("hello"))
+        printed_output = mystdout.getvalue().strip()
+        
+        # If the last line contains text (a single quote), return only the printed text
+        if contains_text_output and printed_output:
+            return printed_output, False
+
+        # If no explicit text output, check for DataFrames and Series
+        for var_name, var_value in local_vars.items():
+            if var_name in ignore_vars or before.get(var_name) == id(var_value):
+                continue  # Skip variables we want to ignore, and ones this run did not assign
+            if isinstance(var_value, pd.DataFrame):
+                last_dataframe = var_value  # Update to the latest non-ignored DataFrame found
+            elif isinstance(var_value, pd.Series):
+                last_series = var_value  # Update to the latest non-ignored Series found
+
+        # If a non-ignored DataFrame was found, return it
+        if last_dataframe is not None:
+            return last_dataframe, False
+
+        # If no DataFrame but a Series was found, return it
+        if last_series is not None:
+            return last_series, False
+
+        # If neither is found, return any standard text output
+        return printed_output, False
+    except Exception as e:
+        return repr(e), True
+
+# Render an execution result for the chat: tables as HTML, everything else as text
+def render_analysis_result(value):
+    if isinstance(value, pd.DataFrame):
+        return value.to_html(index=False)
+    if isinstance(value, pd.Series):
+        return value.to_frame().to_html(header=True, index=True)
+    return value
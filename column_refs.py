@@ -0,0 +1,161 @@
+import ast
+import re
+
+# Static analysis of which dataset columns a piece of generated code or a
+# Vega-Lite spec refers to, so only those columns are loaded from the columnar
+# store. Both functions return a set of column names, or None when references
+# are dynamic and the whole table must be loaded.
+
+DATASET_NAME = "df"
+# Calls that make any variable reachable by name
+DYNAMIC_CALLS = {"eval", "exec", "globals", "locals", "vars", "getattr"}
+# Row filters that look at every column unless given a `subset`
+ALL_COLUMN_FILTERS = {"dropna", "drop_duplicates", "duplicated"}
+# Encoding channel properties that hold field names
+FIELD_KEYS = ("field", "groupby", "fields")
+
+
+def string_constants(node):
+    return [child.value for child in ast.walk(node) if isinstance(child, ast.Constant) and isinstance(child.value, str)]
+
+
+# Column names a string literal can refer to: the column itself, or columns
+# named inside an expression string such as df.query("price > 3")
+def columns_in_string(text, columns):
+    if text in columns:
+        return {text}
+    return {column for column in columns if isinstance(column, str) and re.search(rf"(?<!\w){re.escape(column)}(?!\w)", text)}
+
+
+# Constant column selector (`"a"` or `["a", "b"]`); None if not constant
+def constant_selector(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return {node.value}
+    if isinstance(node, ast.List) and node.elts and all(isinstance(elt, ast.Constant) and isinstance(elt.value, str) for elt in node.elts):
+        return {elt.value for elt in node.elts}
+    return None
+
+
+# Columns a dropna/drop_duplicates/duplicated call compares rows on; None
+# when that is every column (no subset, or one that is not a literal)
+def filter_subset(call, method):
+    keywords = {keyword.arg: keyword.value for keyword in call.keywords}
+    if "axis" in keywords:
+        return None
+    subset = keywords.get("subset")
+    if subset is None and call.args and method != "dropna":
+        subset = call.args[0]
+    return constant_selector(subset) if subset is not None else None
+
+
+def parent_map(tree):
+    parents = {}
+    for node in ast.walk(tree):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+    return parents
+
+
+# Follow one use of `df` up through method calls, row filters and groupbys
+# until the chain is narrowed to named columns. Returns the referenced
+# columns, or None if the whole frame escapes (assigned, passed on, shown).
+def chain_columns(node, parents, columns):
+    referenced = set()
+    grouped = False
+    while True:
+        parent = parents.get(node)
+        if isinstance(parent, ast.Subscript) and parent.value is node:
+            if isinstance(node, ast.Attribute) and node.attr == "shape":
+                index = parent.slice
+                return referenced if isinstance(index, ast.Constant) and index.value == 0 else None
+            selector = constant_selector(parent.slice)
+            if selector is not None:
+                return referenced | selector
+            # Row selection such as df[mask]; the mask's own column uses are separate df uses
+            node = parent
+            continue
+        if isinstance(parent, ast.Attribute) and parent.value is node:
+            call = parents.get(parent)
+            if parent.attr in ("loc", "iloc"):
+                if not (isinstance(call, ast.Subscript) and call.value is parent):
+                    return None
+                if isinstance(call.slice, ast.Tuple):
+                    # Column positions and label slices depend on the column order
+                    selector = constant_selector(call.slice.elts[-1]) if parent.attr == "loc" else None
+                    return referenced | selector if selector is not None else None
+                node = call
+                continue
+            if parent.attr == "shape":
+                node = parent
+                continue
+            if not (isinstance(call, ast.Call) and call.func is parent):
+                return referenced | {parent.attr} if parent.attr in columns else None
+            if parent.attr in ALL_COLUMN_FILTERS:
+                subset = filter_subset(call, parent.attr)
+                if subset is None:
+                    return None
+                referenced |= subset
+            for argument in call.args + [keyword.value for keyword in call.keywords]:
+                for text in string_constants(argument):
+                    referenced |= columns_in_string(text, columns)
+            if parent.attr == "size" and grouped:
+                return referenced
+            grouped = grouped or parent.attr == "groupby"
+            node = call
+            continue
+        if isinstance(parent, ast.Call) and isinstance(parent.func, ast.Name) and parent.func.id == "len" and parent.args == [node]:
+            return referenced  # len(...): row count only
+        return None
+
+
+def code_columns(code, columns):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    columns = set(columns)
+    parents = parent_map(tree)
+    referenced = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in DYNAMIC_CALLS:
+            return None
+        if not (isinstance(node, ast.Name) and node.id == DATASET_NAME and isinstance(node.ctx, ast.Load)):
+            continue
+        found = chain_columns(node, parents, columns)
+        if found is None:
+            return None
+        referenced |= found
+    return referenced & columns
+
+
+# Field names referenced anywhere in a Vega-Lite spec, plus the names its
+# transforms create; (fields, created) or None when fields are dynamic
+def spec_fields(spec):
+    fields, created = set(), set()
+
+    def visit(node):
+        if isinstance(node, list):
+            return all(visit(item) for item in node)
+        if not isinstance(node, dict):
+            return True
+        for key, value in node.items():
+            if key in ("repeat", "fold") or (key == "field" and isinstance(value, dict)):
+                return False
+            if key in FIELD_KEYS:
+                for name in value if isinstance(value, list) else [value]:
+                    if isinstance(name, str):
+                        fields.add(name)
+                    elif isinstance(name, dict) and isinstance(name.get("field"), str):
+                        fields.add(name["field"])
+            elif key in ("calculate", "filter") and isinstance(value, str):
+                fields.update(re.findall(r"datum\.(\w+)", value))
+                fields.update(re.findall(r"datum\[['\"]([^'\"]+)['\"]\]", value))
+            elif key == "as":
+                created.update(name for name in (value if isinstance(value, list) else [value]) if isinstance(name, str))
+            elif key != "data" and not visit(value):
+                return False
+        return True
+
+    if not visit(spec):
+        return None
+    return fields, created
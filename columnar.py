@@ -0,0 +1,260 @@
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+
+# A minimal on-disk columnar table format built on .npy files, so column data
+# can be memory-mapped back without extra dependencies:
+#
+#   <table>/meta.json          column names and kinds, rows per chunk
+#   <table>/c<i>/<chunk>.npy   one array per column per chunk
+#   <table>/c<i>/categories.json
+#
+# Strings and categoricals are stored as int32 codes into a per-column list of
+# categories that grows as chunks are appended; datetimes and timedeltas as
+# int64. Everything else numeric or boolean is stored as-is.
+
+META_FILE = "meta.json"
+# Comparisons a read can filter rows by, as (column, operator, value) triples
+FILTER_OPERATORS = {"==": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge"}
+
+
+def column_kind(series):
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return "category"
+    if pd.api.types.is_bool_dtype(dtype) and dtype != object:
+        return "bool" if dtype == np.bool_ else "string"
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return "datetime"
+    if pd.api.types.is_timedelta64_dtype(dtype):
+        return "timedelta"
+    if pd.api.types.is_numeric_dtype(dtype):
+        return "numeric"
+    return "string"
+
+
+# Rows of a chunk that satisfy every (column, operator, value) filter
+def filter_mask(frame, filters):
+    mask = np.ones(len(frame), dtype=bool)
+    for column, operator, value in filters:
+        series = frame[column]
+        if series.dtype == np.float32:
+            # Compare in float64, as on the restored column
+            series = series.astype(np.float64)
+        if operator == "in":
+            mask &= series.isin(value).to_numpy()
+        else:
+            mask &= getattr(series, FILTER_OPERATORS[operator])(value).to_numpy()
+    return mask
+
+
+def to_json_value(value):
+    return value.item() if hasattr(value, "item") else value
+
+
+# Writes a table chunk by chunk; new categories are appended to each column's list
+class TableWriter:
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.columns = None
+        self.categories = []
+        self.lookups = []
+        self.chunks = []
+
+    def start(self, frame):
+        self.columns = []
+        for index, name in enumerate(frame.columns):
+            series = frame[name]
+            column = {"name": to_json_value(name), "kind": column_kind(series)}
+            if column["kind"] == "numeric":
+                # Nullable extension integers become float64 so missing values survive
+                column["dtype"] = str(series.dtype) if isinstance(series.dtype, np.dtype) else "float64"
+            if column["kind"] == "datetime":
+                column["tz"] = str(series.dt.tz) if series.dt.tz is not None else None
+            self.columns.append(column)
+            self.categories.append([])
+            self.lookups.append({})
+            os.makedirs(os.path.join(self.path, f"c{index}"))
+
+    def encode(self, index, series):
+        column = self.columns[index]
+        kind = column["kind"]
+        if kind in ("category", "string"):
+            categories, lookup = self.categories[index], self.lookups[index]
+            values = series.astype(object)
+            for value in pd.unique(values.dropna()):
+                key = to_json_value(value)
+                if key not in lookup:
+                    lookup[key] = len(categories)
+                    categories.append(key)
+            return pd.Categorical(values, categories=categories).codes.astype(np.int32)
+        if kind == "datetime":
+            if column.get("tz"):
+                series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+            return series.to_numpy(dtype="datetime64[ns]").view(np.int64)
+        if kind == "timedelta":
+            return series.to_numpy(dtype="timedelta64[ns]").view(np.int64)
+        if kind == "bool":
+            return series.to_numpy(dtype=np.bool_)
+        return series.to_numpy(dtype=column["dtype"], na_value=np.nan) if column["dtype"].startswith("float") else series.to_numpy(dtype=column["dtype"])
+
+    def append(self, frame):
+        if self.columns is None:
+            self.start(frame)
+        chunk = len(self.chunks)
+        for index, name in enumerate(frame.columns):
+            np.save(os.path.join(self.path, f"c{index}", f"{chunk:05d}.npy"), self.encode(index, frame[name]))
+        self.chunks.append(len(frame))
+
+    # Change the type of a column whose earlier chunks are already written
+    # (integers to floats, anything to strings, or numbers to a narrower dtype
+    # once every chunk is known to fit), rewriting them one at a time.
+    # `values` gives each earlier chunk's new values, when the caller has
+    # better ones than the stored values converted (such as the source text).
+    def promote(self, index, kind, dtype=None, values=None):
+        previous = dict(self.columns[index])
+        self.columns[index] = {"name": previous["name"], "kind": kind}
+        if dtype is not None:
+            self.columns[index]["dtype"] = dtype
+        if values is not None:
+            for chunk, chunk_values in zip(range(len(self.chunks)), values):
+                np.save(os.path.join(self.path, f"c{index}", f"{chunk:05d}.npy"), self.encode(index, chunk_values.reset_index(drop=True)))
+            return
+        for chunk in range(len(self.chunks)):
+            path = os.path.join(self.path, f"c{index}", f"{chunk:05d}.npy")
+            raw = np.load(path)
+            if kind == "numeric":
+                values = pd.Series(raw.astype(dtype))
+            else:
+                if previous["kind"] in ("datetime", "timedelta"):
+                    values = pd.Series(raw.view("datetime64[ns]" if previous["kind"] == "datetime" else "timedelta64[ns]"))
+                else:
+                    values = pd.Series(raw)
+                values = values.astype(str).where(values.notna(), None)
+            np.save(path, self.encode(index, values))
+
+    def close(self):
+        for index, column in enumerate(self.columns or []):
+            if column["kind"] in ("category", "string"):
+                with open(os.path.join(self.path, f"c{index}", "categories.json"), "w") as handle:
+                    json.dump(self.categories[index], handle, default=str)
+        with open(os.path.join(self.path, META_FILE), "w") as handle:
+            json.dump({"columns": self.columns or [], "chunks": self.chunks}, handle)
+        return ColumnarTable(self.path)
+
+
+def write_table(frame, path, chunk_rows=1_000_000):
+    writer = TableWriter(path)
+    if len(frame) == 0:
+        writer.append(frame)
+    for start in range(0, len(frame), chunk_rows):
+        writer.append(frame.iloc[start:start + chunk_rows])
+    return writer.close()
+
+
+# Read side of the format; column data is memory-mapped unless mmap=False
+class ColumnarTable:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as handle:
+            meta = json.load(handle)
+        self.meta_columns = meta["columns"]
+        self.chunk_rows = meta["chunks"]
+        self.positions = {column["name"]: index for index, column in enumerate(self.meta_columns)}
+        self.categories = {}
+
+    @property
+    def columns(self):
+        return [column["name"] for column in self.meta_columns]
+
+    @property
+    def num_rows(self):
+        return sum(self.chunk_rows)
+
+    # On-disk size of each column, for reporting what a projection avoided
+    def column_nbytes(self):
+        sizes = {}
+        for name, index in self.positions.items():
+            folder = os.path.join(self.path, f"c{index}")
+            sizes[name] = sum(os.path.getsize(os.path.join(folder, entry)) for entry in os.listdir(folder))
+        return sizes
+
+    # Logical pandas dtype of each column
+    def schema(self):
+        schema = {}
+        for column in self.meta_columns:
+            kind = column["kind"]
+            if kind == "numeric":
+                schema[column["name"]] = column["dtype"]
+            elif kind == "datetime":
+                schema[column["name"]] = f"datetime64[ns, {column['tz']}]" if column.get("tz") else "datetime64[ns]"
+            else:
+                schema[column["name"]] = {"bool": "bool", "timedelta": "timedelta64[ns]"}.get(kind, "object")
+        return schema
+
+    # Distinct non-null values of a string column when there are at most
+    # `limit`; strings already keep them as the column's categories
+    def distinct_values(self, name, limit):
+        index = self.positions[name]
+        if self.meta_columns[index]["kind"] not in ("category", "string"):
+            return None
+        categories = self.column_categories(index)
+        return categories if len(categories) <= limit else None
+
+    def column_categories(self, index):
+        if index not in self.categories:
+            with open(os.path.join(self.path, f"c{index}", "categories.json")) as handle:
+                self.categories[index] = json.load(handle)
+        return self.categories[index]
+
+    def decode(self, index, raw):
+        column = self.meta_columns[index]
+        kind = column["kind"]
+        if kind in ("category", "string"):
+            categories = self.column_categories(index)
+            if kind == "category":
+                return pd.Categorical.from_codes(np.asarray(raw), categories=categories)
+            lookup = np.array(categories + [np.nan], dtype=object)
+            return lookup[np.asarray(raw)]
+        if kind == "datetime":
+            values = pd.DatetimeIndex(np.asarray(raw).view("datetime64[ns]"))
+            if column.get("tz"):
+                values = values.tz_localize("UTC").tz_convert(column["tz"])
+            return values
+        if kind == "timedelta":
+            return np.asarray(raw).view("timedelta64[ns]")
+        return raw
+
+    def load_column(self, name, chunk, mmap=True):
+        index = self.positions[name]
+        raw = np.load(os.path.join(self.path, f"c{index}", f"{chunk:05d}.npy"), mmap_mode="r" if mmap else None)
+        return self.decode(index, raw)
+
+    # One chunk; with filters, rows are dropped before the other columns are decoded
+    def read_chunk(self, chunk, columns=None, mmap=True, filters=None):
+        columns = self.columns if columns is None else columns
+        keep = None
+        if filters:
+            filter_columns = list(dict.fromkeys(column for column, _, _ in filters))
+            keep = filter_mask(pd.DataFrame({name: self.load_column(name, chunk, mmap) for name in filter_columns}), filters)
+        data = {}
+        for name in columns:
+            values = self.load_column(name, chunk, mmap)
+            data[name] = values[keep] if keep is not None else values
+        return pd.DataFrame(data, columns=columns, copy=False)
+
+    def iter_chunks(self, columns=None, mmap=True, filters=None):
+        for chunk in range(len(self.chunk_rows)):
+            yield self.read_chunk(chunk, columns, mmap, filters)
+
+    # Read the whole table, or only the requested columns and matching rows
+    def read(self, columns=None, mmap=True, filters=None):
+        frames = list(self.iter_chunks(columns, mmap, filters))
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,194 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+import metrics
+from llm import complete, estimate_tokens
+
+# Server-side conversation history per chat session (the client's
+# session_id). Every question and answer is appended to the session's log, a
+# JSON Lines file that is only ever appended to, so the browser never has to
+# resend history. Prompts get the session's context as chat messages:
+#
+#   - the most recent turns verbatim, newest first, while they fit in
+#     CONVERSATION_RECENT_TOKENS
+#   - a rolling summary of every older turn, at most CONVERSATION_SUMMARY_TOKENS
+#
+# Once the turns after the summary outgrow the recent budget, the oldest of
+# them are folded into the summary by a background model call after the
+# answer has been sent, so follow-ups never wait on it. Summaries are logged
+# too, and a restarted server rebuilds each session from its log, as is the
+# last chart sent, which chart refinements patch.
+
+CONVERSATION_DIR = os.environ.get("CONVERSATION_DIR") or os.path.join(tempfile.gettempdir(), "conversations")
+CONVERSATION_RECENT_TOKENS = int(os.environ.get("CONVERSATION_RECENT_TOKENS", "1000"))
+CONVERSATION_SUMMARY_TOKENS = int(os.environ.get("CONVERSATION_SUMMARY_TOKENS", "300"))
+# Sessions kept in memory; the others are read back from their logs when used
+CONVERSATION_MAX_SESSIONS = int(os.environ.get("CONVERSATION_MAX_SESSIONS", "256"))
+# Characters of an answer's result kept in its turn
+RESULT_PREVIEW_CHARS = 400
+
+_conversations = OrderedDict()  # session_id -> Conversation, least recently used first
+_lock = threading.Lock()
+_summaries = set()  # Running summary tasks, referenced until they finish
+
+
+class Conversation:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.path = os.path.join(CONVERSATION_DIR, f"{session_id}.jsonl")
+        self.turns = []  # {"role", "content"} in order
+        self.summary = ""
+        self.summarized = 0  # Turns folded into the summary
+        self.summarizing = False
+        self.chart = None  # The last chart spec sent, which refinements patch
+        self.lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path) as handle:
+                for line in handle:
+                    self.replay(json.loads(line))
+
+    def replay(self, record):
+        if record["kind"] == "turn":
+            self.turns.append({"role": record["role"], "content": record["content"]})
+        elif record["kind"] == "summary":
+            self.summary, self.summarized = record["content"], record["through"]
+        elif record["kind"] == "chart":
+            self.chart = record["spec"]
+
+    def append(self, record):
+        with self.lock:
+            self.replay(record)
+            with open(self.path, "a") as handle:
+                handle.write(json.dumps(record, default=str) + "\n")
+
+    # Chat messages carrying the session's context for the next prompt
+    def context(self):
+        with self.lock:
+            turns, summary, summarized = list(self.turns), self.summary, self.summarized
+        recent, tokens = [], 0
+        for turn in reversed(turns[summarized:]):
+            tokens += estimate_tokens(turn["content"])
+            if tokens > CONVERSATION_RECENT_TOKENS and recent:
+                break
+            recent.append(turn)
+        # Turns neither recent nor summarized yet are left out until the summary catches up
+        metrics.increment("conversations.dropped_turns", len(turns) - summarized - len(recent))
+        messages = [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] if summary else []
+        return messages + list(reversed(recent))
+
+    # Oldest unsummarized turns to fold so the rest fit in half the recent budget;
+    # folding down to half leaves room for a few turns before the next summary
+    def overflow(self):
+        with self.lock:
+            pending = self.turns[self.summarized:]
+            if self.summarizing or sum(estimate_tokens(turn["content"]) for turn in pending) <= CONVERSATION_RECENT_TOKENS:
+                return None
+            kept, tokens = len(pending), 0
+            while kept > 0 and tokens + estimate_tokens(pending[kept - 1]["content"]) <= CONVERSATION_RECENT_TOKENS // 2:
+                kept -= 1
+                tokens += estimate_tokens(pending[kept]["content"])
+            self.summarizing = True
+            return self.summary, pending[:kept], self.summarized + kept
+
+    async def summarize(self):
+        folding = self.overflow()
+        if folding is None:
+            return
+        summary, turns, through = folding
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        try:
+            content = await complete(
+                model="gpt-3.5-turbo",
+                messages=[
+                    {"role": "system", "content": "You summarise conversations between a user and a data assistant."},
+                    {"role": "user", "content": (
+                        f"Summary so far: {summary or '(none)'}\n"
+                        f"Later turns:\n{transcript}\n"
+                        f"Rewrite the summary to cover the later turns too, in at most {CONVERSATION_SUMMARY_TOKENS * 3 // 4} words. "
+                        f"Keep the columns, filters, groupings, chart settings and results the user may refer back to. Reply with the summary only."
+                    )},
+                ],
+                max_tokens=CONVERSATION_SUMMARY_TOKENS,
+                stop_at_json=False,
+            )
+            self.append({"kind": "summary", "content": content.strip(), "through": through})
+            metrics.increment("conversations.summaries")
+            metrics.increment("conversations.summarized_turns", len(turns))
+        except Exception as e:
+            logging.error(f"Summarising conversation {self.session_id} failed: {e!r}")
+        finally:
+            with self.lock:
+                self.summarizing = False
+
+
+def get_conversation(session_id):
+    with _lock:
+        conversation = _conversations.get(session_id)
+        if conversation is None:
+            os.makedirs(CONVERSATION_DIR, exist_ok=True)
+            conversation = _conversations[session_id] = Conversation(session_id)
+            while len(_conversations) > CONVERSATION_MAX_SESSIONS:
+                _conversations.popitem(last=False)
+        _conversations.move_to_end(session_id)
+        return conversation
+
+
+# Context messages for a session's next prompt; empty outside a session
+def conversation_context(session_id):
+    if session_id is None:
+        return []
+    messages = get_conversation(session_id).context()
+    metrics.observe("conversations.context_tokens", sum(estimate_tokens(message["content"]) for message in messages))
+    return messages
+
+
+# What an answer says in its turn: the description, the chart's spec without
+# its data rows, and the start of the analysis result as text
+def describe_answer(result):
+    parts = [result.get("description") or ""]
+    if result.get("vega_spec"):
+        spec = {key: value for key, value in result["vega_spec"].items() if key != "data"}
+        parts.append(f"Chart: {json.dumps(spec, default=str)[:RESULT_PREVIEW_CHARS]}")
+    if result.get("analysis_result") is not None:
+        text = re.sub(r"\s+", " ", re.sub(r"<[^>]+>", " ", str(result["analysis_result"]))).strip()
+        parts.append(f"Result: {text[:RESULT_PREVIEW_CHARS]}")
+    return "\n".join(part for part in parts if part)
+
+
+# Log a question and its answer, then fold old turns into the summary in the
+# background if the session has outgrown its recent budget
+def record_turn(session_id, user_query, result):
+    if session_id is None:
+        return
+    conversation = get_conversation(session_id)
+    conversation.append({"kind": "turn", "role": "user", "content": user_query})
+    conversation.append({"kind": "turn", "role": "assistant", "content": describe_answer(result)})
+    if result.get("vega_spec"):
+        conversation.append({"kind": "chart", "spec": result["vega_spec"]})
+    metrics.increment("conversations.turns")
+    # The summary outlives the request, so it runs without its deadline or cancel scope
+    task = asyncio.get_running_loop().create_task(conversation.summarize(), context=contextvars.Context())
+    _summaries.add(task)
+    task.add_done_callback(_summaries.discard)
+
+
+# The session's last chart spec, or None
+def last_chart(session_id):
+    if session_id is None:
+        return None
+    conversation = get_conversation(session_id)
+    with conversation.lock:
+        return conversation.chart
+
+
+# The session's turns and current summary, for clients restoring a chat
+def conversation_history(session_id):
+    conversation = get_conversation(session_id)
+    with conversation.lock:
+        return {"turns": list(conversation.turns), "summary": conversation.summary, "summarized": conversation.summarized}
@@ -0,0 +1,318 @@
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+import metrics
+from columnar import ColumnarTable, filter_mask, write_table
+from out_of_core import ALL_ROWS, MERGE_EVERY_CHUNKS, numeric_values
+
+# Precomputed aggregate cube for the common one- and two-key group-bys. When a
+# dataset is registered, one pass over its table fills a cuboid for every
+# single dimension and every pair of dimensions (plus the whole table), each
+# holding per-cell measures of every numeric column:
+#
+#   rows, <i>_count, <i>_sum, <i>_min, <i>_max, <i>_sumsq
+#
+# Dimensions are string and boolean columns with at most CUBE_MAX_VALUES
+# values, and datetime columns binned by month (which rolls up to years and
+# months of the year). Sums of squares are taken around a per-column offset
+# so variances stay accurate for values far from zero. Cuboids are added
+# smallest first while their estimated size fits CUBE_MEMORY_BYTES, and the
+# cube is written to <dataset dir>/cube in the columnar format, so it lives
+# and is removed with the dataset version it describes.
+#
+# query() answers grouped count/sum/mean/min/max/std/var aggregates over
+# dimension keys and filters from the smallest cuboid covering them, returning
+# None for anything the cube does not cover.
+
+CUBE_MEMORY_BYTES = int(os.environ.get("CUBE_MEMORY_BYTES", str(32 * 1024 * 1024)))
+CUBE_MIN_ROWS = int(os.environ.get("CUBE_MIN_ROWS", "50000"))
+CUBE_MAX_VALUES = 1000
+CUBE_DIR = "cube"
+META_FILE = "cube.json"
+# Aggregates the cube answers, and the filters it applies to its cells
+FUNCTIONS = {"size", "count", "sum", "mean", "min", "max", "std", "var"}
+FILTER_OPERATORS = {"==", "!=", "<", "<=", ">", ">=", "in"}
+# Time keys a month bin rolls up to
+TIME_UNITS = {"year", "month", "yearmonth", "yearstart"}
+
+_cubes = {}  # dataset_id -> (version, DataCube or None while building)
+_lock = threading.Lock()
+
+
+class DataCube:
+    def __init__(self, dimensions, measures, offsets, integer_measures, cuboids):
+        self.dimensions = dimensions  # {column: "category" or "month"}
+        self.measures = measures  # Numeric columns, by index in the state column names
+        self.offsets = offsets  # Per-measure offset the squares are taken around
+        self.integer_measures = set(integer_measures)
+        self.cuboids = cuboids  # {frozenset of dimensions: cell frame}
+
+    @property
+    def nbytes(self):
+        return sum(int(frame.memory_usage(index=True, deep=True).sum()) for frame in self.cuboids.values())
+
+    # Smallest cuboid holding every given dimension
+    def covering(self, columns):
+        candidates = [dims for dims in self.cuboids if columns <= dims]
+        return min(candidates, key=lambda dims: (len(dims), len(self.cuboids[dims]))) if candidates else None
+
+    # Grouped aggregates from the cube, shaped as the in-memory plan aggregate
+    # shapes them. `by` are (output name, column, time unit or None) keys,
+    # `aggregations` (output, column, function) as in out_of_core, `filters`
+    # (column, operator, value). None when the cube cannot answer.
+    def query(self, by, aggregations, filters=()):
+        for _, column, unit in by:
+            if self.dimensions.get(column) != ("month" if unit else "category") or (unit and unit not in TIME_UNITS):
+                return None
+        for column, operator, _ in filters:
+            if self.dimensions.get(column) != "category" or operator not in FILTER_OPERATORS:
+                return None
+        for _, column, function in aggregations:
+            if function not in FUNCTIONS or (function != "size" and column not in self.measures):
+                return None
+        dims = self.covering({column for _, column, _ in by} | {column for column, _, _ in filters})
+        if dims is None:
+            return None
+        cells = self.cuboids[dims]
+        if filters:
+            cells = cells[filter_mask(cells, filters)]
+        states = self.state_columns(aggregations)
+        if by:
+            keys = [bin_values(cells[column], unit).rename(name) for name, column, unit in by]
+            grouped = cells[states].groupby(keys, sort=False, dropna=False)
+            totals = grouped.agg({state: merge_function(state) for state in states}).reset_index()
+        else:
+            totals = pd.DataFrame({state: [cells[state].agg(merge_function(state))] for state in states})
+        output = totals[[name for name, _, _ in by]].copy()
+        for name, column, function in aggregations:
+            output[name] = self.finish(totals, column, function)
+        return output
+
+    def state_columns(self, aggregations):
+        states = ["rows"]
+        for _, column, function in aggregations:
+            if function != "size":
+                index = self.measures.index(column)
+                states += [f"{index}_{state}" for state in ("count", "sum", "min", "max", "sumsq")]
+        return list(dict.fromkeys(states))
+
+    def finish(self, totals, column, function):
+        if function == "size":
+            return totals["rows"].astype("int64")
+        index = self.measures.index(column)
+        count, total = totals[f"{index}_count"], totals[f"{index}_sum"]
+        if function == "count":
+            return count.astype("int64")
+        if function in ("sum", "min", "max"):
+            values = totals[f"{index}_{function}"]
+            if column in self.integer_measures and values.notna().all():
+                return values.round().astype("int64")
+            return values
+        if function == "mean":
+            return (total / count).where(count > 0)
+        shifted = total - count * self.offsets[index]
+        variance = ((totals[f"{index}_sumsq"] - shifted ** 2 / count) / (count - 1)).where(count > 1).clip(lower=0)
+        return np.sqrt(variance) if function == "std" else variance
+
+
+def merge_function(state):
+    return state.rsplit("_", 1)[-1] if state.endswith(("_min", "_max")) else "sum"
+
+
+# A month-bin dimension as the key a query groups by
+def bin_values(series, unit):
+    if unit is None or unit == "yearmonth":
+        return series
+    if unit == "yearstart":
+        return series.dt.to_period("Y").dt.to_timestamp()
+    return getattr(series.dt, unit)
+
+
+def month_bins(series):
+    if series.dt.tz is not None:
+        series = series.dt.tz_localize(None)
+    return pd.Series(series.to_numpy(dtype="datetime64[ns]").astype("datetime64[M]").astype("datetime64[ns]"), index=series.index)
+
+
+# Candidate dimensions with their cardinality (counting missing values), and the
+# numeric measure columns
+def plan_columns(dataset):
+    dimensions, cardinality, measures = {}, {}, []
+    temporal = []
+    for column, dtype in dataset.schema.items():
+        if dtype == "object":
+            values = dataset.distinct_values(column)
+            if values is not None and len(values) <= CUBE_MAX_VALUES:
+                dimensions[column], cardinality[column] = "category", len(values) + 1
+        elif dtype == "bool":
+            dimensions[column], cardinality[column] = "category", 2
+        elif dtype.startswith("datetime64"):
+            temporal.append(column)
+        elif pd.api.types.pandas_dtype(dtype).kind in "iuf":
+            measures.append(column)
+    if temporal:
+        ranges = {column: [None, None] for column in temporal}
+        for chunk in dataset.iter_chunks(temporal):
+            for column in temporal:
+                bins = month_bins(chunk[column]).dropna()
+                if len(bins):
+                    low, high = ranges[column]
+                    ranges[column] = [bins.min() if low is None else min(low, bins.min()), bins.max() if high is None else max(high, bins.max())]
+        for column, (low, high) in ranges.items():
+            months = 0 if low is None else (high.year - low.year) * 12 + high.month - low.month + 1
+            if months <= CUBE_MAX_VALUES:
+                dimensions[column], cardinality[column] = "month", months + 1
+    return dimensions, cardinality, measures
+
+
+# Cuboids (as frozensets of dimensions) that fit the memory budget, smallest first
+def plan_cuboids(dimensions, cardinality, measures):
+    cell_bytes = 8 * (1 + 5 * len(measures))
+    candidates = [frozenset(dims) for size in (0, 1, 2) for dims in itertools.combinations(dimensions, size)]
+    estimates = {dims: int(np.prod([cardinality[dim] for dim in dims])) * (cell_bytes + 8 * len(dims)) for dims in candidates}
+    chosen, total = [], 0
+    for dims in sorted(candidates, key=lambda dims: (estimates[dims], len(dims))):
+        if total + estimates[dims] <= CUBE_MEMORY_BYTES:
+            chosen.append(dims)
+            total += estimates[dims]
+    return chosen
+
+
+# Per-cell states of one chunk
+def chunk_cells(chunk, dims, measures):
+    keys = sorted(dims) or [ALL_ROWS]
+    named = {"rows": (keys[0], "size")}
+    for index in range(len(measures)):
+        for state in ("count", "sum", "min", "max"):
+            named[f"{index}_{state}"] = (f"{index}", state)
+        named[f"{index}_sumsq"] = (f"{index}_sq", "sum")
+    return chunk.groupby(keys, sort=False, dropna=False).agg(**named).reset_index()
+
+
+def state_names(measures):
+    return ["rows"] + [f"{index}_{state}" for index in range(len(measures)) for state in ("count", "sum", "min", "max", "sumsq")]
+
+
+# Merge cell states on `dims`: chunk partials, or a larger cuboid rolled up
+def merge_cells(cells, dims, measures):
+    keys = sorted(dims) or [ALL_ROWS]
+    combined = pd.concat(cells, ignore_index=True)
+    if not dims:
+        combined[ALL_ROWS] = 0
+    states = state_names(measures)
+    return combined.groupby(keys, sort=False, dropna=False).agg({state: merge_function(state) for state in states}).reset_index()
+
+
+def build_cube(dataset):
+    started = time.perf_counter()
+    dimensions, cardinality, measures = plan_columns(dataset)
+    chosen = plan_cuboids(dimensions, cardinality, measures)
+    # Cuboids inside a larger chosen one are rolled up from it afterwards
+    scanned = [dims for dims in chosen if not any(dims < other for other in chosen)]
+    offsets = [None] * len(measures)
+    partials = {dims: [] for dims in scanned}
+    for chunk in dataset.iter_chunks(list(dimensions) + measures):
+        prepared = {ALL_ROWS: np.zeros(len(chunk), dtype=np.int8)}
+        for column, kind in dimensions.items():
+            prepared[column] = month_bins(chunk[column]) if kind == "month" else chunk[column]
+        for index, column in enumerate(measures):
+            values = numeric_values(chunk[column])
+            if offsets[index] is None and (~np.isnan(values)).any():
+                offsets[index] = float(values[~np.isnan(values)][0])
+            prepared[f"{index}"] = values
+            prepared[f"{index}_sq"] = (values - (offsets[index] or 0.0)) ** 2
+        prepared = pd.DataFrame(prepared, index=chunk.index)
+        for dims in scanned:
+            partials[dims].append(chunk_cells(prepared, dims, measures))
+            if len(partials[dims]) >= MERGE_EVERY_CHUNKS:
+                partials[dims] = [merge_cells(partials[dims], dims, measures)]
+    cuboids = {}
+    for dims in scanned:
+        cuboids[dims] = merge_cells(partials[dims], dims, measures) if partials[dims] else None
+    for dims in sorted(chosen, key=len, reverse=True):
+        if dims not in cuboids:
+            source = min((other for other in cuboids if dims < other), key=lambda other: len(cuboids[other]) if cuboids[other] is not None else 0)
+            cuboids[dims] = merge_cells([cuboids[source]], dims, measures) if cuboids[source] is not None else None
+    cuboids = {dims: frame.drop(columns=[ALL_ROWS], errors="ignore") for dims, frame in cuboids.items() if frame is not None}
+    offsets = [offset or 0.0 for offset in offsets]
+    integer_measures = [column for column in measures if pd.api.types.pandas_dtype(dataset.schema[column]).kind in "iu"]
+    cube = DataCube(dimensions, measures, offsets, integer_measures, cuboids)
+    metrics.observe("cube.build_seconds", time.perf_counter() - started)
+    metrics.observe("cube.bytes", cube.nbytes)
+    logging.info(f"Built a cube of dataset {dataset.dataset_id} v{dataset.version}: {len(cuboids)} cuboids over {len(dimensions)} dimensions, {cube.nbytes:,} bytes.")
+    return cube
+
+
+# Write the cube next to the dataset's table; the directory is swapped in whole
+def save_cube(cube, path):
+    staging = os.path.join(path, f"{CUBE_DIR}-{uuid.uuid4().hex}")
+    os.makedirs(staging)
+    listed = []
+    for index, (dims, frame) in enumerate(cube.cuboids.items()):
+        write_table(frame, os.path.join(staging, str(index)))
+        listed.append(sorted(dims))
+    meta = {
+        "dimensions": cube.dimensions, "measures": cube.measures, "offsets": cube.offsets,
+        "integer_measures": sorted(cube.integer_measures), "cuboids": listed,
+    }
+    with open(os.path.join(staging, META_FILE), "w") as handle:
+        json.dump(meta, handle)
+    target = os.path.join(path, CUBE_DIR)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+
+
+def load_cube(path):
+    folder = os.path.join(path, CUBE_DIR)
+    with open(os.path.join(folder, META_FILE)) as handle:
+        meta = json.load(handle)
+    cuboids = {}
+    for index, dims in enumerate(meta["cuboids"]):
+        cuboids[frozenset(dims)] = ColumnarTable(os.path.join(folder, str(index))).read(mmap=False)
+    return DataCube(meta["dimensions"], meta["measures"], meta["offsets"], meta["integer_measures"], cuboids)
+
+
+# Build (or reload) the cube of a dataset in the background
+def prepare_cube(dataset):
+    if CUBE_MEMORY_BYTES <= 0 or dataset.num_rows < CUBE_MIN_ROWS:
+        return
+    with _lock:
+        current = _cubes.get(dataset.dataset_id)
+        if current is not None and current[0] == dataset.version:
+            return
+        _cubes[dataset.dataset_id] = (dataset.version, None)
+
+    def build():
+        cube = None
+        try:
+            if os.path.exists(os.path.join(dataset.table.path, CUBE_DIR, META_FILE)):
+                cube = load_cube(dataset.table.path)
+            else:
+                cube = build_cube(dataset)
+                save_cube(cube, dataset.table.path)
+        except Exception as e:
+            logging.error(f"Building the cube of dataset {dataset.dataset_id} failed: {e!r}")
+        with _lock:
+            if _cubes.get(dataset.dataset_id, (None,))[0] == dataset.version:
+                if cube is None:
+                    _cubes.pop(dataset.dataset_id)
+                else:
+                    _cubes[dataset.dataset_id] = (dataset.version, cube)
+
+    threading.Thread(target=build, daemon=True).start()
+
+
+# The dataset's cube once it is built; None while building or when it has none
+def cube_for(dataset):
+    if dataset is None:
+        return None
+    with _lock:
+        current = _cubes.get(dataset.dataset_id)
+    return current[1] if current is not None and current[0] == dataset.version else None
@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import pandas as pd
+from chart_templates import VEGA_LITE_SCHEMA, normalize_text
+
+# "Give me an overview of this dataset": a dashboard of up to
+# DASHBOARD_MAX_PANELS charts and tables planned locally from the column
+# profiles, without a model call per panel:
+#
+#   - a describe() table of the numeric columns
+#   - row counts per value of the low-cardinality categorical columns
+#   - the distribution of the numeric columns
+#   - the mean of the first numeric column per value of the first categorical one
+#   - the yearly total of the first numeric column over the first date column
+#
+# On a registered dataset every panel is a query plan, so it goes through the
+# cube, the streaming executor and the plan cache like any other. Panels that
+# group by the same columns share one plan whose aggregate step computes all
+# their measures, and identical plans run once. Without a registered dataset
+# the panels plot the browser's sample rows with Vega-Lite doing the aggregation.
+
+DASHBOARD_MAX_PANELS = int(os.environ.get("DASHBOARD_MAX_PANELS", "6"))
+DASHBOARD_KEYWORDS = r"\b(overview|dashboard|summari[sz]e (the|this|my) (data|dataset)|summary of (the|this|my) (data|dataset))\b"
+# Categorical columns with more distinct values than this are not charted
+CATEGORY_MAX_VALUES = 20
+HISTOGRAM_BINS = 20
+# Panels per row of the combined layout
+LAYOUT_COLUMNS = 2
+
+
+def is_dashboard_request(user_query):
+    return re.search(DASHBOARD_KEYWORDS, normalize_text(user_query)) is not None
+
+
+# Each column's kind: "quantitative", "temporal" or "nominal" (charted only
+# with few enough distinct values), from the dataset's logical dtypes or
+# else the browser's types and sample rows
+def profile_columns(columns, dataTypes, sampleData, dataset=None):
+    profiles = {}
+    for column in columns:
+        if dataset is not None:
+            dtype = pd.api.types.pandas_dtype(dataset.schema[column])
+            if pd.api.types.is_bool_dtype(dtype):
+                kind = "nominal"
+            elif pd.api.types.is_numeric_dtype(dtype):
+                kind = "quantitative"
+            elif pd.api.types.is_datetime64_any_dtype(dtype):
+                kind = "temporal"
+            else:
+                values = dataset.distinct_values(column)
+                kind = "nominal" if values is not None and len(values) <= CATEGORY_MAX_VALUES else None
+        else:
+            kind = dataTypes.get(column)
+            if kind == "nominal" and len({str(row.get(column)) for row in sampleData}) > CATEGORY_MAX_VALUES:
+                kind = None
+        if kind is not None:
+            profiles[column] = kind
+    return profiles
+
+
+def grouped_panel(title, mark, by, aggregations, encoding):
+    return {"kind": "chart", "title": title, "mark": mark, "by": by, "aggregations": aggregations, "encoding": encoding}
+
+
+# The panels for the profiled columns, `focus` (columns the question names) first
+def plan_dashboard(columns, dataTypes, sampleData, dataset=None, focus=()):
+    profiles = profile_columns(columns, dataTypes, sampleData, dataset)
+    ordered = [column for column in focus if column in profiles] + [column for column in profiles if column not in focus]
+    numeric = [column for column in ordered if profiles[column] == "quantitative"]
+    categorical = [column for column in ordered if profiles[column] == "nominal"]
+    temporal = [column for column in ordered if profiles[column] == "temporal"]
+    panels = []
+    if numeric:
+        panels.append({"kind": "analysis", "title": "Summary statistics", "steps": [{"op": "describe", "columns": numeric}]})
+    for column in categorical[:2]:
+        panels.append(grouped_panel(f"Rows per {column}", "bar", [column], [{"column": "*", "function": "count", "as": "count"}], {
+            "x": {"field": column, "type": "nominal", "sort": "-y"},
+            "y": {"field": "count", "type": "quantitative", "title": "Count"},
+        }))
+    for column in numeric[:2]:
+        panels.append({"kind": "chart", "title": f"Distribution of {column}", "steps": [{"op": "histogram", "column": column, "bins": HISTOGRAM_BINS}], "mark": "bar", "encoding": {
+            "x": {"field": "bin_start", "type": "quantitative", "bin": {"binned": True}, "title": column},
+            "x2": {"field": "bin_end"},
+            "y": {"field": "count", "type": "quantitative", "title": "Count"},
+        }})
+    if categorical and numeric:
+        category, measure = categorical[0], numeric[0]
+        panels.append(grouped_panel(f"Average {measure} per {category}", "bar", [category], [{"column": measure, "function": "mean", "as": f"mean_{measure}"}], {
+            "x": {"field": category, "type": "nominal", "sort": "-y"},
+            "y": {"field": f"mean_{measure}", "type": "quantitative", "title": f"Average {measure}"},
+        }))
+    if temporal and numeric:
+        when, measure = temporal[0], numeric[0]
+        panel = grouped_panel(f"Total {measure} per year", "line", [f"{when}_year"], [{"column": measure, "function": "sum", "as": f"sum_{measure}"}], {
+            "x": {"field": f"{when}_year", "type": "ordinal", "title": "Year"},
+            "y": {"field": f"sum_{measure}", "type": "quantitative", "title": f"Total {measure}"},
+        })
+        panel["derive"] = [{"op": "derive", "name": f"{when}_year", "expression": {"function": "year", "arg": {"column": when}}}]
+        panels.append(panel)
+    return panels[:DASHBOARD_MAX_PANELS]
+
+
+def canonical(steps):
+    return json.dumps(steps, sort_keys=True, separators=(",", ":"), default=str)
+
+
+# The query plans that compute the panels on a registered dataset, as
+# (plans, panel index -> plan index). Grouped panels with the same grouping
+# share one plan; identical plans are only listed once.
+def panel_plans(panels):
+    plans, merged, assigned = [], {}, {}
+    for index, panel in enumerate(panels):
+        if "by" in panel:
+            prefix = panel.get("derive", []) + [{"op": "groupby", "by": panel["by"]}]
+            key = canonical(prefix)
+            if key not in merged:
+                merged[key] = len(plans)
+                plans.append({"steps": prefix + [{"op": "aggregate", "aggregations": []}]})
+            aggregations = plans[merged[key]]["steps"][-1]["aggregations"]
+            for aggregation in panel["aggregations"]:
+                if aggregation not in aggregations:
+                    aggregations.append(aggregation)
+            assigned[index] = merged[key]
+        else:
+            key = canonical(panel["steps"])
+            if key not in merged:
+                merged[key] = len(plans)
+                plans.append({"steps": panel["steps"]})
+            assigned[index] = merged[key]
+    return plans, assigned
+
+
+def chart_spec(panel, values):
+    return {
+        "$schema": VEGA_LITE_SCHEMA,
+        "title": panel["title"],
+        "data": {"values": values},
+        "mark": panel["mark"],
+        "encoding": panel["encoding"],
+    }
+
+
+# A panel's chart or table from the result of its plan
+def panel_output(panel, frame):
+    if panel["kind"] == "analysis":
+        return {"title": panel["title"], "analysis_result": frame.to_html(index=False)}
+    if "by" in panel:
+        frame = frame[panel["by"] + [aggregation["as"] for aggregation in panel["aggregations"]]]
+    values = json.loads(frame.to_json(orient="records", date_format="iso"))
+    return {"title": panel["title"], "vega_spec": chart_spec(panel, values)}
+
+
+# A panel computed by Vega-Lite from the browser's sample rows
+def sample_panel_output(panel, sampleData):
+    if panel["kind"] == "analysis":
+        frame = pd.DataFrame.from_records(sampleData)[panel["steps"][0]["columns"]].describe()
+        return {"title": f"{panel['title']} (sample rows)", "analysis_result": frame.rename_axis("statistic").reset_index().to_html(index=False)}
+    encoding = json.loads(json.dumps(panel["encoding"]))
+    if "by" in panel:
+        for aggregation in panel["aggregations"]:
+            channel = next(definition for definition in encoding.values() if definition.get("field") == aggregation["as"])
+            channel.pop("field")
+            channel["aggregate"] = "count" if aggregation["column"] == "*" else aggregation["function"]
+            if aggregation["column"] != "*":
+                channel["field"] = aggregation["column"]
+        if "derive" in panel:
+            when = panel["derive"][0]["expression"]["arg"]["column"]
+            encoding["x"] = {"field": when, "timeUnit": "year", "type": "ordinal", "title": "Year"}
+    else:
+        column = panel["steps"][0]["column"]
+        encoding = {
+            "x": {"field": column, "type": "quantitative", "bin": {"maxbins": HISTOGRAM_BINS}},
+            "y": {"aggregate": "count", "type": "quantitative", "title": "Count"},
+        }
+    return {"title": panel["title"], "vega_spec": dict(chart_spec(panel, sampleData), encoding=encoding)}
+
+
+# All chart panels side by side, LAYOUT_COLUMNS to a row
+def dashboard_layout(outputs, title):
+    return {
+        "$schema": VEGA_LITE_SCHEMA,
+        "title": title,
+        "columns": LAYOUT_COLUMNS,
+        "concat": [{key: value for key, value in output["vega_spec"].items() if key != "$schema"} for output in outputs if "vega_spec" in output],
+        "resolve": {"scale": {"color": "independent"}},
+    }
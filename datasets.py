@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+import approximate
+import cube
+import metrics
+from columnar import write_table
+from dtype_optimizer import optimize_frame, restore_frame
+from relevance import MAX_INDEXED_VALUES, RelevanceIndex
+from table_formats import open_table
+from result_cache import result_cache
+
+# In-memory registry of uploaded datasets. The browser still sends a small
+# sample with every query for the prompts, but registering the full table lets
+# the server run analyses on all rows and answer simple questions locally.
+# Each version is also written to the columnar store so executions can load
+# just the columns they reference.
+
+DATASET_DIR = os.environ.get("DATASET_DIR") or os.path.join(tempfile.gettempdir(), "datasets")
+# Client-chosen dataset ids name directories under DATASET_DIR
+DATASET_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# Rough in-memory size of one string (object) value, for memory estimates
+OBJECT_VALUE_BYTES = 64
+
+_datasets = {}
+_lock = threading.Lock()
+
+
+class Dataset:
+    def __init__(self, dataset_id, table, version, content_hash, index, frame=None, schema=None, memory=None):
+        self.dataset_id = dataset_id
+        self.table = table
+        self.version = version
+        self.content_hash = content_hash
+        # Built once at upload time, queried locally on every question
+        self.index = index
+        self.column_sizes = table.column_nbytes()
+        self._frame = frame
+        # Logical dtypes before memory optimisation, used in prompts and restored for generated code
+        self.schema = schema or table.schema()
+        self.memory = memory  # Memory before/after the dtype optimisation pass
+
+    @property
+    def columns(self):
+        return self.table.columns
+
+    @property
+    def num_rows(self):
+        return self.table.num_rows
+
+    # The whole table as a DataFrame in its compact storage dtypes, memory-mapped from the columnar store on
+    # first use when the dataset was ingested without ever being in memory
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = self.table.read(mmap=True)
+        return self._frame
+
+    # Load a fresh, writable copy of the given columns (all when None) from the
+    # store in their logical dtypes, recording how many bytes the projection
+    # skipped. `filters` are (column, operator, value) triples the store applies
+    # while reading, skipping whole row groups where it can.
+    def load(self, columns=None, filters=None):
+        if columns is None:
+            metrics.increment("column_pruning.full_loads")
+            return restore_frame(self.table.read(mmap=False, filters=filters), self.schema)
+        columns = self.projection(columns)
+        avoided = sum(size for column, size in self.column_sizes.items() if column not in columns)
+        metrics.increment("column_pruning.pruned_loads")
+        metrics.increment("column_pruning.bytes_avoided", avoided)
+        metrics.observe("column_pruning.bytes_avoided_per_query", avoided)
+        return restore_frame(self.table.read(columns, mmap=False, filters=filters), self.schema)
+
+    # The table's columns among `columns`, in table order; row counts still
+    # need one column, so an empty projection takes the cheapest
+    def projection(self, columns):
+        columns = [column for column in self.table.columns if column in columns]
+        if not columns and self.table.columns:
+            columns = [min(self.column_sizes, key=self.column_sizes.get)]
+        return columns
+
+    # Stream the table chunk by chunk in its logical dtypes, for datasets too
+    # large to load; an empty column list still yields the row counts
+    def iter_chunks(self, columns=None, filters=None):
+        if columns is not None:
+            columns = self.projection(columns)
+        for chunk in self.table.iter_chunks(columns, mmap=True, filters=filters):
+            yield restore_frame(chunk, self.schema)
+
+    # Bytes the whole table would take loaded in its logical dtypes
+    def memory_estimate(self):
+        if self.memory is not None:
+            return self.memory["memory_before"]
+        return estimate_memory(self.schema, self.num_rows)
+
+    # Zero rows in the logical dtypes, for code that only needs the schema
+    def empty_frame(self):
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in self.schema.items()}, columns=self.columns)
+
+    # Distinct values of a string column when it has few enough to index
+    def distinct_values(self, column):
+        return self.table.distinct_values(column, MAX_INDEXED_VALUES)
+
+
+# Approximate in-memory size of `rows` rows in the given logical dtypes
+def estimate_memory(schema, rows):
+    row_bytes = 0
+    for dtype in schema.values():
+        try:
+            row_bytes += OBJECT_VALUE_BYTES if dtype == "object" else np.dtype(dtype).itemsize
+        except TypeError:  # Timezone-aware datetimes
+            row_bytes += 8
+    return row_bytes * rows
+
+
+# Stable content hash of a DataFrame (values, index and column names)
+def hash_frame(frame):
+    digest = hashlib.sha256()
+    digest.update("\x1f".join(map(str, frame.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(frame, index=True).values.tobytes())
+    return digest.hexdigest()
+
+
+def valid_dataset_id(dataset_id):
+    return isinstance(dataset_id, str) and DATASET_ID.match(dataset_id) is not None
+
+
+# Directory of one version of a dataset, refusing anything that would leave DATASET_DIR
+def version_path(dataset_id, version):
+    if not valid_dataset_id(dataset_id):
+        raise ValueError(f"Invalid dataset id: {dataset_id!r}")
+    root = os.path.realpath(DATASET_DIR)
+    path = os.path.realpath(os.path.join(root, f"{dataset_id}-v{version}"))
+    if os.path.dirname(path) != root:
+        raise ValueError(f"Invalid dataset id: {dataset_id!r}")
+    return path
+
+
+# Fresh directory for a table that is still being written
+def staging_path():
+    return os.path.join(DATASET_DIR, f"staging-{uuid.uuid4().hex}")
+
+
+# Register rows (list of dicts) or a DataFrame; re-registering an existing id
+# replaces its contents and bumps the version
+def log_memory(memory):
+    metrics.increment("dtypes.bytes_saved", memory["memory_before"] - memory["memory_after"])
+    logging.info(f"Optimised dtypes: {memory['memory_before']:,} -> {memory['memory_after']:,} bytes ({len(memory['columns'])} columns converted).")
+
+
+def register_dataset(data, dataset_id=None):
+    if dataset_id is not None and not valid_dataset_id(dataset_id):
+        raise ValueError(f"Invalid dataset id: {dataset_id!r}")
+    frame = data if isinstance(data, pd.DataFrame) else pd.DataFrame.from_records(data)
+    frame, schema, memory = optimize_frame(frame)
+    log_memory(memory)
+    table = write_table(frame, staging_path())
+    return register_table(table, hash_frame(frame), RelevanceIndex.from_frame(frame), dataset_id, frame, schema, memory)
+
+
+# Register a table already written to a staging directory (columnar store,
+# Parquet or Arrow file); the directory is moved into place under the new version
+def register_table(table, content_hash, index, dataset_id=None, frame=None, schema=None, memory=None):
+    with _lock:
+        dataset_id = dataset_id or uuid.uuid4().hex
+        previous = _datasets.get(dataset_id)
+        version = previous.version + 1 if previous else 1
+        path = version_path(dataset_id, version)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(table.path, path)
+        dataset = Dataset(dataset_id, open_table(path), version, content_hash, index, frame, schema, memory)
+        _datasets[dataset_id] = dataset
+    if previous is not None:
+        # Cached results of the old version must not be served for the new one.
+        # Its files stay until the next version, for requests still reading them.
+        result_cache.invalidate_dataset(dataset_id)
+        shutil.rmtree(version_path(dataset_id, version - 2), ignore_errors=True)
+    logging.info(f"Registered dataset {dataset_id} v{dataset.version}: {dataset.num_rows} rows, {len(dataset.columns)} columns.")
+    cube.prepare_cube(dataset)
+    if approximate.APPROXIMATE_ANSWERS:
+        approximate.prepare_sample(dataset)
+    return dataset
+
+
+def get_dataset(dataset_id):
+    if not dataset_id:
+        return None
+    with _lock:
+        return _datasets.get(dataset_id)
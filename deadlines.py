@@ -0,0 +1,73 @@
+import contextvars
+import os
+import time
+import metrics
+
+# End-to-end request deadlines. A request gets REQUEST_DEADLINE_SECONDS, or
+# the deadline its client asked for, and each stage may use its weight's
+# share of the time still left against the stages after it: routing first,
+# then generation, then execution, so time a stage does not use passes on to
+# the later ones. Model calls also cap max_tokens at what the observed output
+# rate can produce in the time left. A stage that runs out raises
+# DeadlineExceeded, and the request answers with a best-effort fallback
+# instead of its full answer.
+
+REQUEST_DEADLINE_SECONDS = float(os.environ.get("REQUEST_DEADLINE_SECONDS", "60"))
+# Client deadlines are clamped to this range
+MIN_DEADLINE_SECONDS = 2.0
+MAX_DEADLINE_SECONDS = 600.0
+STAGE_WEIGHTS = {"routing": 1, "generation": 3, "execution": 2}
+# max_tokens is never cut below this, so a reply can still close its JSON
+MIN_MAX_TOKENS = 256
+# Output rate assumed until completions have been measured
+DEFAULT_TOKENS_PER_SECOND = 40.0
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage):
+        super().__init__(f"The {stage} stage ran out of time.")
+        self.stage = stage
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    # Seconds `stage` may take: its weight against the stages after it, or
+    # everything left when it is the request's last stage
+    def stage_budget(self, stage, last=False):
+        if last:
+            return self.remaining()
+        stages = list(STAGE_WEIGHTS)
+        later = stages[stages.index(stage):]
+        return self.remaining() * STAGE_WEIGHTS[stage] / sum(STAGE_WEIGHTS[name] for name in later)
+
+
+# Start the current request's deadline: the client's, clamped, or the configured one
+def start_deadline(seconds=None):
+    seconds = REQUEST_DEADLINE_SECONDS if seconds is None else min(max(seconds, MIN_DEADLINE_SECONDS), MAX_DEADLINE_SECONDS)
+    deadline = Deadline(seconds)
+    _deadline.set(deadline)
+    return deadline
+
+
+def current_deadline():
+    return _deadline.get()
+
+
+# max_tokens reduced to what the model can write in the time left
+def token_limit(max_tokens):
+    deadline = _deadline.get()
+    if deadline is None:
+        return max_tokens
+    affordable = int(deadline.remaining() * metrics.mean("deadline.tokens_per_second", DEFAULT_TOKENS_PER_SECOND))
+    limit = min(max_tokens, max(MIN_MAX_TOKENS, affordable))
+    if limit < max_tokens:
+        metrics.increment("deadline.max_tokens_reduced")
+    return limit
@@ -0,0 +1,66 @@
+import os
+import re
+from chart_templates import normalize_text
+
+# Compound questions ("compare revenue growth by region and show the top 3
+# products in each") are split by a planner call into a DAG of smaller
+# analysis and chart tasks. Each task names the tasks whose results it reads;
+# an analysis task's result is a DataFrame that later tasks see under the
+# task's id, and a chart task plots one of them. Tasks whose inputs are ready
+# are generated and run side by side, and the answer is assembled from all
+# task results in plan order.
+
+QUERY_DECOMPOSITION = os.environ.get("QUERY_DECOMPOSITION", "1") == "1"
+DECOMPOSE_MAX_TASKS = int(os.environ.get("DECOMPOSE_MAX_TASKS", "6"))
+TASK_TYPES = {"analysis", "chart"}
+TASK_ID = re.compile(r"^[A-Za-z_][A-Za-z0-9_]{0,30}$")
+
+ACTION_WORDS = {
+    "compare", "show", "plot", "chart", "graph", "visualize", "visualise", "list", "find", "compute",
+    "calculate", "rank", "summarize", "summarise", "count", "break", "top", "identify", "which", "what",
+}
+CONNECTORS = r"\b(and|then|also|plus)\b|[;,]"
+
+
+class TaskGraphError(ValueError):
+    pass
+
+
+# Worth a planner call: at least two requested actions joined by a connector
+def is_compound(user_query):
+    query = normalize_text(user_query)
+    actions = sum(word in ACTION_WORDS for word in re.findall(r"[a-z]+", query))
+    return actions >= 2 and re.search(CONNECTORS, user_query.lower()) is not None
+
+
+# Check the planner's tasks form a DAG over existing analysis results;
+# returns the tasks in an order where every task follows its dependencies
+def validate_tasks(tasks):
+    if not isinstance(tasks, list) or not tasks:
+        raise TaskGraphError("The plan needs a non-empty 'tasks' list.")
+    if len(tasks) > DECOMPOSE_MAX_TASKS:
+        raise TaskGraphError(f"At most {DECOMPOSE_MAX_TASKS} tasks are allowed.")
+    by_id = {}
+    for task in tasks:
+        if not isinstance(task, dict) or task.get("type") not in TASK_TYPES or not isinstance(task.get("request"), str):
+            raise TaskGraphError(f"Invalid task: {task!r}")
+        if not isinstance(task.get("id"), str) or not TASK_ID.match(task["id"]) or task["id"] in by_id or task["id"] == "df":
+            raise TaskGraphError(f"Task ids must be unique identifiers: {task.get('id')!r}")
+        task.setdefault("depends_on", [])
+        if not isinstance(task["depends_on"], list):
+            raise TaskGraphError(f"'depends_on' of {task['id']} must be a list.")
+        by_id[task["id"]] = task
+    for task in tasks:
+        for dependency in task["depends_on"]:
+            if dependency not in by_id:
+                raise TaskGraphError(f"{task['id']} depends on unknown task {dependency!r}.")
+            if by_id[dependency]["type"] != "analysis":
+                raise TaskGraphError(f"{task['id']} depends on {dependency}, which produces no data.")
+    ordered, done = [], set()
+    while len(ordered) < len(tasks):
+        ready = [task for task in tasks if task["id"] not in done and set(task["depends_on"]) <= done]
+        if not ready:
+            raise TaskGraphError("The task dependencies form a cycle.")
+        ordered.extend(ready)
+        done.update(task["id"] for task in ready)
+    return ordered
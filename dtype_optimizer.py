@@ -0,0 +1,112 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+
+# Memory optimisation pass run when a dataset is registered. Default pandas
+# inference leaves low-cardinality strings as object columns and every number
+# as 64-bit; this converts them to the smallest lossless representation:
+#
+#   - "true"/"false" text columns become bool, date strings become datetime64
+#   - low-cardinality strings become categoricals
+#   - integers are downcast to the smallest integer type holding their range
+#   - floats become float32 when that round-trips exactly
+#
+# The first two change what the column *is* and are kept everywhere. The last
+# three only change how it is stored: restore_frame() undoes them before a
+# frame is handed to generated code, so results and prompts use the logical
+# schema (object, int64, float64) and int8 arithmetic cannot overflow.
+
+# Strings become categoricals when at most this share of values is distinct
+CATEGORY_MAX_RATIO = float(os.environ.get("CATEGORY_MAX_RATIO", "0.5"))
+# Rows used to decide whether an object column holds dates before parsing it all
+DATE_SAMPLE_ROWS = 1000
+
+BOOLEAN_TEXT = {"true": True, "false": False}
+NUMERIC_TEXT = re.compile(r"^\s*[-+]?\d+(\.\d*)?\s*$")
+
+
+def memory_usage(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+
+def parse_booleans(series):
+    if series.empty or series.isna().any():
+        return None
+    unique = pd.unique(series)
+    if len(unique) > 6:
+        return None
+    flags = {}
+    for value in unique:
+        flag = BOOLEAN_TEXT.get(value.lower()) if isinstance(value, str) else value if isinstance(value, (bool, np.bool_)) else None
+        if flag is None:
+            return None
+        flags[value] = flag
+    return series.map(flags).astype(bool)
+
+
+# Parse a whole object column as dates in one call, after checking a sample;
+# plain numbers are left alone even though they would parse as timestamps
+def parse_dates(series):
+    sample = series.dropna().head(DATE_SAMPLE_ROWS)
+    if sample.empty or not sample.map(lambda value: isinstance(value, str)).all():
+        return None
+    if sample.str.match(NUMERIC_TEXT).any():
+        return None
+    try:
+        pd.to_datetime(sample)
+        return pd.to_datetime(series)
+    except (ValueError, TypeError, OverflowError):
+        return None
+
+
+def downcast_float(series):
+    narrow = series.astype(np.float32)
+    same = (narrow.astype(np.float64) == series) | series.isna()
+    return narrow if same.all() else series
+
+
+# Smallest lossless storage for a numeric column; other columns are returned as-is
+def downcast_numeric(series):
+    if pd.api.types.is_integer_dtype(series.dtype) and isinstance(series.dtype, np.dtype):
+        return pd.to_numeric(series, downcast="integer")
+    if pd.api.types.is_float_dtype(series.dtype):
+        return downcast_float(series)
+    return series
+
+
+# Returns (optimised frame, logical schema, report). The schema maps each
+# column to its dtype before the storage-only conversions.
+def optimize_frame(frame):
+    before = memory_usage(frame)
+    stored, schema, changes = {}, {}, {}
+    for column in frame.columns:
+        series = frame[column]
+        if series.dtype == object:
+            series = next((parsed for parsed in (parse_booleans(series), parse_dates(series)) if parsed is not None), series)
+        schema[column] = str(series.dtype)
+        if series.dtype == object:
+            if series.nunique(dropna=True) <= CATEGORY_MAX_RATIO * len(series):
+                categorical = series.astype("category")
+                # Tiny tables can be smaller as plain objects than with the category table
+                if categorical.memory_usage(deep=True) < series.memory_usage(deep=True):
+                    series = categorical
+        else:
+            series = downcast_numeric(series)
+        stored[column] = series
+        if str(series.dtype) != str(frame[column].dtype):
+            changes[column] = {"from": str(frame[column].dtype), "to": str(series.dtype)}
+    stored = pd.DataFrame(stored, index=frame.index)
+    report = {"memory_before": before, "memory_after": memory_usage(stored), "columns": changes}
+    return stored, schema, report
+
+
+# Cast storage-only types back to the logical schema
+def restore_frame(frame, schema):
+    casts = {column: schema[column] for column in frame.columns if column in schema and str(frame[column].dtype) != schema[column]}
+    for column, dtype in casts.items():
+        if dtype == "object":
+            frame[column] = np.asarray(frame[column], dtype=object)
+        else:
+            frame[column] = frame[column].astype(dtype)
+    return frame
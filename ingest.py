@@ -0,0 +1,375 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+import pandas as pd
+import metrics
+from columnar import TableWriter
+from datasets import estimate_memory, log_memory, register_table, staging_path
+from dtype_optimizer import downcast_numeric
+from relevance import RelevanceIndex
+from table_formats import ARROW_FILES, HAVE_PYARROW, open_table
+
+try:
+    import openpyxl
+except ImportError:  # Only needed for Excel uploads
+    openpyxl = None
+
+# Server-side ingestion of large or non-CSV files. The browser uploads the raw
+# file in chunks to an upload session (resumable: the server's byte count is
+# the offset to continue from), then:
+#
+#   - CSV/TSV, JSON Lines and Excel are parsed in bounded-memory chunks of rows
+#     and written chunk by chunk to the columnar store. Column types are
+#     inferred from the first chunk and promoted (int -> float -> string,
+#     bool/datetime -> string) when a later chunk disagrees; chunks already
+#     written are widened, and a column promoted to string is re-read from
+#     the upload so earlier rows keep their text as written.
+#   - Parquet and Arrow/Feather files are already columnar and are registered
+#     as they are, so queries read them with projection and filter pushdown.
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR") or os.path.join(tempfile.gettempdir(), "uploads")
+UPLOAD_CHUNK_BYTES = int(os.environ.get("UPLOAD_CHUNK_BYTES", str(8 * 1024 * 1024)))
+INGEST_CHUNK_ROWS = int(os.environ.get("INGEST_CHUNK_ROWS", "200000"))
+INGEST_SAMPLE_ROWS = int(os.environ.get("INGEST_SAMPLE_ROWS", "10000"))
+
+# Next, wider type for a column whose values no longer fit
+PROMOTIONS = {"int": "float", "float": "string", "bool": "string", "datetime": "string"}
+# How each inferred type is stored: (columnar kind, numpy dtype)
+STORAGE = {"int": ("numeric", "int64"), "float": ("numeric", "float64"), "bool": ("bool", None), "datetime": ("datetime", None), "string": ("string", None)}
+# File extension -> upload format
+FORMATS = {
+    ".csv": "csv", ".tsv": "tsv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".xlsx": "xlsx",
+    ".parquet": "parquet", ".pq": "parquet", ".feather": "ipc", ".arrow": "ipc", ".ipc": "ipc",
+}
+# Rows returned with a finished upload for the browser's preview and prompt sample
+PREVIEW_ROWS = 15
+
+_uploads = {}
+_lock = threading.Lock()
+
+
+class UploadSession:
+    def __init__(self, upload_id, filename, size, file_format, dataset_id=None):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.format = file_format
+        self.dataset_id = dataset_id
+        self.path = os.path.join(UPLOAD_DIR, upload_id + os.path.splitext(filename)[1].lower())
+        self.state = "receiving"  # receiving -> parsing -> ready | failed
+        self.rows_parsed = 0
+        self.bytes_parsed = 0
+        self.error = None
+        self.promotions = []
+        self.sample = None  # First rows as JSON records, once ready
+        self.lock = threading.Lock()  # Serialises chunk appends
+
+    @property
+    def received(self):
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def status(self):
+        # The raw file is deleted once parsed
+        received = self.received if self.state == "receiving" else self.size
+        # Upload progress while receiving, parse progress afterwards
+        done = received if self.state == "receiving" else self.bytes_parsed
+        progress = done / self.size if self.size else 0.0
+        return {
+            "upload_id": self.upload_id,
+            "state": self.state,
+            "format": self.format,
+            "received": received,
+            "size": self.size,
+            "rows_parsed": self.rows_parsed,
+            "progress": round(min(progress, 1.0), 4),
+            "chunk_size": UPLOAD_CHUNK_BYTES,
+            "dataset_id": self.dataset_id if self.state == "ready" else None,
+            "promotions": self.promotions,
+            "sample": self.sample,
+            "error": self.error,
+        }
+
+
+# Upload format from the file name; ValueError for formats that cannot be read here
+def upload_format(filename):
+    file_format = FORMATS.get(os.path.splitext(filename or "")[1].lower())
+    if file_format is None:
+        raise ValueError(f"Unsupported file type. Upload one of: {', '.join(sorted(FORMATS))}.")
+    if file_format in ARROW_FILES and not HAVE_PYARROW:
+        raise ValueError("Parquet and Arrow files need pyarrow, which is not installed on the server.")
+    if file_format == "xlsx" and openpyxl is None:
+        raise ValueError("Excel files need openpyxl, which is not installed on the server.")
+    return file_format
+
+
+def create_upload(filename, size, dataset_id=None):
+    file_format = upload_format(filename)
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    session = UploadSession(uuid.uuid4().hex, filename, size, file_format, dataset_id)
+    open(session.path, "wb").close()
+    with _lock:
+        _uploads[session.upload_id] = session
+    return session
+
+
+def get_upload(upload_id):
+    with _lock:
+        return _uploads.get(upload_id)
+
+
+# Append one chunk at `offset`. A chunk for an offset the server already has
+# is acknowledged without writing, so a client retrying after a lost response
+# just continues; a gap raises ValueError with the offset to resume from.
+def append_chunk(session, offset, data):
+    with session.lock:
+        received = session.received
+        if session.state != "receiving":
+            raise ValueError(f"The upload is already {session.state}.")
+        if offset + len(data) <= received:
+            return received
+        if offset != received:
+            raise ValueError(f"Expected a chunk at offset {received}.")
+        if received + len(data) > session.size:
+            raise ValueError("The chunk runs past the declared file size.")
+        with open(session.path, "ab") as handle:
+            handle.write(data)
+        return received + len(data)
+
+
+# Narrowest type every value of each sample column (read as text) fits
+def infer_types(sample):
+    types = {}
+    for column in sample.columns:
+        values = sample[column]
+        if convert_column(values, "bool") is not None:
+            types[column] = "bool"
+        elif convert_column(values, "int") is not None:
+            types[column] = "int"
+        elif convert_column(values, "float") is not None:
+            types[column] = "float"
+        else:
+            types[column] = "datetime" if values.notna().any() and convert_column(values.dropna(), "datetime") is not None else "string"
+    return types
+
+
+# Values (read as text) converted to the given type, or None if any do not fit
+def convert_column(values, kind):
+    try:
+        if kind == "int":
+            numbers = pd.to_numeric(values)
+            if numbers.isna().any() or not (numbers % 1 == 0).all():
+                return None
+            return numbers.astype("int64")
+        if kind == "float":
+            return pd.to_numeric(values).astype("float64")
+        if kind == "bool":
+            flags = values.str.lower().map({"true": True, "false": False})
+            return flags.astype(bool) if flags.notna().all() else None
+        if kind == "datetime":
+            return pd.to_datetime(values)
+    except (ValueError, TypeError, OverflowError):
+        return None
+    return values.astype(object).where(values.notna(), None)
+
+
+# Convert a chunk to the current types, promoting (and widening the chunks
+# already written) for every column this chunk does not fit
+def convert_chunk(chunk, types, writer, session):
+    converted = {}
+    for position, column in enumerate(chunk.columns):
+        kind = types[column]
+        values = convert_column(chunk[column], kind)
+        while values is None:
+            kind = PROMOTIONS[kind]
+            values = convert_column(chunk[column], kind)
+        if kind != types[column]:
+            session.promotions.append({"column": column, "from": types[column], "to": kind, "row": session.rows_parsed})
+            metrics.increment("ingest.promotions")
+            types[column] = kind
+            if writer.columns is not None:
+                parsed = session.bytes_parsed
+                text = (convert_column(values, "string") for values in source_column(session, column, position, len(writer.chunks))) if kind == "string" else None
+                writer.promote(position, *STORAGE[kind], values=text)
+                session.bytes_parsed = parsed
+        converted[column] = values
+    return pd.DataFrame(converted, index=chunk.index)
+
+
+# The text of `column` (at `position`) in the first `count` chunks, read again
+# from the upload: converted values would not give back the text as written
+# ("true" for "TRUE", reformatted dates)
+def source_column(session, column, position, count):
+    if session.format in ("csv", "tsv"):
+        with open(session.path, "rb") as handle:
+            reader = pd.read_csv(handle, chunksize=INGEST_CHUNK_ROWS, dtype=str, sep="\t" if session.format == "tsv" else ",", usecols=[position])
+            for _, chunk in zip(range(count), reader):
+                yield chunk.iloc[:, 0]
+        return
+    for _, chunk in zip(range(count), text_chunks(session)):
+        yield chunk.reindex(columns=[column])[column]
+
+
+# Move a fully received upload to parsing; False if parsing already started
+def start_ingest(session):
+    with session.lock:
+        if session.state != "receiving":
+            return False
+        if session.received != session.size:
+            raise ValueError(f"Only {session.received} of {session.size} bytes have been received.")
+        session.state = "parsing"
+        return True
+
+
+# Cells of a parsed chunk as text (None for missing), the form the type
+# conversions expect whatever the source format
+def as_text(chunk):
+    return chunk.astype(str).where(chunk.notna(), None)
+
+
+def excel_chunks(session):
+    workbook = openpyxl.load_workbook(session.path, read_only=True, data_only=True)
+    try:
+        sheet = workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(name) if name is not None else f"column_{index + 1}" for index, name in enumerate(header)]
+        total_rows = sheet.max_row or 0
+        batch, read = [], 0
+        for row in rows:
+            read += 1
+            if all(value is None for value in row):
+                continue
+            batch.append(row[:len(columns)])
+            if len(batch) == INGEST_CHUNK_ROWS:
+                session.bytes_parsed = int(session.size * read / total_rows) if total_rows else 0
+                yield as_text(pd.DataFrame.from_records(batch, columns=columns))
+                batch = []
+        if batch:
+            yield as_text(pd.DataFrame.from_records(batch, columns=columns))
+    finally:
+        workbook.close()
+
+
+# Chunks of rows as text frames, tracking how far into the file parsing is
+def text_chunks(session):
+    if session.format == "xlsx":
+        yield from excel_chunks(session)
+        return
+    with open(session.path, "rb") as handle:
+        if session.format == "jsonl":
+            reader = pd.read_json(handle, lines=True, chunksize=INGEST_CHUNK_ROWS, dtype=False, convert_dates=False)
+        else:
+            reader = pd.read_csv(handle, chunksize=INGEST_CHUNK_ROWS, dtype=str, sep="\t" if session.format == "tsv" else ",")
+        for chunk in reader:
+            yield chunk if session.format != "jsonl" else as_text(chunk)
+            session.bytes_parsed = handle.tell()
+
+
+# Parse a row-oriented upload chunk by chunk into the columnar store
+def parse_rows(session, path):
+    writer = TableWriter(path)
+    types = None
+    # Smallest dtype holding every chunk so far of each numeric column
+    narrowest = {}
+    digest = hashlib.sha256()
+    for chunk in text_chunks(session):
+        if types is None:
+            types = infer_types(chunk.head(INGEST_SAMPLE_ROWS))
+            digest.update("\x1f".join(map(str, chunk.columns)).encode())
+        # JSON records may leave keys out; keys that first appear later are dropped
+        chunk = chunk.reindex(columns=list(types))
+        frame = convert_chunk(chunk, types, writer, session)
+        writer.append(frame)
+        for column in frame.columns:
+            if types[column] in ("int", "float"):
+                dtype = downcast_numeric(frame[column]).dtype
+                narrowest[column] = np.promote_types(narrowest.get(column, dtype), dtype)
+        digest.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+        session.rows_parsed += len(frame)
+    if session.rows_parsed == 0:
+        raise ValueError("The file has no rows.")
+    changes = narrow_columns(writer, types, narrowest)
+    table = writer.close()
+    # Logical dtypes, restored when the narrowed columns are read
+    schema = {**table.schema(), **{column: change["from"] for column, change in changes.items()}}
+    memory = {"memory_before": estimate_memory(schema, session.rows_parsed), "memory_after": estimate_memory(table.schema(), session.rows_parsed), "columns": changes}
+    log_memory(memory)
+    return table, digest.hexdigest(), schema, memory
+
+
+# The integer and float downcasts register_dataset applies, made once the
+# whole file is parsed: a column's range is only known after its last chunk
+def narrow_columns(writer, types, narrowest):
+    changes = {}
+    for position, column in enumerate(types):
+        if types[column] not in ("int", "float"):
+            continue
+        stored = STORAGE[types[column]][1]
+        if narrowest[column].itemsize < np.dtype(stored).itemsize:
+            writer.promote(position, "numeric", str(narrowest[column]))
+            changes[column] = {"from": stored, "to": str(narrowest[column])}
+    return changes
+
+
+# Parquet and Arrow files are hashed and moved into place without conversion
+def store_columnar_file(session, path):
+    digest = hashlib.sha256()
+    with open(session.path, "rb") as handle:
+        for block in iter(lambda: handle.read(UPLOAD_CHUNK_BYTES), b""):
+            digest.update(block)
+            session.bytes_parsed = handle.tell()
+    os.makedirs(path)
+    os.replace(session.path, os.path.join(path, ARROW_FILES[session.format]))
+    table = open_table(path)
+    session.rows_parsed = table.num_rows
+    if session.rows_parsed == 0:
+        raise ValueError("The file has no rows.")
+    return table, digest.hexdigest()
+
+
+def preview_rows(table):
+    for chunk in table.iter_chunks():
+        if len(chunk):
+            return json.loads(chunk.head(PREVIEW_ROWS).to_json(orient="records", date_format="iso"))
+    return []
+
+
+# Read the uploaded file into a stored table and register it as a dataset
+def ingest_upload(session):
+    started = time.perf_counter()
+    path = staging_path()
+    try:
+        if session.format in ARROW_FILES:
+            table, digest = store_columnar_file(session, path)
+            schema = memory = None
+        else:
+            table, digest, schema, memory = parse_rows(session, path)
+        sample = preview_rows(table)
+        dataset = register_table(table, digest, RelevanceIndex.from_table(table), session.dataset_id, schema=schema, memory=memory)
+    except Exception as e:
+        logging.error(f"Ingesting upload {session.upload_id} failed: {e!r}")
+        shutil.rmtree(path, ignore_errors=True)
+        session.error = str(e)
+        session.state = "failed"
+        metrics.increment("ingest.failed")
+        return None
+    finally:
+        if os.path.exists(session.path):
+            os.remove(session.path)
+    session.dataset_id = dataset.dataset_id
+    session.sample = sample
+    session.bytes_parsed = session.size
+    session.state = "ready"
+    metrics.increment("ingest.rows", session.rows_parsed)
+    metrics.observe("ingest.seconds", time.perf_counter() - started)
+    logging.info(f"Ingested upload {session.upload_id} ({session.filename}, {session.format}) as dataset {dataset.dataset_id}: {session.rows_parsed} rows.")
+    return dataset
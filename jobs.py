@@ -0,0 +1,200 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+import metrics
+
+# Background jobs for long analyses: POST /jobs queues a query and answers
+# 202 with a job id at once, JOB_WORKERS workers run queued jobs in order,
+# and clients poll the status and result endpoints instead of holding a
+# connection open. Every job is a JSON file under JOB_DIR, rewritten on each
+# state change, so a restarted server picks its queue back up; jobs that were
+# running when it stopped are marked failed, since their datasets and
+# kernels did not survive, and so are queued jobs whose dataset is gone.
+#
+# Cancelling a queued job just marks it; cancelling a running one cancels the
+# CancelScope its work entered, which stops generated code in pool threads and
+# kills kernels running its code, then its task, which closes any model
+# stream it is reading.
+#
+# A finished job keeps its result (its request loses the uploaded rows) for
+# JOB_RETENTION_SECONDS, and only the JOB_MAX_FINISHED most recent are kept.
+
+JOB_DIR = os.environ.get("JOB_DIR") or os.path.join(tempfile.gettempdir(), "jobs")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_RETENTION_SECONDS = int(os.environ.get("JOB_RETENTION_SECONDS", str(24 * 3600)))
+JOB_MAX_FINISHED = int(os.environ.get("JOB_MAX_FINISHED", "1000"))
+FINISHED = {"succeeded", "failed", "cancelled"}
+
+_jobs = {}  # job_id -> job record
+_running = {}  # job_id -> asyncio task of a running job
+_scopes = {}  # job_id -> CancelScope of a running job's work
+_lock = threading.Lock()
+_queue = None
+_runner = None
+
+
+def job_path(job_id):
+    return os.path.join(JOB_DIR, f"{job_id}.json")
+
+
+def save_job(job):
+    os.makedirs(JOB_DIR, exist_ok=True)
+    staging = job_path(job["job_id"]) + ".tmp"
+    with open(staging, "w") as handle:
+        json.dump(job, handle, default=str)
+    os.replace(staging, job_path(job["job_id"]))
+
+
+def update_job(job, **changes):
+    with _lock:
+        job.update(changes)
+        save_job(job)
+
+
+# Move a job to a finished `status`; the rows sent with its request are not
+# needed any more
+def finish_job(job, status, **changes):
+    request = {key: value for key, value in job["request"].items() if key != "FullData"}
+    update_job(job, status=status, request=request, finished_at=time.time(), **changes)
+
+
+# Forget finished jobs past JOB_RETENTION_SECONDS, and the oldest beyond JOB_MAX_FINISHED
+def prune_jobs():
+    with _lock:
+        finished = sorted((job for job in _jobs.values() if job["status"] in FINISHED), key=lambda job: job["finished_at"], reverse=True)
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        expired = [job for index, job in enumerate(finished) if index >= JOB_MAX_FINISHED or job["finished_at"] < cutoff]
+        for job in expired:
+            del _jobs[job["job_id"]]
+            try:
+                os.remove(job_path(job["job_id"]))
+            except FileNotFoundError:
+                pass
+    if expired:
+        metrics.increment("jobs.pruned", len(expired))
+
+
+# The job's record without its request and result, for status polling
+def job_status(job):
+    return {key: value for key, value in job.items() if key not in ("request", "result")}
+
+
+def get_job(job_id):
+    with _lock:
+        job = _jobs.get(job_id)
+        if job is None and os.path.exists(job_path(job_id)):
+            with open(job_path(job_id)) as handle:
+                job = _jobs[job_id] = json.load(handle)
+        return job
+
+
+# Start the workers with `run(job, emit)`, the coroutine answering a job's
+# request, and requeue the jobs an earlier server left queued whose dataset
+# `get_dataset(dataset_id)` still finds
+def start_jobs(run, get_dataset):
+    global _queue, _runner
+    _queue, _runner = asyncio.Queue(), run
+    pending = []
+    for path in glob.glob(os.path.join(JOB_DIR, "*.json")):
+        with open(path) as handle:
+            job = json.load(handle)
+        _jobs[job["job_id"]] = job
+        if job["status"] == "running":
+            finish_job(job, "failed", error="The server restarted while the job was running.")
+        elif job["status"] == "queued":
+            dataset_id = job["request"].get("dataset_id")
+            if dataset_id and get_dataset(dataset_id) is None:
+                # Running on the sample rows alone would report a wrong answer as a success
+                finish_job(job, "failed", error="The server restarted and the job's dataset is no longer registered.")
+            else:
+                pending.append(job)
+    prune_jobs()
+    for job in sorted(pending, key=lambda job: job["created_at"]):
+        _queue.put_nowait(job["job_id"])
+    if pending:
+        logging.info(f"Requeued {len(pending)} jobs from {JOB_DIR}.")
+    for _ in range(JOB_WORKERS):
+        asyncio.get_running_loop().create_task(work())
+
+
+# Jobs waiting for a worker (cancelled ones among them until a worker skips them)
+def queued_jobs():
+    return _queue.qsize() if _queue is not None else 0
+
+
+def store_job(job):
+    with _lock:
+        _jobs[job["job_id"]] = job
+        save_job(job)
+
+
+# Persist the job off the event loop, then queue it on the loop: asyncio
+# queues are not thread-safe
+async def submit_job(request):
+    job = {"job_id": uuid.uuid4().hex, "status": "queued", "stage": None, "created_at": time.time(), "request": request}
+    await asyncio.to_thread(store_job, job)
+    _queue.put_nowait(job["job_id"])
+    metrics.increment("jobs.submitted")
+    return job
+
+
+async def work():
+    while True:
+        job = get_job(await _queue.get())
+        if job is None or job["status"] != "queued":
+            continue
+        metrics.observe("jobs.queue_seconds", time.time() - job["created_at"])
+        update_job(job, status="running", started_at=time.time())
+
+        async def emit(event, data):
+            # Polling clients see the latest stage the pipeline reported
+            if event == "route":
+                update_job(job, stage=data.get("type"))
+
+        task = asyncio.create_task(_runner(job, emit))
+        _running[job["job_id"]] = task
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            finish_job(job, "cancelled")
+            metrics.increment("jobs.cancelled")
+        except Exception as e:
+            logging.error(f"Job {job['job_id']} failed: {e!r}")
+            finish_job(job, "failed", error=str(getattr(e, "detail", e)))
+            metrics.increment("jobs.failed")
+        else:
+            finish_job(job, "succeeded", result=result)
+            metrics.increment("jobs.succeeded")
+            metrics.observe("jobs.run_seconds", job["finished_at"] - job["started_at"])
+        finally:
+            _running.pop(job["job_id"], None)
+            _scopes.pop(job["job_id"], None)
+        await asyncio.to_thread(prune_jobs)
+
+
+# Keep the CancelScope a running job's work entered, for cancel_job
+def set_job_scope(job_id, scope):
+    _scopes[job_id] = scope
+
+
+# Cancel a queued or running job; returns the job, or None if there is no such job
+def cancel_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return None
+    if job["status"] == "queued":
+        finish_job(job, "cancelled")
+        metrics.increment("jobs.cancelled")
+    scope = _scopes.get(job_id)
+    if scope is not None:
+        scope.cancel(request=False)
+    task = _running.get(job_id)
+    if task is not None:
+        task.cancel()
+    return job
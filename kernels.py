@@ -0,0 +1,431 @@
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import pandas as pd
+import metrics
+from cancellation import cancellable
+from code_runner import render_analysis_result, run_panda_dataframe_code
+from dtype_optimizer import restore_frame
+from table_formats import open_table
+
+# Per-session execution kernels for multi-turn analysis. Each chat session
+# (the client's session_id) gets a worker process holding a namespace that
+# outlives single requests, so "filter to 2023", then "group that by region"
+# can reuse the DataFrame the first turn built. Every run gets a fresh `df`
+# (the referenced columns of the registered dataset); the other DataFrames
+# and Series the code assigns stay in the namespace, and their names and
+# shapes are listed in later prompts.
+#
+#   - memory: after each run the kernel spills its least recently used
+#     variables to disk until the rest fit KERNEL_MEMORY_BYTES; spilled
+#     variables are loaded back when later code names them
+#   - idle eviction: kernels unused for KERNEL_IDLE_SECONDS, or the least
+#     recently used one beyond KERNEL_MAX_SESSIONS, spill everything and stop;
+#     the session's next run starts a new process that picks the spilled
+#     variables up again
+#   - a namespace is dropped when its session moves to another dataset (or a
+#     new version of it)
+#   - code that names no session variable runs outside the kernel, through
+#     the result cache; what it assigns is listed for later prompts and built
+#     in the kernel, by replaying just the code that assigned it, only once a
+#     later run names it. A session keeps at most KERNEL_MAX_DEFERRED_RUNS
+#     such runs, and deferred state is evicted like kernels: when idle, or
+#     least recently used beyond KERNEL_MAX_SESSIONS
+
+KERNEL_DIR = os.environ.get("KERNEL_DIR") or os.path.join(tempfile.gettempdir(), "kernels")
+KERNEL_MEMORY_BYTES = int(os.environ.get("KERNEL_MEMORY_BYTES", str(512 * 1024 * 1024)))
+KERNEL_IDLE_SECONDS = int(os.environ.get("KERNEL_IDLE_SECONDS", "900"))
+KERNEL_MAX_SESSIONS = int(os.environ.get("KERNEL_MAX_SESSIONS", "16"))
+KERNEL_MAX_DEFERRED_RUNS = int(os.environ.get("KERNEL_MAX_DEFERRED_RUNS", "20"))
+# Rows of a session variable bound to a chart
+KERNEL_CHART_ROWS = 5000
+SESSION_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+SESSION_FILE = "session.json"
+
+_kernels = {}  # session_id -> Kernel
+# session_id -> {"dataset": key, "runs": [{"code", "columns", "names"}], "variables": {name: summary}, "last_used"};
+# a run's "names" are the variables it is the latest deferred run to assign
+_deferred = {}
+_lock = threading.Lock()
+_reaper = None
+# Workers start from a fresh interpreter: forking a threaded server is unsafe
+_context = multiprocessing.get_context("spawn")
+
+
+def valid_session(session_id):
+    return isinstance(session_id, str) and SESSION_ID.match(session_id) is not None
+
+
+def session_dir(session_id):
+    return os.path.join(KERNEL_DIR, session_id)
+
+
+def dataset_key(dataset):
+    return [dataset.dataset_id, dataset.version] if dataset is not None else None
+
+
+# Whether code reads or reassigns any of the session's `variables`
+def uses_variables(code, variables):
+    return bool(named_in(code, [variable["name"] for variable in variables]))
+
+
+def named_in(code, names):
+    return {name for name in names if re.search(rf"\b{re.escape(name)}\b", code)}
+
+
+# Name, type, shape and columns of a variable, as listed in prompts
+def summarize(name, value):
+    summary = {"name": name, "type": type(value).__name__, "rows": len(value)}
+    if isinstance(value, pd.DataFrame):
+        summary["columns"] = [str(column) for column in value.columns]
+    else:
+        summary["dtype"] = str(value.dtype)
+    return summary
+
+
+# Variables spilled to `folder`, as {name: summary}
+def spilled_variables(folder):
+    spilled = {}
+    for path in glob.glob(os.path.join(folder, "*.json")):
+        if os.path.basename(path) == SESSION_FILE:
+            continue
+        with open(path) as handle:
+            summary = json.load(handle)
+        spilled[summary["name"]] = summary
+    return spilled
+
+
+# The worker process: runs code in one namespace until told to stop
+def kernel_main(connection, folder, memory_limit):
+    namespace, sizes, used = {}, {}, {}
+    spilled = spilled_variables(folder)
+    tables = {}
+    clock = 0
+
+    def variables():
+        return {name: value for name, value in namespace.items() if isinstance(value, (pd.DataFrame, pd.Series)) and not name.startswith("_") and name != "df"}
+
+    def spill(name):
+        value = namespace.pop(name)
+        summary = summarize(name, value)
+        pd.to_pickle(value, os.path.join(folder, f"{name}.pkl"))
+        with open(os.path.join(folder, f"{name}.json"), "w") as handle:
+            json.dump(summary, handle)
+        spilled[name] = summary
+        sizes.pop(name, None)
+
+    def discard(name):
+        for extension in ("pkl", "json"):
+            os.remove(os.path.join(folder, f"{name}.{extension}"))
+        del spilled[name]
+
+    def unspill(name):
+        namespace[name] = pd.read_pickle(os.path.join(folder, f"{name}.pkl"))
+        discard(name)
+
+    def state():
+        kept = variables()
+        for name, value in kept.items():
+            if sizes.get(name, (None,))[0] != id(value):
+                sizes[name] = (id(value), int(value.memory_usage(deep=True).sum() if isinstance(value, pd.DataFrame) else value.memory_usage(deep=True)))
+        return {
+            "variables": [summarize(name, value) for name, value in kept.items()] + list(spilled.values()),
+            "memory": sum(sizes[name][1] for name in kept),
+        }
+
+    while True:
+        command, *args = connection.recv()
+        if command == "run":
+            code, table_path, schema, columns = args
+            clock += 1
+            for name in list(spilled):
+                if re.search(rf"\b{re.escape(name)}\b", code):
+                    unspill(name)
+            df = None
+            if table_path is not None:
+                if table_path not in tables:
+                    tables = {table_path: open_table(table_path)}
+                df = restore_frame(tables[table_path].read(columns, mmap=False), schema)
+            before = {name: id(value) for name, value in variables().items()}
+            value, failed = run_panda_dataframe_code(code, df, copy=False, namespace=namespace)
+            namespace.pop("df", None)
+            for name, kept in variables().items():
+                if name in spilled:
+                    # Reassigned while spilled: the new value wins
+                    discard(name)
+                if before.get(name) != id(kept) or re.search(rf"\b{re.escape(name)}\b", code):
+                    used[name] = clock
+            current = state()
+            while current["memory"] > memory_limit and variables():
+                spill(min(variables(), key=lambda name: used.get(name, 0)))
+                current = state()
+            connection.send((render_analysis_result(value), failed, current))
+        elif command == "records":
+            name, limit = args
+            if name in spilled:
+                unspill(name)
+            value = namespace.get(name)
+            if isinstance(value, pd.Series):
+                value = value.reset_index()
+            records = json.loads(value.head(limit).to_json(orient="records", date_format="iso")) if isinstance(value, pd.DataFrame) else None
+            connection.send(records)
+        elif command == "spill":
+            for name in list(variables()):
+                spill(name)
+            connection.send(state())
+        elif command == "reset":
+            namespace.clear()
+            sizes.clear()
+            used.clear()
+            for name in list(spilled):
+                discard(name)
+            connection.send(state())
+        elif command == "stop":
+            connection.send(None)
+            return
+
+
+class Kernel:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.folder = session_dir(session_id)
+        os.makedirs(self.folder, exist_ok=True)
+        self.connection, child = _context.Pipe()
+        self.process = _context.Process(target=kernel_main, args=(child, self.folder, KERNEL_MEMORY_BYTES), daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        self.memory = 0
+        self.variables = list(spilled_variables(self.folder).values())
+        self.dataset_key = None
+        session_file = os.path.join(self.folder, SESSION_FILE)
+        if os.path.exists(session_file):
+            with open(session_file) as handle:
+                self.dataset_key = json.load(handle)["dataset"]
+
+    def call(self, *command):
+        with self.lock:
+            self.last_used = time.monotonic()
+            self.connection.send(command)
+            return self.connection.recv()
+
+    def update(self, state):
+        self.variables, self.memory = state["variables"], state["memory"]
+        metrics.observe("kernels.memory_bytes", self.memory)
+
+    # Drop the namespace when the session's dataset (or its version) changed
+    def use_dataset(self, dataset):
+        key = dataset_key(dataset)
+        if key == self.dataset_key:
+            return
+        if self.variables:
+            logging.info(f"Session {self.session_id} moved to another dataset; clearing its kernel.")
+            self.update(self.call("reset"))
+        self.dataset_key = key
+        with open(os.path.join(self.folder, SESSION_FILE), "w") as handle:
+            json.dump({"dataset": key}, handle)
+
+    def run(self, code, dataset, columns):
+        self.use_dataset(dataset)
+        table = (dataset.table.path, dataset.schema, dataset.projection(columns) if columns is not None else None) if dataset is not None else (None, None, None)
+        result, failed, state = self.call("run", code, *table)
+        self.update(state)
+        return result, failed
+
+    def stop(self, spill=True):
+        try:
+            if spill:
+                self.update(self.call("spill"))
+            self.call("stop")
+        except (EOFError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+# Start the idle reaper if it is not running; call with _lock held
+def start_reaper():
+    global _reaper
+    if _reaper is None:
+        _reaper = threading.Thread(target=reap_idle, daemon=True)
+        _reaper.start()
+
+
+# The session's kernel, starting one (and the idle reaper) if needed
+def get_kernel(session_id):
+    evicted = []
+    with _lock:
+        kernel = _kernels.get(session_id)
+        if kernel is not None and not kernel.process.is_alive():
+            logging.warning(f"Kernel of session {session_id} exited; starting a new one.")
+            kernel = None
+        if kernel is None:
+            kernel = _kernels[session_id] = Kernel(session_id)
+            metrics.increment("kernels.started")
+            while len(_kernels) > KERNEL_MAX_SESSIONS:
+                oldest = min((other for other in _kernels.values() if other is not kernel), key=lambda other: other.last_used)
+                evicted.append(_kernels.pop(oldest.session_id))
+        kernel.last_used = time.monotonic()
+        start_reaper()
+    for other in evicted:
+        metrics.increment("kernels.evicted")
+        other.stop()
+    return kernel
+
+
+def reap_idle():
+    while True:
+        time.sleep(max(1, KERNEL_IDLE_SECONDS // 4))
+        now = time.monotonic()
+        with _lock:
+            idle = [kernel for kernel in _kernels.values() if now - kernel.last_used > KERNEL_IDLE_SECONDS and not kernel.lock.locked()]
+            for kernel in idle:
+                del _kernels[kernel.session_id]
+            for session_id in [session_id for session_id, deferred in _deferred.items() if now - deferred["last_used"] > KERNEL_IDLE_SECONDS]:
+                del _deferred[session_id]
+                metrics.increment("kernels.deferred_evicted")
+        for kernel in idle:
+            logging.info(f"Kernel of session {kernel.session_id} idle for {KERNEL_IDLE_SECONDS}s; spilling and stopping it.")
+            metrics.increment("kernels.evicted")
+            kernel.stop()
+
+
+# Record code that ran outside the session's kernel and the summaries of the
+# DataFrames and Series it assigned (`variables`), to be replayed in the
+# kernel when a later run names one of them
+def defer_run(session_id, code, dataset, columns, variables):
+    if not variables:
+        return
+    key = dataset_key(dataset)
+    names = {variable["name"] for variable in variables}
+    with _lock:
+        deferred = _deferred.get(session_id)
+        if deferred is None or deferred["dataset"] != key:
+            deferred = _deferred[session_id] = {"dataset": key, "runs": [], "variables": {}}
+        for run in deferred["runs"]:
+            run["names"] -= names
+        deferred["runs"] = [run for run in deferred["runs"] if run["names"]]
+        deferred["runs"].append({"code": code, "columns": columns, "names": names})
+        deferred["variables"].update((variable["name"], variable) for variable in variables)
+        deferred["last_used"] = time.monotonic()
+        while len(deferred["runs"]) > KERNEL_MAX_DEFERRED_RUNS:
+            for name in deferred["runs"].pop(0)["names"]:
+                del deferred["variables"][name]
+        while len(_deferred) > KERNEL_MAX_SESSIONS:
+            del _deferred[min(_deferred, key=lambda other: _deferred[other]["last_used"])]
+            metrics.increment("kernels.deferred_evicted")
+        start_reaper()
+    metrics.increment("kernels.deferred_runs")
+
+
+# Replay in the session's kernel the deferred runs that assigned any of
+# `names` (oldest first); their variables then live in the kernel
+def replay_deferred(session_id, kernel, dataset, names):
+    with _lock:
+        deferred = _deferred.get(session_id)
+        if deferred is None or deferred["dataset"] != dataset_key(dataset):
+            return
+        replayed = [run for run in deferred["runs"] if run["names"] & names]
+        deferred["runs"] = [run for run in deferred["runs"] if not run["names"] & names]
+        for run in replayed:
+            for name in run["names"]:
+                del deferred["variables"][name]
+        deferred["last_used"] = time.monotonic()
+    for run in replayed:
+        _, failed = kernel.run(run["code"], dataset, run["columns"])
+        metrics.increment("kernels.replayed_runs")
+        if failed:
+            logging.warning(f"Replaying earlier code in the kernel of session {session_id} failed.")
+
+
+# Names of the session's deferred variables that `code` names
+def deferred_names(session_id, code):
+    with _lock:
+        deferred = _deferred.get(session_id)
+        return named_in(code, list(deferred["variables"])) if deferred is not None else set()
+
+
+# Run analysis code in the session's kernel, after any deferred runs whose
+# variables it may name; returns (rendered result, failed)
+def run_in_kernel(session_id, code, dataset=None, columns=None):
+    kernel = get_kernel(session_id)
+    try:
+        # A cancelled request kills the worker: its variables since the last spill are lost
+        with cancellable(stop=kernel.process.kill):
+            replay_deferred(session_id, kernel, dataset, deferred_names(session_id, code))
+            return kernel.run(code, dataset, columns)
+    except (EOFError, OSError) as e:
+        # The code took the worker down with it; the next run starts a new one
+        logging.error(f"Kernel of session {session_id} failed: {e!r}")
+        with _lock:
+            if _kernels.get(session_id) is kernel:
+                del _kernels[session_id]
+        kernel.process.kill()
+        return repr(e), True
+
+
+# Variables a session's earlier turns left, in its kernel or deferred,
+# without starting a kernel
+def session_variables(session_id, dataset=None):
+    with _lock:
+        kernel = _kernels.get(session_id)
+        deferred = _deferred.get(session_id)
+        deferred = dict(deferred["variables"]) if deferred is not None and deferred["dataset"] == dataset_key(dataset) else {}
+    folder = session_dir(session_id)
+    if kernel is not None:
+        key, variables = kernel.dataset_key, kernel.variables
+    elif os.path.exists(os.path.join(folder, SESSION_FILE)):
+        with open(os.path.join(folder, SESSION_FILE)) as handle:
+            key = json.load(handle)["dataset"]
+        variables = list(spilled_variables(folder).values())
+    else:
+        key, variables = None, []
+    # Variables computed from another dataset are cleared on the next run
+    if key != dataset_key(dataset):
+        variables = []
+    return [variable for variable in variables if variable["name"] not in deferred] + list(deferred.values())
+
+
+# Rows of a session DataFrame (or Series) for a chart; None if there is no such variable
+def variable_records(session_id, name, dataset=None):
+    if not any(variable["name"] == name for variable in session_variables(session_id, dataset)):
+        return None
+    try:
+        kernel = get_kernel(session_id)
+        replay_deferred(session_id, kernel, dataset, {name})
+        return kernel.call("records", name, KERNEL_CHART_ROWS)
+    except (EOFError, OSError):
+        return None
+
+
+# Stop a session's kernel at once, even in the middle of a run (a cancelled
+# job's code); its spilled variables are kept unless `discard`
+def stop_kernel(session_id, discard=False):
+    with _lock:
+        kernel = _kernels.pop(session_id, None)
+        if discard:
+            _deferred.pop(session_id, None)
+    if kernel is not None:
+        kernel.process.kill()
+        kernel.process.join(timeout=5)
+    if discard:
+        shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+
+def shutdown_kernels():
+    with _lock:
+        kernels = list(_kernels.values())
+        _kernels.clear()
+        _deferred.clear()
+    for kernel in kernels:
+        kernel.stop(spill=False)
+    shutil.rmtree(KERNEL_DIR, ignore_errors=True)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+import openai
+import metrics
+from cancellation import cancelled
+from deadlines import token_limit
+
+
+# Tracks a streamed completion and reports the moment the first top-level JSON
+# object is closed, so the rest of the stream (closing fences, chatter, padding
+# up to max_tokens) never has to be read.
+class JsonObjectTracker:
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+    # Returns the index just past the closing brace within `text`, or None if the
+    # object is still open after consuming it.
+    def feed(self, text):
+        for index, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                continue
+            if char == '"' and self.started:
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+                self.started = True
+            elif char == "}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return index + 1
+        return None
+
+
+# Rough token count (~4 characters per token); streamed replies carry no usage block
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+# Run a chat completion as a stream and return the assistant text. With
+# stop_at_json the stream is closed as soon as the JSON object in the reply is
+# complete instead of waiting for the model to finish. If a `usage` dict is
+# passed, estimated prompt/completion tokens are added to it while the stream
+# is read, so callers can account for calls they cancel midway, and gets the
+# stream's "finish_reason" ("length" when max_tokens cut the reply short).
+# Under a request deadline max_tokens is cut to what fits in the time left.
+async def complete(model, messages, max_tokens, temperature=0.3, stop_at_json=True, usage=None):
+    if usage is not None:
+        usage["prompt_tokens"] = usage.get("prompt_tokens", 0) + sum(estimate_tokens(message["content"]) for message in messages)
+        usage.setdefault("completion_tokens", 0)
+        usage["finish_reason"] = None
+    tracker = JsonObjectTracker()
+    parts = []
+    generated = 0
+    max_tokens = token_limit(max_tokens)
+    started_at = time.monotonic()
+    try:
+        response = await openai.ChatCompletion.acreate(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True,
+        )
+        try:
+            async for chunk in response:
+                if chunk["choices"][0].get("finish_reason") and usage is not None:
+                    usage["finish_reason"] = chunk["choices"][0]["finish_reason"]
+                delta = chunk["choices"][0]["delta"].get("content")
+                if not delta:
+                    continue
+                generated += estimate_tokens(delta)
+                if usage is not None:
+                    usage["completion_tokens"] += estimate_tokens(delta)
+                end = tracker.feed(delta) if stop_at_json else None
+                if end is not None:
+                    parts.append(delta[:end])
+                    logging.info(f"Closed {model} stream early after the JSON object completed.")
+                    break
+                parts.append(delta)
+        finally:
+            await response.aclose()
+    except asyncio.CancelledError:
+        # The client went away: the rest of the reply is never generated
+        if cancelled():
+            metrics.increment("cancellation.llm_calls")
+            metrics.increment("cancellation.tokens_saved", max(0, round(metrics.mean("cancellation.completion_tokens", generated)) - generated))
+        raise
+    metrics.observe("cancellation.completion_tokens", generated)
+    # Short replies are mostly latency to the first token, not output rate
+    if generated >= 50:
+        metrics.observe("deadline.tokens_per_second", generated / max(time.monotonic() - started_at, 1e-3))
+    return "".join(parts)
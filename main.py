@@ -1,16 +1,44 @@
+import asyncio
+import contextvars
+import html
 import json
 import openai
 import os
 import logging
 import sys
-import re
-from io import StringIO
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
-from starlette.responses import FileResponse
+from starlette.responses import FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
+import pandas as pd
 from dotenv import load_dotenv
+from llm import estimate_tokens
+from admission import Overloaded, admission_report, admit, admit_job, answer_key, cached_answer, release, remember_answer
+from approximate import APPROXIMATE_ANSWERS, sample_for
+from cancellation import DISCONNECT_POLL_SECONDS, ClientDisconnected, enter_child_scope, enter_scope
+from chart_templates import match_chart_template
+from code_runner import render_analysis_result, run_panda_dataframe_code, sanitize_input
+from cube import cube_for
+from dashboard import dashboard_layout, is_dashboard_request, panel_output, panel_plans, plan_dashboard, sample_panel_output
+from column_refs import code_columns, spec_fields
+from conversations import conversation_context, conversation_history, last_chart, record_turn
+from datasets import get_dataset, register_dataset, valid_dataset_id
+from deadlines import DeadlineExceeded, current_deadline, start_deadline
+from decompose import DECOMPOSE_MAX_TASKS, QUERY_DECOMPOSITION, TaskGraphError, is_compound, validate_tasks
+from jobs import cancel_job, get_job, job_status, set_job_scope, start_jobs, submit_job
+from model_policy import is_advanced_analysis, model_report, record_execution, strongest_model, tiered_complete
+from kernels import defer_run, run_in_kernel, session_variables, shutdown_kernels, stop_kernel, summarize, uses_variables, valid_session, variable_records
+from ingest import append_chunk, create_upload, get_upload, ingest_upload, start_ingest
+from nl_compiler import compile_query, compiled_columns, compiled_steps, describe_compiled, run_compiled, run_compiled_chunks, run_compiled_cube
+from out_of_core import exceeds_memory
+from query_plan import PlanError, execute_plan, execute_plan_approximate
+from relevance import RelevanceIndex
+from result_cache import make_key as make_cache_key, normalize_variables, restore_variables, result_cache
+from vectorize import vectorize_code
+import metrics
+from speculation import SPECULATIVE_GENERATION, guess_request_type, start_speculation, speculation_report
+from spec_patch import PatchError, patch_spec, prompt_spec
 
 # Load environment variables from .env file
 load_dotenv()
@@ -35,83 +63,170 @@ app.add_middleware(
 # Load OpenAI API key from environment variable
 openai.api_key = os.environ.get("OPENAI_API_KEY")
 
+# Sample rows kept in prompts once the question is matched to specific columns
+FOCUSED_SAMPLE_ROWS = 5
+
+# How analyses run on a registered dataset: "code" executes generated Python,
+# "plan" asks for a restricted JSON query plan run by the built-in executor
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "code")
+
+# Charts on a registered dataset up to this size plot every row instead of the sample
+CHART_DATA_MAX_ROWS = int(os.environ.get("CHART_DATA_MAX_ROWS", "5000"))
+# Charts the cube can pre-aggregate: top-level spec keys, Vega-Lite aggregates
+# and time units, mapped onto the cube's
+CUBE_CHART_KEYS = {"$schema", "data", "mark", "encoding", "title", "description", "width", "height", "config"}
+CHART_AGGREGATES = {"count": "size", "sum": "sum", "mean": "mean", "average": "mean", "min": "min", "max": "max", "stdev": "std", "variance": "var"}
+CHART_TIME_UNITS = {"year": "yearstart", "yearmonth": "yearmonth"}
+
 # Define request and response models
 class QueryRequest(BaseModel):
     query: str
     columns: list
     dataTypes: dict
     FullData: list
+    speculative: bool = None  # Start generation alongside routing; defaults to SPECULATIVE_GENERATION
+    dataset_id: str = None  # Registered full dataset from POST /datasets
+    analysis_mode: str = None  # "code" or "plan"; defaults to ANALYSIS_MODE
+    approximate: bool = None  # Stream a sample estimate before the exact result; defaults to APPROXIMATE_ANSWERS
+    session_id: str = None  # Chat session whose kernel keeps variables across questions
+    deadline_seconds: float = None  # Time the answer must arrive in; defaults to REQUEST_DEADLINE_SECONDS
+
+class DatasetRequest(BaseModel):
+    rows: list
+    dataset_id: str = None
+
+class UploadRequest(BaseModel):
+    filename: str
+    size: int
+    dataset_id: str = None
 
 class QueryResponse(BaseModel):
     vega_spec: dict = None
     analysis_result: str = None
 
-# Sanitize input for Python REPL execution
-def sanitize_input(query: str) -> str:
-    query = re.sub(r"^(\s|`)*(?i:python)?\s*", "", query)
-    query = re.sub(r"(\s|`)*$", "", query)
-    return query
+def execute_panda_dataframe_code(code, df=None):
+    value, _ = run_panda_dataframe_code(code, df)
+    return render_analysis_result(value)
 
-# Execute the Python code for data analysis
-import pandas as pd
-from io import StringIO
-import sys
-import logging
+# Execute analysis code through the result cache: the same (normalised) code on
+# the same dataset contents returns the earlier result without re-running it.
+# In a session, code that names a variable of earlier turns runs in the
+# session's kernel instead, uncached; other code stays on the cached path and
+# the variables it assigns (kept with the cached result, for hits) are
+# deferred to the kernel for later turns.
+def execute_analysis(code, dataset=None, session_id=None):
+    columns = code_columns(sanitize_input(code), dataset.columns) if dataset is not None else None
+    if session_id is not None and uses_variables(sanitize_input(code), session_variables(session_id, dataset)):
+        result, failed = run_in_kernel(session_id, code, dataset, columns)
+        metrics.increment("kernels.runs")
+        return result, failed
+    key = make_cache_key(dataset, sanitize_input(code))
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            logging.info("Analysis result served from the result cache.")
+            variables = result_cache.variables(key)
+            if session_id is not None and variables:
+                defer_run(session_id, code, dataset, columns, restore_variables(sanitize_input(code), variables))
+            return render_analysis_result(cached), False
+    namespace = {}
+    if dataset is not None:
+        # Load only the columns the code reads; dynamic references load them all
+        frame = dataset.load(columns)
+        value, failed = run_panda_dataframe_code(code, frame, copy=False, namespace=namespace)
+    else:
+        value, failed = run_panda_dataframe_code(code, namespace=namespace)
+    if failed:
+        return render_analysis_result(value), failed
+    variables = [summarize(name, kept) for name, kept in namespace.items() if isinstance(kept, (pd.DataFrame, pd.Series)) and not name.startswith("_") and name != "df"]
+    if key is not None:
+        result_cache.put(key, dataset.dataset_id if dataset else None, value, normalize_variables(sanitize_input(code), variables))
+    if session_id is not None:
+        defer_run(session_id, code, dataset, columns, variables)
+    return render_analysis_result(value), failed
 
-def execute_panda_dataframe_code(code):
-    logging.info(f"Generated Python Code:\n{code}")  # Log the generated Python code
+# Point a chart at the registered dataset's rows, loading only the fields the
+# spec encodes. Specs that plot values the model computed itself (fields that
+# are not dataset columns) keep their inline data; specs naming a session
+# variable as their data get its rows from the session's kernel.
+def bind_chart_data(vega_spec, dataset, session_id=None):
+    data = vega_spec.get("data")
+    if session_id is not None and isinstance(data, dict) and isinstance(data.get("name"), str) and "values" not in data:
+        records = variable_records(session_id, data["name"], dataset)
+        if records is not None:
+            metrics.increment("kernels.chart_bindings")
+            return dict(vega_spec, data={"values": records})
+    if dataset is None or not isinstance(vega_spec.get("data"), dict) or "values" not in vega_spec["data"]:
+        return vega_spec
+    data_cube = cube_for(dataset)
+    bound = cube_chart_data(vega_spec, data_cube) if data_cube is not None else None
+    if bound is not None:
+        metrics.increment("cube.chart_hits")
+        return bound
+    if dataset.num_rows > CHART_DATA_MAX_ROWS:
+        return vega_spec
+    found = spec_fields(vega_spec)
+    if found is None:
+        fields = None
+    else:
+        referenced, created = found
+        if referenced - created - set(dataset.columns):
+            return vega_spec
+        fields = referenced - created
+    frame = dataset.load(fields)
+    return dict(vega_spec, data={"values": json.loads(frame.to_json(orient="records", date_format="iso"))})
 
-    old_stdout = sys.stdout
-    sys.stdout = mystdout = StringIO()
-    last_dataframe = None  # To store the last detected DataFrame
-    last_series = None  # To store the last detected Series
+# A single-view chart whose channels are cube dimensions (optionally by year or
+# month) and aggregates of its measures, bound to the aggregated values from
+# the cube: each aggregated channel plots a precomputed field instead. None
+# for any other spec.
+def cube_chart_data(vega_spec, data_cube):
+    encoding = vega_spec.get("encoding")
+    if not isinstance(encoding, dict) or set(vega_spec) - CUBE_CHART_KEYS:
+        return None
+    by, aggregations, rewritten = {}, {}, {}
+    for channel, definition in encoding.items():
+        if not isinstance(definition, dict):
+            return None
+        aggregate = definition.get("aggregate")
+        if aggregate is not None:
+            function = CHART_AGGREGATES.get(aggregate)
+            column = None if aggregate == "count" else definition.get("field")
+            if function is None or (column is None and aggregate != "count"):
+                return None
+            name = "count" if column is None else f"{aggregate}_{column}"
+            aggregations[name] = (name, column, function)
+            title = "Count of Records" if column is None else f"{aggregate.capitalize()} of {column}"
+            rewritten[channel] = dict({key: value for key, value in definition.items() if key != "aggregate"}, field=name, title=definition.get("title", title))
+        elif isinstance(definition.get("field"), str) and not definition.get("bin") and definition.get("timeUnit") in (None, *CHART_TIME_UNITS):
+            unit = definition.get("timeUnit")
+            by[definition["field"]] = (definition["field"], definition["field"], CHART_TIME_UNITS[unit] if unit else None)
+        else:
+            return None
+    if not aggregations or set(by) & set(aggregations):
+        return None
+    result = data_cube.query(list(by.values()), list(aggregations.values()))
+    if result is None:
+        return None
+    values = json.loads(result.to_json(orient="records", date_format="iso"))
+    return dict(vega_spec, data={"values": values}, encoding=dict(encoding, **rewritten))
 
-    # Variables to ignore, e.g., 'df' is for raw data and should not be returned
-    ignore_vars = ['df']
+# Run a JSON query plan on the registered dataset; raises PlanError if it is invalid
+def execute_analysis_plan(plan, dataset):
+    return render_analysis_result(execute_plan(plan, dataset, get_dataset))
 
-    # Check if the last line of the code contains a single quote
-    code_lines = code.strip().splitlines()
-    last_line = code_lines[-1] if code_lines else ""
-    contains_text_output = "'" in last_line
-
-    try:
-        # Define a local dictionary with 'pd' to provide context for exec
-        local_vars = {'pd': pd}
-        cleaned_command = sanitize_input(code)
-        
-        # Execute code within this local namespace
-        exec(cleaned_command, {}, local_vars)
-        sys.stdout = old_stdout
-
-        # Check if there was printed output (e.g., from print("hello"))
-        printed_output = mystdout.getvalue().strip()
-        
-        # If the last line contains text (a single quote), return only the printed text
-        if contains_text_output and printed_output:
-            return printed_output
-
-        # If no explicit text output, check for DataFrames and Series
-        for var_name, var_value in local_vars.items():
-            if var_name in ignore_vars:
-                continue  # Skip variables we want to ignore
-            if isinstance(var_value, pd.DataFrame):
-                last_dataframe = var_value  # Update to the latest non-ignored DataFrame found
-            elif isinstance(var_value, pd.Series):
-                last_series = var_value  # Update to the latest non-ignored Series found
-
-        # If a non-ignored DataFrame was found, return it as HTML
-        if last_dataframe is not None:
-            return last_dataframe.to_html(index=False)
-
-        # If no DataFrame but a Series was found, return it as HTML
-        if last_series is not None:
-            return last_series.to_frame().to_html(header=True, index=True)
-
-        # If neither is found, return any standard text output
-        return printed_output
-    except Exception as e:
-        sys.stdout = old_stdout
-        return repr(e)
+# While `exact` runs, stream the plan's estimate from the dataset's sample
+# (preceded by `description` if given); returns the estimate sent, or None
+async def emit_estimate(emit, plan, dataset, sample, exact, description=None):
+    estimate = await asyncio.to_thread(execute_plan_approximate, plan, dataset, sample)
+    if estimate is None or exact.done():
+        return None
+    metrics.increment("approximate.estimates")
+    if description is not None:
+        await emit_event(emit, "description", {"stage": "analysis", "description": description})
+    estimate = render_analysis_result(estimate)
+    await emit_event(emit, "result", {"analysis_result": estimate, "approximate": True, "sample_rows": sample.rows})
+    return estimate
 
 
 
@@ -196,101 +311,540 @@ def print_red(*strings):
 def print_blue(*strings):
     print("\033[94m" + " ".join(strings) + "\033[0m")
 
-def chart_generation(user_query, columns, dataTypes, sampleData):
-    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "chart")
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
+# Forward a pipeline event to the caller if one is listening (the streaming endpoint)
+async def emit_event(emit, event, data):
+    if emit is not None:
+        await emit(event, data)
+
+# Await `work` for no longer than `stage` may take of the request's deadline
+# (all of what is left if it is the `last` stage), raising DeadlineExceeded
+# when it runs out. `interruptible` work runs under its own cancel scope, so
+# code it hands to threads or kernels is stopped rather than left running.
+async def within_budget(stage, work, last=False, interruptible=False):
+    deadline = current_deadline()
+    if deadline is None:
+        return await work
+    scope = None
+    if interruptible:
+        context = contextvars.copy_context()
+        scope = context.run(enter_child_scope)
+        work = asyncio.get_running_loop().create_task(work, context=context)
+    try:
+        return await asyncio.wait_for(work, timeout=deadline.stage_budget(stage, last))
+    except asyncio.TimeoutError:
+        if scope is not None:
+            scope.cancel(request=False)
+        metrics.increment(f"deadline.{stage}_timeouts")
+        logging.warning(f"The {stage} stage ran out of its time budget.")
+        raise DeadlineExceeded(stage)
+
+# Best-effort answer without the model, `reason` saying why: the locally
+# planned dashboard panel closest to the question, computed from the sample rows
+def degraded_answer(request_type, columns, dataTypes, sampleData, relevance, reason):
+    metrics.increment("deadline.degraded")
+    panels = plan_dashboard(columns, dataTypes, sampleData, focus=relevance.columns if relevance is not None else ())
+    if request_type == "chart":
+        panels = [panel for panel in panels if panel["kind"] == "chart"]
+    if not panels:
+        return {"type": "none", "description": f"No answer could be prepared, since {reason}. Please try again later."}
+    output = sample_panel_output(panels[0], sampleData)
+    description = f"{output['title']}: a quick overview from the sample rows, since {reason}."
+    if "vega_spec" in output:
+        return {"type": "chart", "vega_spec": output["vega_spec"], "description": description, "degraded": True}
+    return {"type": "analysis", "analysis_result": output["analysis_result"], "description": description, "degraded": True}
+
+# Ask the model for a chart spec; returns (vega_spec, description, is_relevant).
+# With the session's `previous` chart, refinements of it are asked for as a
+# patch first, and the whole spec only if there is no patch that applies.
+async def generate_chart(user_query, columns, dataTypes, sampleData, usage=None, relevance=None, variables=None, history=(), previous=None):
+    if previous is not None:
+        refined = await refine_chart(user_query, columns, dataTypes, sampleData, previous, usage, relevance, history)
+        if refined is not None:
+            return refined
+    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "chart", relevance=relevance, variables=variables)
+    # The spec inlines the sample rows, so its size follows theirs
+    assistant_message, _ = await tiered_complete(
+        "chart",
+        [
             {"role": "system", "content": "You are a data visualization assistant. Generate a Vega-Lite specification if the user's request requires chart generation."},
+            *history,
             {"role": "user", "content": prompt},
         ],
-        max_tokens=3000,
-        temperature=0.3,
+        lambda reply: valid_reply(reply, "chart"),
+        echoed=estimate_tokens(str(prompt_rows(sampleData, relevance))),
+        usage=usage,
     )
-    assistant_message = response['choices'][0]['message']['content']
-    vega_spec, description, is_relevant = parse_assistant_response(assistant_message, "chart")
+    return parse_assistant_response(assistant_message, "chart")
+
+# Ask for a JSON Patch against the `previous` spec and apply it locally;
+# returns (vega_spec, description, True), or None when the request is not a
+# refinement or the patch does not apply
+async def refine_chart(user_query, columns, dataTypes, sampleData, previous, usage=None, relevance=None, history=()):
+    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "patch", relevance=relevance, previous_spec=prompt_spec(previous))
+    assistant_message, _ = await tiered_complete(
+        "patch",
+        [
+            {"role": "system", "content": "You are a data visualization assistant. Edit the user's existing Vega-Lite chart with a JSON Patch."},
+            *history,
+            {"role": "user", "content": prompt},
+        ],
+        lambda reply: valid_reply(reply, "patch"),
+        usage=usage,
+    )
+    try:
+        patch, description, is_refinement = parse_assistant_response(assistant_message, "patch")
+        if not is_refinement:
+            metrics.increment("spec_patch.declined")
+            return None
+        vega_spec = patch_spec(previous, patch, columns)
+    except (PatchError, ValueError, HTTPException) as e:
+        logging.warning(f"Chart patch failed, regenerating the chart: {e}")
+        metrics.increment("spec_patch.failed")
+        return None
+    metrics.increment("spec_patch.applied")
+    metrics.increment("spec_patch.operations", len(patch))
+    return vega_spec, description, True
+
+# `pending` is an already running generate_chart task (speculative generation)
+async def chart_generation(user_query, columns, dataTypes, sampleData, emit=None, pending=None, relevance=None, dataset=None, session_id=None, variables=None, history=(), previous=None):
+    # Binding the data is quick, so generation may use all the time left
+    if pending is not None:
+        vega_spec, description, is_relevant = await within_budget("generation", pending, last=True)
+    else:
+        vega_spec, description, is_relevant = await within_budget("generation", generate_chart(user_query, columns, dataTypes, sampleData, relevance=relevance, variables=variables, history=history, previous=previous), last=True)
     if not is_relevant:
         return None, "Your question does not seem to be related to the dataset. Please ask a question relevant to the data."
+    vega_spec = await asyncio.to_thread(bind_chart_data, vega_spec, dataset, session_id)
+    await emit_event(emit, "description", {"stage": "chart", "description": description})
+    await emit_event(emit, "spec", {"vega_spec": vega_spec})
     return vega_spec, description
 
-# Data analysis function
-def data_analysis(user_query, columns, dataTypes, sampleData):
-    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "analysis")
-    response = openai.ChatCompletion.create(
-        model="gpt-4-turbo",
-        messages=[
+# Ask the model for analysis code, or a query plan in "plan" mode; returns
+# (code_snippet or plan, description, is_relevant). Simple questions start on
+# the cheapest model tier; `strongest` asks the strongest one straight away.
+async def generate_analysis(user_query, columns, dataTypes, sampleData, usage=None, dataset=None, relevance=None, mode="code", variables=None, history=(), strongest=False):
+    query_type = "plan" if mode == "plan" else "analysis"
+    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, query_type, dataset=dataset, relevance=relevance, variables=variables)
+    assistant_message, _ = await tiered_complete(
+        query_type,
+        [
             {"role": "system", "content": "You are a data analysis assistant. Generate Python code if the user's request requires data analysis."},
+            *history,
             {"role": "user", "content": prompt},
         ],
-        max_tokens=3000,
-        temperature=0.3,
+        lambda reply: valid_reply(reply, query_type),
+        strongest=strongest or is_advanced_analysis(user_query),
+        usage=usage,
     )
-    assistant_message = response['choices'][0]['message']['content']
     logging.info(f"Assistant Response (Python Code and Description): {assistant_message}")  # Log the raw response from assistant
+    return parse_assistant_response(assistant_message, query_type)
+
+# Plan a dashboard from the column profiles and compute its panels side by
+# side, streaming each panel as soon as it is ready. `focus` columns (those the
+# question names) are charted first.
+async def dashboard_generation(user_query, columns, dataTypes, sampleData, emit=None, dataset=None, focus=()):
+    panels = plan_dashboard(columns, dataTypes, sampleData, dataset, focus)
+    if not panels:
+        return {"type": "none", "description": "The dataset has no columns a dashboard could chart."}
+    titles = [panel["title"] for panel in panels]
+    description = f"A dashboard of {len(panels)} panels: {', '.join(titles)}."
+    await emit_event(emit, "description", {"stage": "dashboard", "description": description})
+    outputs = [None] * len(panels)
+
+    async def finish(index, computing):
+        try:
+            frame = await computing
+        except PlanError as e:
+            logging.warning(f"Dashboard panel '{titles[index]}' failed: {e}")
+            metrics.increment("dashboard.failed_panels")
+            return
+        outputs[index] = panel_output(panels[index], frame)
+        await emit_event(emit, "panel", dict(outputs[index], index=index))
+
+    if dataset is not None:
+        # Panels sharing a grouping are computed by one plan, each plan once
+        plans, assigned = panel_plans(panels)
+        metrics.increment("dashboard.shared_panels", len(panels) - len(plans))
+        running = [asyncio.create_task(asyncio.to_thread(execute_plan, plan, dataset, get_dataset)) for plan in plans]
+        await asyncio.gather(*(finish(index, running[plan]) for index, plan in assigned.items()))
+    else:
+        for index, panel in enumerate(panels):
+            outputs[index] = sample_panel_output(panel, sampleData)
+            await emit_event(emit, "panel", dict(outputs[index], index=index))
+    outputs = [output for output in outputs if output is not None]
+    metrics.increment("dashboard.panels", len(outputs))
+    tables = "".join(f"<h4>{html.escape(output['title'])}</h4>{output['analysis_result']}" for output in outputs if "analysis_result" in output)
+    return {
+        "type": "dashboard",
+        "vega_spec": dashboard_layout(outputs, "Dataset overview"),
+        "analysis_result": tables or None,
+        "panels": outputs,
+        "description": description,
+    }
+
+# Run a decomposed task's code with the results of the tasks it depends on
+# defined under their ids; returns the unrendered (value, failed). Tasks that
+# read only the dataset go through the result cache.
+def run_task_code(code, dataset, inputs):
+    key = make_cache_key(dataset, sanitize_input(code)) if not inputs else None
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached, False
+    frame = dataset.load(code_columns(sanitize_input(code), dataset.columns)) if dataset is not None else None
+    # Copies, since tasks reading the same result may run at the same time
+    value, failed = run_panda_dataframe_code(code, frame, copy=False, namespace={name: frame.copy() for name, frame in inputs.items()})
+    if key is not None and not failed:
+        result_cache.put(key, dataset.dataset_id if dataset else None, value)
+    return value, failed
+
+# Split a compound question into a DAG of analysis and chart tasks and run
+# it: every task starts once the tasks it reads from have finished, so
+# independent tasks are generated and run side by side. Returns the
+# assembled answer, or None to answer the question whole (a single task, an
+# invalid graph, or no task succeeding).
+async def decomposed_request(user_query, columns, dataTypes, sampleData, emit=None, dataset=None, relevance=None, history=()):
+    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "decompose", relevance=relevance)
+    content, _ = await tiered_complete(
+        "decompose",
+        [
+            {"role": "system", "content": "You are a data analysis planner. Split the user's request into smaller analysis and chart tasks."},
+            *history,
+            {"role": "user", "content": prompt},
+        ],
+        lambda reply: valid_reply(reply, "decompose"),
+    )
+    try:
+        tasks, description, _ = parse_assistant_response(content, "decompose")
+        ordered = validate_tasks(tasks)
+    except (ValueError, HTTPException) as e:
+        logging.warning(f"Rejected task graph, answering the question whole: {e}")
+        metrics.increment("decompose.rejected")
+        return None
+    if len(ordered) < 2:
+        metrics.increment("decompose.single_task")
+        return None
+    metrics.increment("decompose.graphs")
+    metrics.increment("decompose.tasks", len(ordered))
+    await emit_event(emit, "route", {"type": "tasks", "description": description})
+    await emit_event(emit, "tasks", {"tasks": ordered})
+    frames, outputs, running = {}, {}, {}
 
-    code_snippet, description, is_relevant = parse_assistant_response(assistant_message, "analysis")
+    async def run_task(task):
+        finished = [await running[dependency] for dependency in task["depends_on"]]
+        output = {"id": task["id"], "title": task["request"]}
+        try:
+            if not all(finished) or any(frames.get(dependency) is None for dependency in task["depends_on"]):
+                raise TaskGraphError("A task it depends on produced no table.")
+            inputs = {dependency: frames[dependency] for dependency in task["depends_on"]}
+            variables = [summarize(name, frame) for name, frame in inputs.items()]
+            if task["type"] == "chart":
+                vega_spec, _, is_relevant = await generate_chart(task["request"], columns, dataTypes, sampleData, relevance=relevance, variables=variables)
+                if not is_relevant:
+                    raise TaskGraphError("No chart was generated.")
+                data = vega_spec.get("data")
+                name = data.get("name") if isinstance(data, dict) else None
+                if name in inputs:
+                    vega_spec = dict(vega_spec, data={"values": json.loads(inputs[name].to_json(orient="records", date_format="iso"))})
+                else:
+                    vega_spec = await asyncio.to_thread(bind_chart_data, vega_spec, dataset)
+                output["vega_spec"] = vega_spec
+            else:
+                usage = {}
+                code_snippet, _, is_relevant = await generate_analysis(task["request"], columns, dataTypes, sampleData, usage, dataset, relevance, variables=variables)
+                if not is_relevant:
+                    raise TaskGraphError("No analysis code was generated.")
+                value, failed = await asyncio.to_thread(run_task_code, code_snippet, dataset, inputs)
+                record_execution("analysis", usage["model"], failed)
+                if failed and usage["model"] != strongest_model():
+                    # Code a cheaper model wrote that does not run is written again by the strongest
+                    metrics.increment("models.analysis.execution_escalations")
+                    usage = {}
+                    code_snippet, _, is_relevant = await generate_analysis(task["request"], columns, dataTypes, sampleData, usage, dataset, relevance, variables=variables, strongest=True)
+                    if not is_relevant:
+                        raise TaskGraphError("No analysis code was generated.")
+                    value, failed = await asyncio.to_thread(run_task_code, code_snippet, dataset, inputs)
+                    record_execution("analysis", usage["model"], failed)
+                if failed:
+                    raise TaskGraphError(value)
+                if isinstance(value, pd.Series):
+                    value = value.reset_index()
+                frames[task["id"]] = value if isinstance(value, pd.DataFrame) else None
+                output["analysis_result"] = render_analysis_result(value)
+        except Exception as e:
+            logging.warning(f"Task {task['id']} failed: {e}")
+            metrics.increment("decompose.failed_tasks")
+            outputs[task["id"]] = dict(output, error=str(e))
+            await emit_event(emit, "task", outputs[task["id"]])
+            return False
+        outputs[task["id"]] = output
+        await emit_event(emit, "task", output)
+        return True
+
+    for task in ordered:
+        running[task["id"]] = asyncio.create_task(run_task(task))
+    await asyncio.gather(*running.values())
+    charts = [outputs[task["id"]] for task in tasks if "vega_spec" in outputs[task["id"]]]
+    tables = [outputs[task["id"]] for task in tasks if "analysis_result" in outputs[task["id"]]]
+    if not charts and not tables:
+        return None
+    result = {"type": "both" if charts and tables else "chart" if charts else "analysis", "description": description, "tasks": [outputs[task["id"]] for task in tasks]}
+    if charts:
+        result["vega_spec"] = charts[0]["vega_spec"] if len(charts) == 1 else dashboard_layout(charts, description)
+    if tables:
+        result["analysis_result"] = "".join(f"<h4>{html.escape(output['title'])}</h4>{output['analysis_result']}" for output in tables)
+    return result
+
+# Data analysis function; `pending` is an already running generate_analysis task
+# With a dataset `sample`, plans first stream an estimate while the exact result is computed
+# With a `session_id`, code runs in the session's kernel next to the `variables` earlier turns left
+# `history` is the session's conversation context, as chat messages placed before the prompt
+# `strongest` regenerates the code on the strongest model after cheaper code failed to run.
+# `rejected` is the error of an earlier plan for the same question.
+async def data_analysis(user_query, columns, dataTypes, sampleData, emit=None, pending=None, dataset=None, relevance=None, mode="code", sample=None, session_id=None, variables=None, history=(), strongest=False, rejected=None):
+    usage = {}
+    if pending is not None:
+        code_snippet, description, is_relevant = await within_budget("generation", pending)
+    else:
+        code_snippet, description, is_relevant = await within_budget("generation", generate_analysis(user_query, columns, dataTypes, sampleData, usage, dataset, relevance, mode, variables, history, strongest))
+    if mode == "plan" and is_relevant:
+        await emit_event(emit, "plan", {"plan": code_snippet})
+        exact = asyncio.create_task(within_budget("execution", asyncio.to_thread(execute_analysis_plan, code_snippet, dataset), last=True, interruptible=True))
+        described = await emit_estimate(emit, code_snippet, dataset, sample, exact, description) if sample is not None else None
+        try:
+            result = await exact
+        except DeadlineExceeded:
+            if described is None:
+                raise
+            # The sample estimate already sent is the best answer there is time for
+            metrics.increment("deadline.estimates_kept")
+            return described, f"{description} (estimated from a sample; the exact result ran out of time)"
+        except PlanError as e:
+            logging.warning(f"Rejected query plan: {e}")
+            metrics.increment("query_plan.rejected")
+            # Generated code would load a dataset too large for memory: the
+            # model gets one chance to correct its plan, then the request fails
+            if exceeds_memory(dataset):
+                if rejected is not None:
+                    message = f"The dataset is too large to analyse with generated code, and no valid query plan could be made for this question: {e}"
+                    await emit_event(emit, "result", {"analysis_result": message})
+                    return message, description
+                correction = [
+                    {"role": "assistant", "content": json.dumps(code_snippet, default=str)},
+                    {"role": "user", "content": f"That query plan was rejected: {e}. Reply with a corrected plan for the request below."},
+                ]
+                return await data_analysis(user_query, columns, dataTypes, sampleData, emit, None, dataset, relevance, mode, sample, session_id, variables, (*history, *correction), strongest=True, rejected=e)
+            # An invalid plan falls back to generated code rather than failing the request
+            return await data_analysis(user_query, columns, dataTypes, sampleData, emit, None, dataset, relevance, session_id=session_id, variables=variables, history=history)
+        metrics.increment("query_plan.executed")
+        if not described:
+            await emit_event(emit, "description", {"stage": "analysis", "description": description})
+        await emit_event(emit, "result", {"analysis_result": result})
+        return result, description
     if not is_relevant:
         return None, "Your question does not seem to require data analysis. Please ask a question relevant to data analysis."
-    result = execute_panda_dataframe_code(code_snippet)
+    await emit_event(emit, "description", {"stage": "analysis", "description": description})
+    # Rewrite slow row-at-a-time idioms into vectorised pandas before running
+    code_snippet, rewrites, warnings = vectorize_code(code_snippet)
+    if rewrites or warnings:
+        metrics.increment("vectorize.rewrites", len(rewrites))
+        metrics.increment("vectorize.warnings", len(warnings))
+        await emit_event(emit, "rewrite", {"rewrites": rewrites, "warnings": warnings})
+    await emit_event(emit, "code", {"code": code_snippet})
+    result, failed = await within_budget("execution", asyncio.to_thread(execute_analysis, code_snippet, dataset, session_id), last=True, interruptible=True)
+    if "model" in usage:
+        record_execution("analysis", usage["model"], failed)
+    # Speculated code does not say which model wrote it, so it may be retried on the strongest too
+    if failed and not strongest and usage.get("model") != strongest_model():
+        logging.warning(f"Generated code failed to run, regenerating it on {strongest_model()}: {result}")
+        metrics.increment("models.analysis.execution_escalations")
+        return await data_analysis(user_query, columns, dataTypes, sampleData, emit, None, dataset, relevance, mode, sample, session_id, variables, history, strongest=True)
+    await emit_event(emit, "result", {"analysis_result": result})
     return result, description
 
 # Unified request handling function with ReAct loop
-def handle_request(user_query, columns, dataTypes, sampleData, max_iterations=3):
+# `degraded` requests (admitted while the server is overloaded) get only answers that need no model call,
+# starting with an earlier full answer to the same question on the same data
+async def handle_request(user_query, columns, dataTypes, sampleData, max_iterations=3, emit=None, speculative=False, dataset=None, analysis_mode="code", approximate=False, session_id=None, degraded=False):
+    key = answer_key(dataset, sampleData, user_query)
+    if degraded:
+        cached = cached_answer(key)
+        if cached is not None:
+            metrics.increment("admission.cached_answers")
+            await emit_event(emit, "route", {"type": cached["type"], "description": "Answered from an earlier answer to the same question."})
+            await emit_event(emit, "description", {"stage": cached["type"], "description": cached["description"]})
+            if cached.get("vega_spec"):
+                await emit_event(emit, "spec", {"vega_spec": cached["vega_spec"]})
+            if cached.get("analysis_result"):
+                await emit_event(emit, "result", {"analysis_result": cached["analysis_result"]})
+            return cached
+    result = await answer_request(user_query, columns, dataTypes, sampleData, max_iterations, emit, speculative, dataset, analysis_mode, approximate, session_id, degraded)
+    # Only full answers to standalone questions hold for whoever asks next
+    if not degraded and not result.get("degraded") and result["type"] != "none" and not await asyncio.to_thread(conversation_context, session_id):
+        remember_answer(key, result)
+    return result
+
+async def answer_request(user_query, columns, dataTypes, sampleData, max_iterations=3, emit=None, speculative=False, dataset=None, analysis_mode="code", approximate=False, session_id=None, degraded=False):
+    # The session's last chart, which chart requests may refine with a patch
+    previous = await asyncio.to_thread(last_chart, session_id)
+
+    # Zero-LLM fast path: common one-line chart requests fill a template locally.
+    # With a chart on screen the request may be an edit of it, which only the refine path can tell.
+    template = match_chart_template(user_query, columns, dataTypes, sampleData) if previous is None else None
+    if template is not None:
+        vega_spec, description = template
+        vega_spec = await asyncio.to_thread(bind_chart_data, vega_spec, dataset, session_id)
+        metrics.increment("chart_templates.hits")
+        await emit_event(emit, "route", {"type": "chart", "description": "Matched a chart template."})
+        await emit_event(emit, "description", {"stage": "chart", "description": description})
+        await emit_event(emit, "spec", {"vega_spec": vega_spec})
+        return {"type": "chart", "vega_spec": vega_spec, "description": description}
+
+    # Datasets too large to load are only ever streamed over
+    out_of_core = dataset is not None and exceeds_memory(dataset)
+    # Estimates need somewhere to go before the exact result: the event stream
+    sample = sample_for(dataset) if approximate and emit is not None else None
+
+    # Zero-LLM fast path: simple aggregations compile straight to pandas on the
+    # registered dataset. Compiling needs only the schema and the indexed
+    # distinct values, never the table itself.
+    compiled = None
+    if dataset is not None and not (degraded and out_of_core):
+        compiled = compile_query(user_query, dataset.empty_frame(), dataset.distinct_values)
+    if compiled is not None:
+        def run_exact():
+            data_cube = cube_for(dataset)
+            answered = run_compiled_cube(compiled, data_cube) if data_cube is not None else None
+            if answered is not None:
+                metrics.increment("cube.hits")
+                return answered
+            if out_of_core:
+                return run_compiled_chunks(compiled, dataset)
+            return run_compiled(compiled, dataset.load(compiled_columns(compiled)))
+        exact = asyncio.create_task(asyncio.to_thread(run_exact))
+        description = describe_compiled(compiled)
+        metrics.increment("nl_compiler.hits")
+        await emit_event(emit, "route", {"type": "analysis", "description": "Compiled to a pandas query."})
+        await emit_event(emit, "description", {"stage": "analysis", "description": description})
+        steps = compiled_steps(compiled) if sample is not None else None
+        if steps is not None:
+            await emit_estimate(emit, {"steps": steps}, dataset, sample, exact)
+        result = await exact
+        analysis_result = result.to_html(index=False) if isinstance(result, pd.DataFrame) else result
+        await emit_event(emit, "result", {"analysis_result": analysis_result})
+        return {"type": "analysis", "analysis_result": analysis_result, "description": description}
+
+    # Variables earlier questions of this session left in its kernel; None outside a session
+    variables = await asyncio.to_thread(session_variables, session_id, dataset) if session_id is not None and not degraded else None
+    # Earlier turns of the session: a rolling summary and the latest turns verbatim
+    history = await asyncio.to_thread(conversation_context, session_id)
+
+    index = dataset.index if dataset is not None else RelevanceIndex.from_sample(columns, sampleData)
+    relevance = index.match(user_query)
+
+    # Zero-LLM fast path: overview requests become a dashboard planned from the column profiles
+    if is_dashboard_request(user_query):
+        metrics.increment("dashboard.keyword_hits")
+        await emit_event(emit, "route", {"type": "dashboard", "description": "Planned a dashboard from the column profiles."})
+        # Overloaded servers chart the sample rows rather than scan the dataset
+        return await dashboard_generation(user_query, columns, dataTypes, sampleData, emit, None if degraded else dataset, relevance.columns)
+
+    # Local relevance filter: clearly off-topic questions never reach the model.
+    # Follow-ups ("plot it") may name no column, only an earlier result.
+    if relevance.irrelevant and not variables and not history:
+        metrics.increment("relevance.rejected")
+        await emit_event(emit, "route", {"type": "none", "description": "No dataset column or value matched the question."})
+        return {"type": "none", "description": "Your question does not relate to the dataset."}
+
+    # Overloaded: a heuristic answer from the sample rows instead of model calls
+    if degraded:
+        request_type, _ = guess_request_type(user_query)
+        await emit_event(emit, "route", {"type": request_type or "analysis", "description": "The server is busy; answering without the model."})
+        return degraded_answer(request_type, columns, dataTypes, sampleData, relevance, "the server is busy")
+
+    # Query plans run against the registered dataset, so they need one
+    if dataset is None:
+        analysis_mode = "code"
+    # Generated code needs its columns in memory; plans can stream instead
+    if out_of_core and analysis_mode != "plan":
+        logging.info(f"Dataset {dataset.dataset_id} exceeds the in-memory limit; using a query plan.")
+        analysis_mode = "plan"
+    # Only plans can be estimated from the sample
+    if sample is not None and analysis_mode != "plan":
+        logging.info("Approximate answers requested; using a query plan.")
+        analysis_mode = "plan"
+
+    # Compound questions run as a graph of smaller tasks when the planner splits them.
+    # Tasks run outside the session's kernel, so follow-ups on its variables do not.
+    if QUERY_DECOMPOSITION and analysis_mode == "code" and not variables and is_compound(user_query):
+        decomposed = await decomposed_request(user_query, columns, dataTypes, sampleData, emit, dataset, relevance, history)
+        if decomposed is not None:
+            return decomposed
+
     tool_descriptions = {
         "data_analysis": data_analysis_function_tool,
         "chart_generation": chart_generation_function_description
     }
     
     # Prepare prompt
-    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "determine", tool_descriptions)
+    prompt = construct_prompt(user_query, columns, dataTypes, sampleData, "determine", tool_descriptions, relevance=relevance, variables=variables)
     messages = [
         {"role": "system", "content": "You are a data assistant. Determine if the user's request requires data analysis, graph generation, both, or neither."},
+        *history,
         {"role": "user", "content": prompt},
     ]
 
+    # Optionally start the likely generation call alongside the routing call
+    speculation = None
+    if speculative:
+        speculation = start_speculation(user_query, prompt, {
+            "chart": lambda usage: generate_chart(user_query, columns, dataTypes, sampleData, usage, relevance, variables, history, previous),
+            "analysis": lambda usage: generate_analysis(user_query, columns, dataTypes, sampleData, usage, dataset, relevance, analysis_mode, variables, history),
+        })
+    try:
+        return await route_and_generate(user_query, columns, dataTypes, sampleData, messages, max_iterations, emit, speculation, dataset, relevance, analysis_mode, sample, session_id, variables, history, previous)
+    finally:
+        if speculation is not None and not speculation.resolved:
+            await speculation.reject()
+
+async def route_and_generate(user_query, columns, dataTypes, sampleData, messages, max_iterations, emit, speculation, dataset, relevance, analysis_mode, sample=None, session_id=None, variables=None, history=(), previous=None):
     for iteration in range(max_iterations):
         print(f"Iteration: {iteration + 1}")
 
         # Call OpenAI API for type determination
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=messages,
-            max_tokens=2000,
-            temperature=0.3,
-        )
-        
-        assistant_message = response['choices'][0]['message']
+        try:
+            content, _ = await within_budget("routing", tiered_complete("routing", messages, lambda reply: valid_reply(reply, "determine")))
+        except DeadlineExceeded:
+            # Out of time to ask: route on the keywords speculation guesses from
+            guessed, _ = guess_request_type(user_query)
+            content = json.dumps({"type": guessed or "analysis", "description": "Routed by keywords; the routing call ran out of time."})
+            metrics.increment("deadline.keyword_routes")
 
         # Check if the response includes a valid content message
-        if assistant_message.get("content"):
-            result = parse_assistant_response(assistant_message["content"], "determine")
+        if content:
+            result = parse_assistant_response(content, "determine")
             request_type = result["type"]
+            await emit_event(emit, "route", {"type": request_type, "description": result.get("description")})
+
+            # Keep a speculative call only if routing needs its output
+            pending = {}
+            if speculation is not None and not speculation.resolved:
+                if request_type in (speculation.request_type, "both"):
+                    pending[speculation.request_type] = speculation.accept()
+                else:
+                    await speculation.reject()
+
+            if request_type in ["chart", "analysis", "both", "dashboard"]:
+                try:
+                    answer = await generate_answer(user_query, columns, dataTypes, sampleData, request_type, emit, pending, dataset, relevance, analysis_mode, sample, session_id, variables, history, previous)
+                except DeadlineExceeded as e:
+                    await emit_event(emit, "deadline", {"stage": e.stage})
+                    return degraded_answer(request_type, columns, dataTypes, sampleData, relevance, f"the {e.stage} stage ran out of time")
+                if answer is not None:
+                    return answer
 
-            if request_type in ["chart", "analysis", "both"]:
-                # Based on determined request type, handle specific tasks
-                if request_type == "chart":
-                    vega_spec, description = chart_generation(user_query, columns, dataTypes, sampleData)
-                    if vega_spec:
-                        return {"type": "chart", "vega_spec": vega_spec, "description": description}
-                
-                elif request_type == "analysis":
-                    analysis_result, description = data_analysis(user_query, columns, dataTypes, sampleData)
-                    if analysis_result:
-                        return {"type": "analysis", "analysis_result": analysis_result, "description": description}
-
-                elif request_type == "both":
-                    vega_spec, chart_desc = chart_generation(user_query, columns, dataTypes, sampleData)
-                    analysis_result, analysis_desc = data_analysis(user_query, columns, dataTypes, sampleData)
-                    if vega_spec and analysis_result:
-                        return {
-                            "type": "both",
-                            "vega_spec": vega_spec,
-                            "analysis_result": analysis_result,
-                            "description": f"{chart_desc} {analysis_desc}"
-                        }
-            
             # If no valid tool call was detected, append the assistant's response and continue the loop
-            messages.append(assistant_message)
+            messages.append({"role": "assistant", "content": content})
 
         # If the max iterations are reached without completion
         if iteration == max_iterations - 1:
@@ -299,35 +853,219 @@ def handle_request(user_query, columns, dataTypes, sampleData, max_iterations=3)
 
     return {"type": "none", "description": "Your question does not relate to the dataset."}
 
+# Generate and run the answer for a routed request; returns None when
+# generation found the request irrelevant, so routing can try again
+async def generate_answer(user_query, columns, dataTypes, sampleData, request_type, emit, pending, dataset, relevance, analysis_mode, sample=None, session_id=None, variables=None, history=(), previous=None):
+    if request_type == "dashboard":
+        return await dashboard_generation(user_query, columns, dataTypes, sampleData, emit, dataset, relevance.columns if relevance is not None else ())
+
+    elif request_type == "chart":
+        vega_spec, description = await chart_generation(user_query, columns, dataTypes, sampleData, emit, pending.get("chart"), relevance, dataset, session_id, variables, history, previous)
+        if vega_spec:
+            return {"type": "chart", "vega_spec": vega_spec, "description": description}
+
+    elif request_type == "analysis":
+        analysis_result, description = await data_analysis(user_query, columns, dataTypes, sampleData, emit, pending.get("analysis"), dataset, relevance, analysis_mode, sample, session_id, variables, history)
+        if analysis_result:
+            return {"type": "analysis", "analysis_result": analysis_result, "description": description}
+
+    elif request_type == "both":
+        # The two generations are independent, so run them side by side
+        chart, analysis = await asyncio.gather(
+            chart_generation(user_query, columns, dataTypes, sampleData, emit, pending.get("chart"), relevance, dataset, session_id, variables, history, previous),
+            data_analysis(user_query, columns, dataTypes, sampleData, emit, pending.get("analysis"), dataset, relevance, analysis_mode, sample, session_id, variables, history),
+            return_exceptions=True,
+        )
+        for part in (chart, analysis):
+            if isinstance(part, BaseException) and not isinstance(part, DeadlineExceeded):
+                raise part
+        if isinstance(chart, DeadlineExceeded) and isinstance(analysis, DeadlineExceeded):
+            raise chart
+        # Out of time for one half: answer with the half that finished
+        if isinstance(chart, DeadlineExceeded) or isinstance(analysis, DeadlineExceeded):
+            metrics.increment("deadline.partial")
+            if isinstance(analysis, DeadlineExceeded) and chart[0]:
+                return {"type": "chart", "vega_spec": chart[0], "description": f"{chart[1]} The analysis ran out of time.", "degraded": True}
+            if isinstance(chart, DeadlineExceeded) and analysis[0]:
+                return {"type": "analysis", "analysis_result": analysis[0], "description": f"{analysis[1]} The chart ran out of time.", "degraded": True}
+            return None
+        (vega_spec, chart_desc), (analysis_result, analysis_desc) = chart, analysis
+        if vega_spec and analysis_result:
+            return {
+                "type": "both",
+                "vega_spec": vega_spec,
+                "analysis_result": analysis_result,
+                "description": f"{chart_desc} {analysis_desc}"
+            }
+    return None
+
+# Speculative generation is opt-in per request, falling back to the server setting
+def use_speculation(request):
+    return SPECULATIVE_GENERATION if request.speculative is None else request.speculative
+
+def use_approximate(request):
+    return APPROXIMATE_ANSWERS if request.approximate is None else request.approximate
+
+def use_session(request):
+    if request.session_id is not None and not valid_session(request.session_id):
+        raise HTTPException(status_code=400, detail="session_id must be 1-64 letters, digits, '-' or '_'.")
+    return request.session_id
+
+def use_analysis_mode(request):
+    mode = request.analysis_mode or ANALYSIS_MODE
+    if mode not in ("code", "plan"):
+        raise HTTPException(status_code=400, detail="analysis_mode must be 'code' or 'plan'.")
+    return mode
+
+# Pass the admission controller's `check`, or answer 429 with Retry-After
+def use_admission(check=admit):
+    try:
+        return check()
+    except Overloaded as e:
+        logging.warning(str(e))
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+# Run a request's pipeline, checking every DISCONNECT_POLL_SECONDS whether
+# the client is still there; if it left, its model calls and executions are
+# cancelled and ClientDisconnected is raised
+async def run_until_disconnected(http_request, pipeline):
+    scope = enter_scope()
+    task = asyncio.create_task(pipeline)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+        if done:
+            scope.finish()
+            return task.result()
+        if await http_request.is_disconnected():
+            scope.cancel()
+            task.cancel()
+            raise ClientDisconnected()
+
 # Endpoint to interact with OpenAI API
 @app.post("https://graph-generation-ai-interface-4.onrender.com/query", response_model=QueryResponse)
-async def query_openai(request: QueryRequest):
+async def query_openai(request: QueryRequest, http_request: Request):
+    analysis_mode = use_analysis_mode(request)
+    session_id = use_session(request)
+    ticket = use_admission()
+    start_deadline(request.deadline_seconds)
     try:
-        result = handle_request(request.query, request.columns, request.dataTypes, request.FullData)
+        result = await run_until_disconnected(http_request, handle_request(request.query, request.columns, request.dataTypes, request.FullData, speculative=use_speculation(request), dataset=get_dataset(request.dataset_id), analysis_mode=analysis_mode, session_id=session_id, degraded=ticket["degraded"]))
+        record_turn(session_id, request.query, result)
         if result["type"] == "chart":
             return QueryResponse(vega_spec=result["vega_spec"], description=result["description"])
         elif result["type"] == "analysis":
             return QueryResponse(analysis_result=result["analysis_result"], description=result["description"])
-        elif result["type"] == "both":
+        elif result["type"] in ("both", "dashboard"):
             return QueryResponse(vega_spec=result["vega_spec"], analysis_result=result["analysis_result"], description=result["description"])
         else:
             return QueryResponse(description="Your question does not relate to the dataset.")
+    except ClientDisconnected:
+        # Nobody is left to read the response
+        return QueryResponse()
     except json.JSONDecodeError as e:
         logging.error(f"JSON decode error: {str(e)}")
         raise HTTPException(status_code=500, detail="Assistant's response was not in a valid JSON format.")
     except Exception as e:
         logging.error(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred.")
+    finally:
+        release(ticket)
+
+# Format one Server-Sent Events frame
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+# Streaming variant of /query: emits an SSE event as each stage completes
+# (route, description, spec, code, result) and finishes with "done" or "error"
+@app.post("/query/stream")
+async def query_openai_stream(request: QueryRequest):
+    analysis_mode = use_analysis_mode(request)
+    session_id = use_session(request)
+    ticket = use_admission()
+    queue = asyncio.Queue()
+    scope = enter_scope()
+    start_deadline(request.deadline_seconds)
+
+    async def emit(event, data):
+        await queue.put((event, data))
+
+    async def run():
+        try:
+            result = await handle_request(request.query, request.columns, request.dataTypes, request.FullData, emit=emit, speculative=use_speculation(request), dataset=get_dataset(request.dataset_id), analysis_mode=analysis_mode, approximate=use_approximate(request), session_id=session_id, degraded=ticket["degraded"])
+            record_turn(session_id, request.query, result)
+            scope.finish()
+            await queue.put(("done", result))
+        except HTTPException as e:
+            await queue.put(("error", {"detail": e.detail}))
+        except Exception as e:
+            logging.error(f"Unexpected error: {str(e)}")
+            await queue.put(("error", {"detail": "An unexpected error occurred."}))
+
+    task = asyncio.create_task(run())
+    # Released however the task ends, even if cancelled before it started
+    task.add_done_callback(lambda _: release(ticket))
+
+    async def event_stream():
+        try:
+            while True:
+                event, data = await queue.get()
+                yield format_sse(event, data)
+                if event in ("done", "error"):
+                    break
+        finally:
+            # The client disconnected before the end: stop the rest of the work
+            if not task.done():
+                scope.cancel()
+            task.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# The sample rows a prompt shows: a few rows of the matched columns once the
+# question is focused on them, else every sample row
+def prompt_rows(sampleData, relevance=None):
+    if relevance is None or not relevance.focused:
+        return sampleData
+    return [{col: row.get(col) for col in relevance.columns} for row in sampleData[:FOCUSED_SAMPLE_ROWS]]
+
+# One line per session variable: name, type and shape
+def describe_variables(variables):
+    lines = ""
+    for variable in variables:
+        if variable["type"] == "DataFrame":
+            lines += f"- {variable['name']}: DataFrame with {variable['rows']:,} rows and columns {variable['columns']}\n"
+        else:
+            lines += f"- {variable['name']}: Series of {variable['rows']:,} {variable['dtype']} values\n"
+    return lines
 
 # Construct prompt for OpenAI API
-def construct_prompt(user_query, columns, dataTypes, sampleData, query_type, tool_descriptions=None):
+# `relevance` is the local relevance match; when the question names specific
+# columns only those are described in full and the sample rows are cut down.
+# `variables` are the session's kept variables (None outside a session).
+# `previous_spec` is the chart a "patch" prompt refines.
+def construct_prompt(user_query, columns, dataTypes, sampleData, query_type, tool_descriptions=None, dataset=None, relevance=None, variables=None, previous_spec=None):
+    focused = relevance is not None and relevance.focused
+    prompt_columns = relevance.columns if focused else columns
     dataset_info = f"Dataset columns and types:\n"
-    for col in columns:
+    for col in prompt_columns:
         dataset_info += f"- {col}: {dataTypes[col]}\n"
+    if focused:
+        other_columns = [col for col in columns if col not in prompt_columns]
+        if other_columns:
+            dataset_info += f"Other columns: {', '.join(map(str, other_columns))}\n"
+        for col, values in relevance.values.items():
+            dataset_info += f"Values of {col} mentioned in the request: {values}\n"
     dataset_info += "Sample data:\n"
-    for row in sampleData:
+    for row in prompt_rows(sampleData, relevance):
         dataset_info += f"{row}\n"
 
+    session_info = ""
+    if variables:
+        session_info = f"Variables from earlier questions in this conversation, still defined in the Python session:\n{describe_variables(variables)}"
+
         # Include tool descriptions in the prompt if provided
     tool_desc = ""
     if tool_descriptions:
@@ -354,6 +1092,32 @@ def construct_prompt(user_query, columns, dataTypes, sampleData, query_type, too
             f"}}\n"
             f"Respond **only** in JSON format with 'vega_spec' for the chart specification and 'description' for an explanation.\n"
         )
+        if session_info:
+            prompt += f"{session_info}To plot one of these variables, set \"data\": {{\"name\": \"<variable>\"}} instead of inline values.\n"
+    elif query_type == "patch":
+        prompt = (
+            f"**You are a data visualization assistant. The user already has this Vega-Lite chart (only its first data rows are shown):\n"
+            f"{json.dumps(previous_spec, default=str)}\n"
+            f"The user provided this request: '{user_query}'.\n"
+            f"You have access to the following dataset information:\n{dataset_info}\n"
+            f"If the request changes this chart (colours, sorting, scales, titles, chart type, encodings), respond with an RFC 6902 JSON Patch against the spec above, "
+            f"using only the operations needed, and do not change \"/data\". Format the response as follows:\n"
+            f'{{"patch": [{{"op": "replace", "path": "/mark", "value": "line"}}, {{"op": "add", "path": "/encoding/y/scale", "value": {{"type": "log"}}}}], '
+            f'"description": "A brief description of the updated chart."}}\n'
+            f"If the request asks for a different chart instead, respond with {{\"patch\": null, \"description\": \"New chart\"}}.\n"
+            f"Respond **only** in JSON format.\n"
+        )
+    elif query_type == "decompose":
+        prompt = (
+            f"You are a data analysis planner. The user provided this request: '{user_query}'.\n"
+            f"Split it into the smallest set of tasks that answer it. Each task is "
+            f'{{"id": "t1", "type": "analysis" or "chart", "request": "a self-contained instruction", "depends_on": ["t0"]}}. '
+            f"An analysis task produces one table (a pandas DataFrame) that tasks listing its id in depends_on can use under that id; "
+            f"a chart task plots the dataset or such a table. Only add a dependency when a task needs that table, so the others can run in parallel. "
+            f"Use at most {DECOMPOSE_MAX_TASKS} tasks, and a single task if the request asks one thing.\n"
+            f"Respond strictly in JSON format with two keys: 'tasks' (the list of tasks) and 'description' (how the tasks answer the request).\n"
+            f"Dataset information:\n{dataset_info}\n"
+        )
     elif query_type == "analysis":
         prompt = (
             f"You are a data analysis assistant. Your task is to analyze the data based on the user's request: '{user_query}'. "
@@ -363,14 +1127,52 @@ def construct_prompt(user_query, columns, dataTypes, sampleData, query_type, too
             f"Ensure the response is complete and valid JSON with no syntax errors, as this code will be run by a specific program to generate text-based answers for the user. "
             f"Dataset information: {dataset_info}"
         )
+        if dataset is not None:
+            prompt += (
+                f"\nThe full dataset ({dataset.num_rows} rows) is already loaded as a pandas DataFrame named `df` "
+                f"with these column dtypes: {', '.join(f'{col}: {dtype}' for col, dtype in dataset.schema.items())}. "
+                f"Use `df` directly and do not recreate it from the sample rows."
+            )
+        if session_info:
+            prompt += f"\n{session_info}When the request refers to an earlier result, build on these variables instead of recomputing it from `df`."
+        if variables is not None:
+            prompt += "\nAssign intermediate results to descriptive variable names; they are kept for follow-up questions."
+    elif query_type == "plan":
+        prompt = (
+            f"You are a data analysis assistant. Your task is to answer the user's request: '{user_query}' with a query plan over the full dataset "
+            f"({dataset.num_rows} rows), not with Python code.\n"
+            f"A plan is a JSON object {{\"steps\": [...]}} whose steps run in order. Allowed steps:\n"
+            f'- {{"op": "select", "columns": [...]}}\n'
+            f'- {{"op": "filter", "column": "...", "operator": "==|!=|<|<=|>|>=|in|not in|contains|isnull|notnull", "value": ...}}\n'
+            f'- {{"op": "derive", "name": "...", "expression": E}} where E is {{"column": "..."}}, {{"value": ...}}, '
+            f'{{"op": "+|-|*|/", "left": E, "right": E}} or {{"function": "abs|round|year|month|day|lower|upper|length", "arg": E}}\n'
+            f'- {{"op": "groupby", "by": [...]}}, which must be followed by {{"op": "aggregate", "aggregations": '
+            f'[{{"column": "... or *", "function": "sum|mean|median|min|max|count|nunique|std|var|first|last", "as": "..."}}]}}\n'
+            f'- {{"op": "sort", "by": [...], "ascending": true|false}}\n'
+            f'- {{"op": "limit", "n": 10}}\n'
+            f'- {{"op": "join", "dataset_id": "...", "on": [...], "how": "inner|left|right|outer"}}\n'
+            f'- {{"op": "value_counts", "column": "..."}}, {{"op": "describe", "columns": [...]}} '
+            f'or {{"op": "histogram", "column": "...", "bins": 20}} to count values, summarise numeric columns or bin one\n'
+            f"Respond strictly in JSON format with two keys: 'plan' (the query plan) and 'description' (an explanation of the analysis in words).\n"
+            f"Dataset information: {dataset_info}"
+        )
     elif query_type == "determine":
+        # The local index has already matched the question to columns, so the
+        # model does not need to re-check relevance
+        if relevance is not None and relevance.columns:
+            relevance_check = f"The request refers to these dataset columns: {', '.join(map(str, relevance.columns))}.\n"
+        else:
+            relevance_check = "Check if the user's question is directly related to the dataset. A question is relevant if it includes keywords or terms that match the dataset columns, types, or content.\n"
         prompt = (
             f"You are a data assistant. The user provided this request: '{user_query}'.\n"
             f"{tool_desc}"
-            f"Based on the tool descriptions and the dataset information, determine if the user's request requires data analysis, chart generation, both, or neither.Check if the user's question is directly related to the dataset. A question is relevant if it includes keywords or terms that match the dataset columns, types, or content.\n"
+            f"Based on the tool descriptions and the dataset information, determine if the user's request requires data analysis, chart generation, both, or neither.{relevance_check}"
             f"Dataset information:\n{dataset_info}\n"
-            f"Respond in JSON format with 'type' (options: 'chart', 'analysis', 'both', 'none') and 'description' explaining the response.\n"
+            f"Use 'dashboard' when the user asks for an overview of the dataset or for several charts at once.\n"
+            f"Respond in JSON format with 'type' (options: 'chart', 'analysis', 'both', 'dashboard', 'none') and 'description' explaining the response.\n"
         )
+        if session_info:
+            prompt += f"{session_info}The request may refer to these earlier results (\"it\", \"that\") rather than to dataset columns.\n"
     elif query_type == "both":
         prompt = (
             f"The user provided this request: '{user_query}', which requires both data analysis and chart generation.\n"
@@ -408,6 +1210,18 @@ def parse_assistant_response(response_content, query_type):
                 logging.warning("Incomplete JSON response for chart generation.")
                 return None, "The assistant did not provide a valid chart specification.", False
 
+        elif query_type == "decompose":
+            tasks = response_json.get("tasks")
+            description = response_json.get("description") or "Answered in several steps."
+            return tasks, description, isinstance(tasks, list)
+
+        elif query_type == "patch":
+            patch = response_json.get("patch")
+            description = response_json.get("description") or "Updated the chart."
+            if isinstance(patch, list) and patch:
+                return patch, description, True
+            return None, description, False
+
         elif query_type == "analysis":
             code_snippet = response_json.get("code")
             description = response_json.get("description")
@@ -417,6 +1231,17 @@ def parse_assistant_response(response_content, query_type):
                 logging.warning("Incomplete JSON response for data analysis.")
                 return None, "The assistant did not provide valid Python code for analysis.", False
 
+        elif query_type == "plan":
+            plan = response_json.get("plan")
+            description = response_json.get("description")
+            if isinstance(plan, list):
+                plan = {"steps": plan}
+            if isinstance(plan, dict) and description:
+                return plan, description, True
+            else:
+                logging.warning("Incomplete JSON response for query plan.")
+                return None, "The assistant did not provide a valid query plan.", False
+
         elif query_type == "both":
             vega_spec = response_json.get("vega_spec")
             code_snippet = response_json.get("code")
@@ -428,7 +1253,7 @@ def parse_assistant_response(response_content, query_type):
                 return None, "The assistant did not provide complete information for both chart and analysis.", False
 
         elif query_type == "determine":
-            return {"type": response_json.get("type")}
+            return {"type": response_json.get("type"), "description": response_json.get("description")}
 
     except json.JSONDecodeError:
         # If JSON decoding fails, assume the response is plain text
@@ -444,6 +1269,158 @@ def parse_assistant_response(response_content, query_type):
         # Raise an HTTP error if parsing failed for another reason
         raise HTTPException(status_code=500, detail="The assistant's response was not in a valid JSON format.")
 
+# Whether a reply is usable as an answer of `query_type`, for deciding to
+# retry it on a stronger model. A patch reply declining to patch is usable.
+def valid_reply(reply, query_type):
+    try:
+        parsed = parse_assistant_response(reply, query_type)
+    except HTTPException:
+        return False
+    if query_type == "determine":
+        return isinstance(parsed, dict) and parsed.get("type") in ("chart", "analysis", "both", "dashboard", "none")
+    if query_type == "patch":
+        return True
+    return parsed[-1] is True
+
+# Client-chosen dataset ids become directory names, so only plain ones are accepted
+def use_dataset_id(dataset_id):
+    if dataset_id is not None and not valid_dataset_id(dataset_id):
+        raise HTTPException(status_code=400, detail="dataset_id must be 1-64 letters, digits, '-' or '_'.")
+    return dataset_id
+
+# Register the full uploaded dataset so analyses run on every row
+@app.post("/datasets")
+async def create_dataset(request: DatasetRequest):
+    if not request.rows:
+        raise HTTPException(status_code=400, detail="The dataset has no rows.")
+    use_dataset_id(request.dataset_id)
+    dataset = await asyncio.to_thread(register_dataset, request.rows, request.dataset_id)
+    return {"dataset_id": dataset.dataset_id, "version": dataset.version, "rows": dataset.num_rows, "columns": dataset.columns, "memory": dataset.memory, "out_of_core": exceeds_memory(dataset)}
+
+# Start a resumable chunked upload for files the browser does not parse itself:
+# large CSVs and TSV, JSON Lines, Excel, Parquet and Arrow/Feather files
+@app.post("/uploads")
+async def start_upload(request: UploadRequest):
+    if request.size < 0:
+        raise HTTPException(status_code=400, detail="The file size must not be negative.")
+    use_dataset_id(request.dataset_id)
+    try:
+        session = await asyncio.to_thread(create_upload, request.filename, request.size, request.dataset_id)
+    except ValueError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    return session.status()
+
+def find_upload(upload_id):
+    session = get_upload(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Unknown upload.")
+    return session
+
+# Append the raw bytes of one chunk at ?offset=. A wrong offset answers 409 with
+# the byte count the server has, which is where the client resumes from.
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    session = find_upload(upload_id)
+    data = await request.body()
+    try:
+        received = await asyncio.to_thread(append_chunk, session, offset, data)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "received": session.received})
+    return {"received": received}
+
+# Upload and parse progress; poll this after completing the upload
+@app.get("/uploads/{upload_id}")
+async def upload_status(upload_id: str):
+    return find_upload(upload_id).status()
+
+# All bytes are in: parse or store the table in the background
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    session = find_upload(upload_id)
+    try:
+        started = start_ingest(session)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail={"message": str(e), "received": session.received})
+    if started:
+        asyncio.get_running_loop().run_in_executor(None, ingest_upload, session)
+    return session.status()
+
+# Runtime counters and timings
+@app.get("/metrics")
+async def read_metrics():
+    return dict(metrics.snapshot(), speculation=speculation_report(), models=model_report(), admission=admission_report())
+
+# Answer a queued job's request inside a cancel scope kept with the job, so
+# cancelling it stops generated code in pool threads and in kernels (the
+# session's, or one of its own)
+async def run_job(job, emit):
+    set_job_scope(job["job_id"], enter_scope())
+    request = QueryRequest(**job["request"])
+    session_id = request.session_id or f"job-{job['job_id']}"
+    # Jobs exist for long analyses: only a deadline their client set applies
+    if request.deadline_seconds is not None:
+        start_deadline(request.deadline_seconds)
+    try:
+        result = await handle_request(request.query, request.columns, request.dataTypes, request.FullData, emit=emit, speculative=use_speculation(request), dataset=get_dataset(request.dataset_id), analysis_mode=use_analysis_mode(request), session_id=session_id)
+    finally:
+        if request.session_id is None:
+            await asyncio.to_thread(stop_kernel, session_id, True)
+    record_turn(request.session_id, request.query, result)
+    return result
+
+@app.on_event("startup")
+async def start_job_workers():
+    start_jobs(run_job, get_dataset)
+
+# Queue a query as a background job; poll /jobs/{job_id} for its status
+@app.post("/jobs", status_code=202)
+async def create_job(request: QueryRequest):
+    use_analysis_mode(request)
+    use_session(request)
+    use_admission(admit_job)
+    job = await submit_job(request.dict(exclude_none=True))
+    return job_status(job)
+
+def find_job(job_id):
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job.")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def read_job(job_id: str):
+    return job_status(find_job(job_id))
+
+# The finished job's answer; 409 while it is still queued or running
+@app.get("/jobs/{job_id}/result")
+async def read_job_result(job_id: str):
+    job = find_job(job_id)
+    if job["status"] == "succeeded":
+        return job["result"]
+    if job["status"] in ("failed", "cancelled"):
+        raise HTTPException(status_code=409, detail=f"The job {job['status']}: {job.get('error') or 'no result'}.")
+    raise HTTPException(status_code=409, detail=f"The job is {job['status']}.")
+
+# Cancel a job: generated code still running is stopped through its cancel
+# scope, and pending model calls are closed with its task
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job_request(job_id: str):
+    job = find_job(job_id)
+    cancel_job(job_id)
+    return job_status(job)
+
+# A session's logged conversation: its turns and the summary of the older ones
+@app.get("/sessions/{session_id}/history")
+async def read_history(session_id: str):
+    if not valid_session(session_id):
+        raise HTTPException(status_code=400, detail="session_id must be 1-64 letters, digits, '-' or '_'.")
+    return await asyncio.to_thread(conversation_history, session_id)
+
+# Stop the session kernels' worker processes with the server
+@app.on_event("shutdown")
+async def stop_kernels():
+    await asyncio.to_thread(shutdown_kernels)
+
 # Root endpoint
 @app.get("/")
 async def read_root():
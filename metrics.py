@@ -0,0 +1,43 @@
+import threading
+
+# Process-wide counters and timings, exposed as JSON on /metrics
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+# Record one observation (usually seconds) under `name`, keeping count/total/max
+def observe(name, value):
+    with _lock:
+        timing = _timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["total"] += value
+        timing["max"] = max(timing["max"], value)
+
+
+def get(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+
+# Average of an observed timing, or `default` when nothing has been recorded yet
+def mean(name, default=0.0):
+    with _lock:
+        timing = _timings.get(name)
+        if not timing or not timing["count"]:
+            return default
+        return timing["total"] / timing["count"]
+
+
+def snapshot():
+    with _lock:
+        timings = {
+            name: dict(timing, mean=timing["total"] / timing["count"] if timing["count"] else 0.0)
+            for name, timing in _timings.items()
+        }
+        return {"counters": dict(_counters), "timings": timings}
@@ -0,0 +1,174 @@
+import collections
+import logging
+import os
+import re
+import threading
+import time
+import metrics
+from llm import complete
+
+# Model and max_tokens per call, by pipeline stage. MODEL_TIERS lists the
+# models from cheapest to strongest. A call starts on the cheapest tier that
+# has been passing for its stage (or the strongest for analyses that look
+# advanced), with max_tokens sized to the replies the stage has produced and
+# the data the reply may echo. A reply cut off by that limit is a budget
+# miss, not the model's fault: it is retried on the same tier with the
+# stage's full max_tokens. A reply that fails validation, or analysis code
+# that fails to run, counts against its tier and is retried on the next one.
+#
+# Every call records its tier's latency, tokens and estimated cost;
+# model_report() summarizes them for /metrics.
+
+MODEL_TIERS = [model.strip() for model in os.environ.get("MODEL_TIERS", "gpt-3.5-turbo,gpt-4-turbo").split(",") if model.strip()]
+# USD per 1K prompt and completion tokens; unknown models count as the strongest listed
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.005, 0.015),
+    "gpt-4-turbo": (0.01, 0.03),
+}
+# Expected reply size before anything is measured, and the most a reply may use
+STAGE_OUTPUT = {
+    "routing": {"expected": 60, "ceiling": 2000},
+    "chart": {"expected": 250, "ceiling": 3000},
+    "patch": {"expected": 150, "ceiling": 600},
+    "analysis": {"expected": 400, "ceiling": 3000},
+    "plan": {"expected": 300, "ceiling": 3000},
+    "decompose": {"expected": 300, "ceiling": 1000},
+}
+# max_tokens is this multiple of the largest recent reply of the stage
+OUTPUT_HEADROOM = 1.5
+OUTPUT_HISTORY = 50
+# A tier whose pass rate for a stage falls below this, over at least
+# MODEL_MIN_SAMPLES calls, is skipped for that stage
+MODEL_MIN_PASS_RATE = float(os.environ.get("MODEL_MIN_PASS_RATE", "0.7"))
+MODEL_MIN_SAMPLES = 20
+# Analyses worded like these, or longer than ANALYSIS_SIMPLE_MAX_WORDS, start on the strongest tier
+ADVANCED_ANALYSIS = r"\b(regress\w*|correlat\w*|forecast\w*|predict\w*|cluster\w*|seasonal\w*|significan\w*|anomal\w*|outliers?|cohorts?|pivot\w*|percentiles?|rolling|moving average|statistical\w*)\b"
+ANALYSIS_SIMPLE_MAX_WORDS = 25
+
+_outputs = collections.defaultdict(lambda: collections.deque(maxlen=OUTPUT_HISTORY))  # stage -> completion tokens of recent passing replies
+_lock = threading.Lock()
+
+
+def strongest_model():
+    return MODEL_TIERS[-1]
+
+
+def is_advanced_analysis(user_query):
+    return len(user_query.split()) > ANALYSIS_SIMPLE_MAX_WORDS or re.search(ADVANCED_ANALYSIS, user_query.lower()) is not None
+
+
+# Share of the stage's replies from `model` that validated and, for code,
+# also ran
+def pass_rate(stage, model):
+    calls = metrics.get(f"models.{stage}.{model}.calls")
+    if calls < MODEL_MIN_SAMPLES:
+        return 1.0
+    return (metrics.get(f"models.{stage}.{model}.passed") - metrics.get(f"models.{stage}.{model}.failed_runs")) / calls
+
+
+# Index of the tier a call starts on
+def start_tier(stage, strongest=False):
+    if strongest:
+        return len(MODEL_TIERS) - 1
+    tier = 0
+    while tier < len(MODEL_TIERS) - 1 and pass_rate(stage, MODEL_TIERS[tier]) < MODEL_MIN_PASS_RATE:
+        tier += 1
+    return tier
+
+
+# max_tokens for a first attempt: room for the largest recent reply of the
+# stage, or its expected size plus the `echoed` tokens of data the reply may copy
+def output_budget(stage, echoed=0):
+    limits = STAGE_OUTPUT[stage]
+    with _lock:
+        largest = max(_outputs[stage], default=0)
+    return min(limits["ceiling"], int(max(limits["expected"] + echoed, largest) * OUTPUT_HEADROOM))
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = MODEL_PRICES.get(model, MODEL_PRICES.get(strongest_model(), (0.0, 0.0)))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+# Account for one call; `passed` is None for a budget miss, which is paid
+# for but says nothing about the model
+def record_call(stage, model, passed, seconds, prompt_tokens, completion_tokens):
+    if passed is None:
+        metrics.increment(f"models.{stage}.budget_misses")
+    else:
+        metrics.increment(f"models.{stage}.{model}.calls")
+        metrics.increment(f"models.{model}.calls")
+    if passed:
+        metrics.increment(f"models.{stage}.{model}.passed")
+        metrics.increment(f"models.{model}.passed")
+        with _lock:
+            _outputs[stage].append(completion_tokens)
+    metrics.observe(f"models.{model}.seconds", seconds)
+    metrics.increment(f"models.{model}.cost_usd", call_cost(model, prompt_tokens, completion_tokens))
+    metrics.increment(f"models.{model}.prompt_tokens", prompt_tokens)
+    metrics.increment(f"models.{model}.completion_tokens", completion_tokens)
+
+
+# Generated code from `model` for `stage` was run; code that fails counts
+# against the tier like a reply that does not validate
+def record_execution(stage, model, failed):
+    if failed:
+        metrics.increment(f"models.{stage}.{model}.failed_runs")
+        metrics.increment(f"models.{model}.failed_runs")
+
+
+# Complete `messages` for `stage`, moving up the tiers until `passes(reply)`;
+# returns the reply (the last one if none passed) and the model that wrote it.
+# If a `usage` dict is passed it accumulates the tokens of every attempt and
+# gets the final model under "model".
+async def tiered_complete(stage, messages, passes, strongest=False, echoed=0, usage=None, temperature=0.3, stop_at_json=True):
+    usage = usage if usage is not None else {}
+    tier = start_tier(stage, strongest)
+    ceiling = STAGE_OUTPUT[stage]["ceiling"]
+    max_tokens = output_budget(stage, echoed)
+    while True:
+        model = MODEL_TIERS[tier]
+        prompt_before, completion_before = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+        started_at = time.monotonic()
+        reply = await complete(model, messages, max_tokens, temperature, stop_at_json, usage)
+        passed = passes(reply)
+        cut_short = not passed and usage.get("finish_reason") == "length" and max_tokens < ceiling
+        record_call(stage, model, None if cut_short else passed, time.monotonic() - started_at, usage["prompt_tokens"] - prompt_before, usage["completion_tokens"] - completion_before)
+        usage["model"] = model
+        if passed:
+            return reply, model
+        if cut_short:
+            logging.info(f"{model} reply for {stage} hit max_tokens={max_tokens}; retrying with {ceiling}.")
+        elif tier + 1 < len(MODEL_TIERS):
+            tier += 1
+            metrics.increment(f"models.{stage}.escalations")
+            logging.warning(f"{model} reply for {stage} failed validation; retrying with {MODEL_TIERS[tier]}.")
+        else:
+            return reply, model
+        max_tokens = ceiling
+
+
+# Per-model calls, pass rate, mean latency and cost, and escalations and budget misses per stage
+def model_report():
+    report = {"models": {}, "escalations": {}}
+    for model in dict.fromkeys(MODEL_TIERS + list(MODEL_PRICES)):
+        calls = metrics.get(f"models.{model}.calls")
+        if not calls:
+            continue
+        report["models"][model] = {
+            "calls": calls,
+            "pass_rate": (metrics.get(f"models.{model}.passed") - metrics.get(f"models.{model}.failed_runs")) / calls,
+            "failed_runs": metrics.get(f"models.{model}.failed_runs"),
+            "latency_seconds_mean": metrics.mean(f"models.{model}.seconds"),
+            "cost_usd_total": metrics.get(f"models.{model}.cost_usd"),
+            "prompt_tokens": metrics.get(f"models.{model}.prompt_tokens"),
+            "completion_tokens": metrics.get(f"models.{model}.completion_tokens"),
+        }
+    report["budget_misses"] = {}
+    for stage in STAGE_OUTPUT:
+        report["escalations"][stage] = metrics.get(f"models.{stage}.escalations")
+        report["budget_misses"][stage] = metrics.get(f"models.{stage}.budget_misses")
+    report["escalations"]["analysis_execution"] = metrics.get("models.analysis.execution_escalations")
+    return report
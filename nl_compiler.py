@@ -0,0 +1,250 @@
+import re
+import pandas as pd
+import out_of_core
+from chart_templates import normalize_text
+
+# A small deterministic grammar for the simple analytical questions that do not
+# need a model: "average price by region", "top 10 customers by revenue",
+# "count of rows where status is open", "correlation between x and y". Each
+# question compiles to a plan dict that runs as vectorised pandas on the
+# registered dataset. The grammar only accepts whole-sentence matches, so
+# anything with extra qualifiers falls through to the LLM.
+
+AGGREGATES = {
+    "average": "mean", "avg": "mean", "mean": "mean",
+    "sum": "sum", "total": "sum",
+    "max": "max", "maximum": "max", "highest": "max",
+    "min": "min", "minimum": "min", "lowest": "min",
+    "median": "median",
+    "count": "count", "number": "count",
+}
+AGGREGATE_WORDS = {"mean": "average", "sum": "total", "max": "maximum", "min": "minimum", "median": "median", "count": "number of"}
+LEADING_PHRASES = r"^(?:(?:what is|what s|whats|what are|show me|show|give me|compute|calculate|find|list|get|tell me)\s+)?(?:the\s+)?"
+ROWS = r"(?:rows|records|entries|items)"
+GROUP_BY = r"(?:by|per|for each|for every|across|grouped by|in each)"
+NUMBER = re.compile(r"^-?(?:\d+\.?\d*|\.\d+)$")
+
+
+# normalize_text, except that numbers keep their sign and decimal point
+def normalize_query(text):
+    tokens = (token if NUMBER.match(token) else normalize_text(token) for token in str(text).lower().split())
+    return " ".join(token for token in tokens if token)
+
+
+def column_alternation(columns):
+    names = {}
+    for column in columns:
+        name = normalize_text(column)
+        if name:
+            names.setdefault(name, column)
+            names.setdefault(name + "s", column)
+            names.setdefault(name + "es", column)
+    ordered = sorted(names, key=len, reverse=True)
+    return "(?:" + "|".join(re.escape(name) for name in ordered) + ")", names
+
+
+def grammar(columns):
+    col, names = column_alternation(columns)
+    agg = "(?:" + "|".join(sorted(AGGREGATES, key=len, reverse=True)) + ")"
+    rules = [
+        ("count_where", rf"(?:(?:count|number) of {ROWS}|how many {ROWS}) (?:where|with|have|has) (?P<column>{col}) (?:is |equals |equal to |= |== )?(?P<value>.+)"),
+        ("count_rows", rf"(?:count|number) of {ROWS}(?: {GROUP_BY} (?:each )?(?P<group>{col}))?"),
+        ("top", rf"(?P<direction>top|bottom) (?P<n>\d+) (?P<group>{col}) by (?:(?P<agg>{agg}) )?(?P<measure>{col})"),
+        ("correlation", rf"correlation (?:between|of) (?P<a>{col}) and (?P<b>{col})"),
+        ("aggregate", rf"(?P<agg>{agg}) (?:of )?(?:the )?(?P<measure>{col})(?: {GROUP_BY} (?:each )?(?P<group>{col}))?"),
+    ]
+    return [(name, re.compile(LEADING_PHRASES + pattern + "$")) for name, pattern in rules], names
+
+
+def is_numeric(frame, column):
+    return pd.api.types.is_numeric_dtype(frame[column]) and not pd.api.types.is_bool_dtype(frame[column])
+
+
+# Map the literal from "where status is open" onto an actual value of the column.
+# `distinct_values(column)` replaces scanning the frame for datasets not loaded
+# in memory; it returns None when the column has too many values to list.
+def resolve_value(frame, column, literal, distinct_values=None):
+    literal = literal.strip().strip("'\"")
+    if is_numeric(frame, column):
+        try:
+            return float(literal)
+        except ValueError:
+            return None
+    values = distinct_values(column) if distinct_values is not None else frame[column].dropna().unique()
+    for value in values if values is not None else ():
+        if normalize_query(value) == literal:
+            return value
+    return None
+
+
+# Compile a question into a plan dict, or None if the grammar does not cover it
+def compile_query(user_query, frame, distinct_values=None):
+    query = normalize_query(re.sub(r"[?!.]+\s*$", "", user_query))
+    rules, names = grammar(frame.columns)
+    for name, pattern in rules:
+        match = pattern.match(query)
+        if not match:
+            continue
+        parts = {key: value for key, value in match.groupdict().items() if value is not None}
+        for key in ("column", "group", "measure", "a", "b"):
+            if key in parts:
+                parts[key] = names[parts[key]]
+        plan = build_plan(name, parts, frame, distinct_values)
+        if plan is not None:
+            return plan
+    return None
+
+
+def build_plan(name, parts, frame, distinct_values=None):
+    if name == "count_where":
+        value = resolve_value(frame, parts["column"], parts["value"], distinct_values)
+        if value is None:
+            return None
+        return {"op": "count_where", "column": parts["column"], "value": value}
+    if name == "count_rows":
+        return {"op": "aggregate", "agg": "count", "measure": None, "by": [parts["group"]] if "group" in parts else []}
+    if name == "correlation":
+        if parts["a"] == parts["b"] or not (is_numeric(frame, parts["a"]) and is_numeric(frame, parts["b"])):
+            return None
+        return {"op": "correlation", "columns": [parts["a"], parts["b"]]}
+    agg = AGGREGATES[parts.get("agg", "sum")]
+    measure = parts["measure"]
+    if agg != "count" and not is_numeric(frame, measure):
+        return None
+    if name == "top":
+        if parts["group"] == measure:
+            return None
+        return {"op": "top", "agg": agg, "measure": measure, "by": [parts["group"]], "n": int(parts["n"]), "ascending": parts["direction"] == "bottom"}
+    group = parts.get("group")
+    if group == measure:
+        return None
+    return {"op": "aggregate", "agg": agg, "measure": measure, "by": [group] if group else []}
+
+
+def format_number(value):
+    if isinstance(value, float):
+        return f"{value:,.4f}".rstrip("0").rstrip(".")
+    return f"{value:,}"
+
+
+# Dataset columns a plan reads, so only those are loaded to run it
+def compiled_columns(plan):
+    if plan["op"] == "count_where":
+        return [plan["column"]]
+    if plan["op"] == "correlation":
+        return list(plan["columns"])
+    return [column for column in [plan["measure"], *plan["by"]] if column is not None]
+
+
+# The compiled question as query-plan steps, so it can be estimated from a
+# sample; None for correlations
+def compiled_steps(plan):
+    op = plan["op"]
+    if op == "count_where":
+        return [
+            {"op": "filter", "column": plan["column"], "operator": "==", "value": plan["value"]},
+            {"op": "aggregate", "aggregations": [{"column": "*", "function": "count", "as": "count"}]},
+        ]
+    if op == "correlation":
+        return None
+    measure = plan["measure"]
+    name = "count" if measure is None else f"{plan['agg']}_{measure}"
+    steps = [
+        {"op": "groupby", "by": plan["by"]},
+        {"op": "aggregate", "aggregations": [{"column": "*" if measure is None else measure, "function": plan["agg"], "as": name}]},
+    ]
+    if op == "top":
+        steps += [{"op": "sort", "by": [name], "ascending": plan["ascending"]}, {"op": "limit", "n": plan["n"]}]
+    return steps
+
+
+# Execute a compiled plan; returns a DataFrame for grouped results or a sentence
+def run_compiled(plan, frame):
+    op = plan["op"]
+    if op == "count_where":
+        return format_compiled(plan, int((frame[plan["column"]] == plan["value"]).sum()))
+    if op == "correlation":
+        a, b = plan["columns"]
+        return format_compiled(plan, float(frame[a].corr(frame[b])))
+    measure, by, agg = plan["measure"], plan["by"], plan["agg"]
+    if not by:
+        return format_compiled(plan, len(frame) if measure is None else frame[measure].agg(agg))
+    grouped = frame.groupby(by, sort=True)
+    return format_compiled(plan, grouped.size() if measure is None else grouped[measure].agg(agg))
+
+
+# The same results streamed chunk by chunk over a dataset too large to load
+def run_compiled_chunks(plan, dataset):
+    op = plan["op"]
+    columns = compiled_columns(plan)
+
+    def scan():
+        return dataset.iter_chunks(columns)
+
+    if op == "count_where":
+        return format_compiled(plan, sum(int((chunk[plan["column"]] == plan["value"]).sum()) for chunk in scan()))
+    if op == "correlation":
+        return format_compiled(plan, float(out_of_core.correlation(scan, *plan["columns"])))
+    measure, by, agg = plan["measure"], plan["by"], plan["agg"]
+    if agg == "median" and by:
+        return run_compiled(plan, dataset.load(columns))
+    return format_aggregate(plan, out_of_core.aggregate(scan, by, [("value", measure, "size" if measure is None else agg)]))
+
+
+# The same results from the dataset's precomputed cube; None when the cube
+# does not cover the question
+def run_compiled_cube(plan, data_cube):
+    op = plan["op"]
+    if op == "correlation":
+        return None
+    if op == "count_where":
+        result = data_cube.query([], [("value", None, "size")], [(plan["column"], "==", plan["value"])])
+        return None if result is None else format_compiled(plan, int(result["value"].iloc[0]))
+    measure, by, agg = plan["measure"], plan["by"], plan["agg"]
+    result = data_cube.query([(key, key, None) for key in by], [("value", measure, "size" if measure is None else agg)])
+    return None if result is None else format_aggregate(plan, result)
+
+
+# Format a merged aggregate (one "value" column) as run_compiled does
+def format_aggregate(plan, result):
+    by = plan["by"]
+    if not by:
+        return format_compiled(plan, result["value"].iloc[0])
+    # groupby(sort=True) leaves out missing keys and sorts the rest
+    return format_compiled(plan, result.dropna(subset=by).set_index(by)["value"].sort_index())
+
+
+# Sentence for a single value, or a DataFrame for a per-group Series
+def format_compiled(plan, value):
+    op = plan["op"]
+    if not isinstance(value, pd.Series) and hasattr(value, "item"):
+        value = value.item()
+    if op == "count_where":
+        return f"{value:,} rows have {plan['column']} equal to {plan['value']}."
+    if op == "correlation":
+        a, b = plan["columns"]
+        return f"The correlation between {a} and {b} is {format_number(value)}."
+    measure, agg = plan["measure"], plan["agg"]
+    if not plan["by"]:
+        label = "number of rows" if measure is None else f"{AGGREGATE_WORDS[agg]} {measure}"
+        return f"The {label} is {format_number(value)}."
+    name = "count" if measure is None else f"{agg}_{measure}"
+    if op == "top":
+        value = value.nsmallest(plan["n"]) if plan["ascending"] else value.nlargest(plan["n"])
+    return value.rename(name).reset_index()
+
+
+def describe_compiled(plan):
+    op = plan["op"]
+    if op == "count_where":
+        return f"Counted the rows where {plan['column']} is {plan['value']}."
+    if op == "correlation":
+        a, b = plan["columns"]
+        return f"Computed the Pearson correlation between {a} and {b}."
+    target = "the number of rows" if plan["measure"] is None else f"the {AGGREGATE_WORDS[plan['agg']]} {plan['measure']}"
+    if op == "top":
+        direction = "bottom" if plan["ascending"] else "top"
+        return f"Ranked {plan['by'][0]} by {target} and kept the {direction} {plan['n']}."
+    if plan["by"]:
+        return f"Computed {target} for each {plan['by'][0]}."
+    return f"Computed {target} over the whole dataset."
@@ -0,0 +1,313 @@
+import math
+import os
+import numpy as np
+import pandas as pd
+
+# Out-of-core execution for datasets whose in-memory estimate exceeds
+# OUT_OF_CORE_BYTES. Instead of loading the table, the common aggregations
+# stream over it chunk by chunk and merge partial results:
+#
+#   - grouped aggregates keep per-group partial states (counts, sums, min/max,
+#     first/last, and count/sum/M2 for variances, merged with Chan's formula)
+#   - value counts and histogram bins add up per chunk
+#   - quantiles (describe, ungrouped medians) are exact: each pass histograms
+#     a window around every wanted rank and narrows it until the values left in
+#     the window are few enough to collect and sort
+#
+# Every function takes `scan`, a zero-argument callable returning a fresh
+# iterator of DataFrame chunks, since some results need more than one pass.
+# Grouped medians cannot be merged from chunks and raise NotImplementedError.
+
+OUT_OF_CORE_BYTES = int(os.environ.get("OUT_OF_CORE_BYTES", str(2 * 1024 ** 3)))
+# Partial results are merged whenever this many chunks have accumulated
+MERGE_EVERY_CHUNKS = 16
+QUANTILE_BINS = 1024
+# A quantile window is collected and sorted once it holds at most this many values
+QUANTILE_COLLECT_VALUES = 1_000_000
+DESCRIBE_QUANTILES = (0.25, 0.5, 0.75)
+# Key used when an aggregate has no group columns
+ALL_ROWS = "__all_rows__"
+
+
+def exceeds_memory(dataset):
+    return dataset.memory_estimate() > OUT_OF_CORE_BYTES
+
+
+def numeric_values(series):
+    return series.to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+# Partial state of one chunk: one row per group, the group keys as columns
+def chunk_partial(chunk, keys, aggregations):
+    grouped = chunk.groupby(keys, sort=False, dropna=False, observed=True)
+    named = {"rows_n": (keys[0], "size")}
+    for index, (_, column, function) in enumerate(aggregations):
+        if function == "size":
+            named[f"{index}_n"] = (keys[0], "size")
+        elif function in ("count", "sum", "min", "max", "first", "last"):
+            named[f"{index}_{function}"] = (column, function)
+        elif function in ("mean", "std", "var"):
+            named[f"{index}_count"] = (column, "count")
+            named[f"{index}_sum"] = (column, "sum")
+            if function != "mean":
+                named[f"{index}_var"] = (column, "var")
+    partial = grouped.agg(**named).reset_index()
+    for index, (_, _, function) in enumerate(aggregations):
+        if function in ("std", "var"):
+            # Sum of squared deviations from the chunk's group mean
+            m2 = partial.pop(f"{index}_var") * (partial[f"{index}_count"] - 1)
+            partial[f"{index}_m2"] = m2.fillna(0.0)
+    return partial
+
+
+# Merge partial states (in chunk order, so first/last and group order hold)
+def merge_partials(partials, keys):
+    combined = pd.concat(partials, ignore_index=True)
+    grouped = combined.groupby(keys, sort=False, dropna=False, observed=True)
+    merged = {}
+    for name in combined.columns:
+        if name in keys or name.endswith("_m2"):
+            continue
+        function = name.rsplit("_", 1)[1]
+        merged[name] = grouped[name].agg("sum" if function in ("n", "count", "sum") else function)
+    merged = pd.DataFrame(merged)
+    for name in [name for name in combined.columns if name.endswith("_m2")]:
+        prefix = name[:-len("m2")]
+        count, total = combined[prefix + "count"], combined[prefix + "sum"]
+        mean = grouped[prefix + "sum"].transform("sum") / grouped[prefix + "count"].transform("sum")
+        shift = (count * (total / count - mean) ** 2).fillna(0.0)
+        merged[name] = (combined[name] + shift).groupby([combined[key] for key in keys], sort=False, dropna=False).sum().values
+    return merged.reset_index()
+
+
+# Grouped (or, with no `by`, whole-table) aggregates merged from chunks.
+# `aggregations` are (output, column, function) with function "size" counting
+# rows; output columns are named as the in-memory aggregate names them.
+def aggregate(scan, by, aggregations):
+    functions = {function for _, _, function in aggregations}
+    if "median" in functions and by:
+        raise NotImplementedError("Grouped medians cannot be merged from chunks.")
+    keys = list(by) if by else [ALL_ROWS]
+    distinct_columns = [column for _, column, function in aggregations if function == "nunique"]
+    partials, distinct = [], {column: None for column in distinct_columns}
+    for chunk in scan():
+        if not by:
+            chunk = chunk.assign(**{ALL_ROWS: 0})
+        partials.append(chunk_partial(chunk, keys, aggregations))
+        if len(partials) >= MERGE_EVERY_CHUNKS:
+            partials = [merge_partials(partials, keys)]
+        for column in distinct_columns:
+            pairs = chunk[keys + [column]].drop_duplicates()
+            distinct[column] = pairs if distinct[column] is None else pd.concat([distinct[column], pairs]).drop_duplicates()
+    if not partials:
+        return pd.DataFrame(columns=keys + [name for name, _, _ in aggregations]) if by else no_rows(aggregations)
+    result = merge_partials(partials, keys) if len(partials) > 1 else partials[0]
+    output = result[keys].copy()
+    for index, (name, column, function) in enumerate(aggregations):
+        if function in ("size", "count", "sum", "min", "max", "first", "last"):
+            output[name] = result[f"{index}_{'n' if function == 'size' else function}"]
+        elif function == "mean":
+            output[name] = result[f"{index}_sum"] / result[f"{index}_count"]
+        elif function in ("std", "var"):
+            variance = result[f"{index}_m2"] / (result[f"{index}_count"] - 1)
+            variance = variance.where(result[f"{index}_count"] > 1)
+            output[name] = np.sqrt(variance) if function == "std" else variance
+        elif function == "nunique":
+            counts = distinct[column].groupby(keys, sort=False, dropna=False)[column].nunique() if distinct[column] is not None else pd.Series(dtype="int64")
+            output[name] = counts.reindex(pd.MultiIndex.from_frame(output[keys]) if len(keys) > 1 else output[keys[0]]).fillna(0).astype("int64").values
+        elif function == "median":
+            output[name] = quantiles(lambda: (chunk[[column]] for chunk in scan()), [column], [0.5])[column][0.5]
+    if by:
+        return output
+    output = output.drop(columns=ALL_ROWS)
+    return no_rows(aggregations) if output.empty else output
+
+
+# Whole-table aggregates of no rows: counts and sums are zero, everything else missing
+def no_rows(aggregations):
+    return pd.DataFrame({name: [0 if function in ("size", "count", "sum", "nunique") else np.nan] for name, _, function in aggregations})
+
+
+# Row counts of each distinct value, most frequent first
+def value_counts(scan, column):
+    partials = []
+    for chunk in scan():
+        partials.append(chunk.groupby(column, sort=False, dropna=False).size())
+        if len(partials) >= MERGE_EVERY_CHUNKS:
+            partials = [pd.concat(partials).groupby(level=0, sort=False, dropna=False).sum()]
+    if not partials:
+        return pd.DataFrame({column: [], "count": []})
+    counts = pd.concat(partials).groupby(level=0, sort=False, dropna=False).sum()
+    return counts.sort_values(ascending=False, kind="stable").rename_axis(column).reset_index(name="count")
+
+
+def column_range(scan, column):
+    low, high = np.inf, -np.inf
+    for chunk in scan():
+        values = numeric_values(chunk[column])
+        values = values[~np.isnan(values)]
+        if len(values):
+            low, high = min(low, values.min()), max(high, values.max())
+    return (low, high) if low <= high else None
+
+
+# Equal-width bins between the column's minimum and maximum, as np.histogram
+def histogram(scan, column, bins):
+    edges = np.histogram_bin_edges([], bins=bins, range=column_range(scan, column))
+    counts = np.zeros(bins, dtype=np.int64)
+    for chunk in scan():
+        values = numeric_values(chunk[column])
+        counts += np.histogram(values[~np.isnan(values)], bins=edges)[0]
+    return bins_frame(counts, edges)
+
+
+def bins_frame(counts, edges):
+    return pd.DataFrame({"bin_start": edges[:-1], "bin_end": edges[1:], "count": counts})
+
+
+# The same bins for a column already in memory
+def histogram_frame(series, bins):
+    values = numeric_values(series)
+    values = values[~np.isnan(values)]
+    edges = np.histogram_bin_edges(values, bins=bins)
+    return bins_frame(np.histogram(values, bins=edges)[0], edges)
+
+
+# Count, mean and sum of squared deviations of each column, merged across chunks
+def moments(scan, columns):
+    stats = {column: [0, 0.0, 0.0, np.inf, -np.inf] for column in columns}
+    for chunk in scan():
+        for column in columns:
+            values = numeric_values(chunk[column])
+            values = values[~np.isnan(values)]
+            if not len(values):
+                continue
+            count, mean, m2, low, high = stats[column]
+            chunk_mean = values.mean()
+            chunk_m2 = ((values - chunk_mean) ** 2).sum()
+            total = count + len(values)
+            delta = chunk_mean - mean
+            stats[column] = [
+                total, mean + delta * len(values) / total, m2 + chunk_m2 + delta ** 2 * count * len(values) / total,
+                min(low, values.min()), max(high, values.max()),
+            ]
+    return stats
+
+
+# Linear interpolation between neighbouring order statistics, as numpy does it
+def interpolate(low, high, fraction):
+    difference = high - low
+    return high - difference * (1 - fraction) if fraction >= 0.5 else low + difference * fraction
+
+
+class RankWindow:
+    def __init__(self, rank, low, high):
+        self.rank = rank
+        self.low, self.high = low, high
+        self.closed = True  # Whether the window includes its upper edge
+        self.below = 0  # Values under the window
+        self.inside = None  # Values in the window, once known
+        self.value = None
+
+    def mask(self, values):
+        upper = values <= self.high if self.closed else values < self.high
+        return (values >= self.low) & upper
+
+
+# Exact quantiles of numeric columns: {column: {q: value}}
+def quantiles(scan, columns, qs, stats=None):
+    stats = stats or moments(scan, columns)
+    windows = {}
+    for column in columns:
+        count, _, _, low, high = stats[column]
+        for q in qs:
+            position = q * (count - 1)
+            for rank in {math.floor(position), math.ceil(position)} if count else ():
+                windows[(column, rank)] = RankWindow(rank, low, high)
+                windows[(column, rank)].inside = count
+    passes = 0
+    while any(window.value is None for window in windows.values()):
+        passes += 1
+        active = {key: window for key, window in windows.items() if window.value is None}
+        collected = {key: [] for key, window in active.items() if window.inside <= QUANTILE_COLLECT_VALUES or passes > 64}
+        histograms = {key: np.zeros(QUANTILE_BINS, dtype=np.int64) for key in active if key not in collected}
+        extremes = {key: [np.inf, -np.inf] for key in histograms}
+        for chunk in scan():
+            for column in {column for column, _ in active}:
+                values = numeric_values(chunk[column])
+                values = values[~np.isnan(values)]
+                for key, window in active.items():
+                    if key[0] != column:
+                        continue
+                    inside = values[window.mask(values)]
+                    if key in collected:
+                        collected[key].append(inside)
+                    elif len(inside):
+                        histograms[key] += np.histogram(inside, bins=QUANTILE_BINS, range=(window.low, window.high))[0]
+                        extremes[key] = [min(extremes[key][0], inside.min()), max(extremes[key][1], inside.max())]
+        for key, window in active.items():
+            if key in collected:
+                window.value = np.sort(np.concatenate(collected[key]))[window.rank - window.below]
+            elif extremes[key][0] == extremes[key][1]:
+                window.value = extremes[key][0]
+            else:
+                # Narrow to the bin holding the rank
+                counts = histograms[key]
+                cumulative = np.cumsum(counts)
+                position = int(np.searchsorted(cumulative, window.rank - window.below, side="right"))
+                edges = np.linspace(window.low, window.high, QUANTILE_BINS + 1)
+                window.below += int(cumulative[position - 1]) if position else 0
+                window.inside = int(counts[position])
+                window.closed = window.closed and position == QUANTILE_BINS - 1
+                window.low, window.high = edges[position], edges[position + 1]
+    result = {}
+    for column in columns:
+        count = stats[column][0]
+        result[column] = {}
+        for q in qs:
+            if not count:
+                result[column][q] = np.nan
+                continue
+            position = q * (count - 1)
+            low, high = windows[(column, math.floor(position))].value, windows[(column, math.ceil(position))].value
+            result[column][q] = interpolate(low, high, position - math.floor(position))
+    return result
+
+
+# The statistics of DataFrame.describe() for numeric columns
+def describe(scan, columns):
+    stats = moments(scan, columns)
+    percentiles = quantiles(scan, columns, DESCRIBE_QUANTILES, stats)
+    index = ["count", "mean", "std", "min"] + [f"{q:.0%}" for q in DESCRIBE_QUANTILES] + ["max"]
+    data = {}
+    for column in columns:
+        count, mean, m2, low, high = stats[column]
+        data[column] = [
+            float(count), mean if count else np.nan, math.sqrt(m2 / (count - 1)) if count > 1 else np.nan,
+            low if count else np.nan, *(percentiles[column][q] for q in DESCRIBE_QUANTILES), high if count else np.nan,
+        ]
+    return pd.DataFrame(data, index=index)
+
+
+# Pearson correlation over rows where both columns are present
+def correlation(scan, a, b):
+    count, mean_a, mean_b, m2_a, m2_b, co = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+    for chunk in scan():
+        x, y = numeric_values(chunk[a]), numeric_values(chunk[b])
+        present = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[present], y[present]
+        if not len(x):
+            continue
+        n = len(x)
+        chunk_a, chunk_b = x.mean(), y.mean()
+        total = count + n
+        delta_a, delta_b = chunk_a - mean_a, chunk_b - mean_b
+        m2_a += ((x - chunk_a) ** 2).sum() + delta_a ** 2 * count * n / total
+        m2_b += ((y - chunk_b) ** 2).sum() + delta_b ** 2 * count * n / total
+        co += ((x - chunk_a) * (y - chunk_b)).sum() + delta_a * delta_b * count * n / total
+        mean_a += delta_a * n / total
+        mean_b += delta_b * n / total
+        count = total
+    if count < 2 or m2_a == 0 or m2_b == 0:
+        return np.nan
+    return co / math.sqrt(m2_a * m2_b)
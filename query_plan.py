@@ -0,0 +1,607 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+import pandas as pd
+import approximate
+import cube
+from cancellation import cancellable
+import metrics
+import out_of_core
+
+# Restricted JSON query plans: an alternative to executing model-written Python.
+# The model emits {"steps": [...]} using a fixed set of operations and this
+# module validates, optimises and runs the plan vectorised over the registered
+# dataset. Plans are plain data, so they are canonicalised and cached, and the
+# intermediate result after each step is reused by later plans sharing a prefix.
+#
+#   {"op": "select", "columns": ["a", "b"]}
+#   {"op": "filter", "column": "a", "operator": ">", "value": 3}
+#   {"op": "derive", "name": "c", "expression": {"op": "*", "left": {"column": "a"}, "right": {"value": 2}}}
+#   {"op": "groupby", "by": ["b"]}
+#   {"op": "aggregate", "aggregations": [{"column": "a", "function": "mean", "as": "avg_a"}]}
+#   {"op": "sort", "by": ["avg_a"], "ascending": false}
+#   {"op": "limit", "n": 10}
+#   {"op": "join", "dataset_id": "...", "on": ["b"], "how": "left"}
+#   {"op": "value_counts", "column": "b"}
+#   {"op": "describe", "columns": ["a"]}
+#   {"op": "histogram", "column": "a", "bins": 20}
+#
+# On datasets larger than the out-of-core limit, plans that reduce the rows
+# (aggregate, value_counts, describe, histogram) stream over the table instead
+# of loading it: the select/filter/derive steps before the reduction run on
+# each chunk and the partial results are merged (see out_of_core.py). Before
+# either, aggregates and value counts over the dataset's cube dimensions are
+# answered from its precomputed cube (see cube.py).
+
+OPERATIONS = {"select", "filter", "derive", "groupby", "aggregate", "sort", "limit", "join", "value_counts", "describe", "histogram"}
+FILTER_OPERATORS = {"==", "!=", "<", "<=", ">", ">=", "in", "not in", "contains", "isnull", "notnull"}
+AGGREGATE_FUNCTIONS = {"sum", "mean", "median", "min", "max", "count", "nunique", "std", "var", "first", "last"}
+ARITHMETIC = {"+": "add", "-": "sub", "*": "mul", "/": "truediv"}
+EXPRESSION_FUNCTIONS = {"abs", "round", "year", "month", "day", "lower", "upper", "length"}
+JOIN_TYPES = {"inner", "left", "right", "outer"}
+# Steps that reduce the rows to a small result, and the row-wise steps that
+# can run on each chunk before one of them
+REDUCING_OPERATIONS = {"aggregate", "value_counts", "describe", "histogram"}
+ROW_OPERATIONS = {"select", "filter", "derive"}
+DEFAULT_BINS = 20
+MAX_BINS = 1000
+# Filters the table reader can apply while scanning. "!=" is left out because
+# Arrow drops nulls that pandas keeps.
+SCAN_FILTER_OPERATORS = {"==", "<", "<=", ">", ">=", "in"}
+
+PLAN_CACHE_ENTRIES = int(os.environ.get("PLAN_CACHE_ENTRIES", "64"))
+PLAN_CACHE_BYTES = int(os.environ.get("PLAN_CACHE_BYTES", str(256 * 1024 * 1024)))
+
+
+class PlanError(ValueError):
+    pass
+
+
+def expression_columns(expression):
+    if "column" in expression:
+        return {expression["column"]}
+    if "value" in expression:
+        return set()
+    if "function" in expression:
+        return expression_columns(expression["arg"])
+    return expression_columns(expression["left"]) | expression_columns(expression["right"])
+
+
+def step_inputs(step):
+    op = step["op"]
+    if op == "select":
+        return set(step["columns"])
+    if op == "filter":
+        return {step["column"]}
+    if op == "derive":
+        return expression_columns(step["expression"])
+    if op == "groupby":
+        return set(step["by"])
+    if op == "aggregate":
+        return set(step.get("by") or []) | {aggregation["column"] for aggregation in step["aggregations"] if aggregation["column"] != "*"}
+    if op == "sort":
+        return set(step["by"])
+    if op == "join":
+        return set(step["on"])
+    if op in ("value_counts", "histogram"):
+        return {step["column"]}
+    if op == "describe":
+        return set(step.get("columns") or [])
+    return set()
+
+
+def validate_expression(expression, available):
+    if not isinstance(expression, dict):
+        raise PlanError("Expressions must be objects.")
+    if "column" in expression:
+        if expression["column"] not in available:
+            raise PlanError(f"Unknown column in expression: {expression['column']!r}")
+    elif "value" in expression:
+        if not isinstance(expression["value"], (int, float, str, bool)):
+            raise PlanError("Expression values must be numbers, strings or booleans.")
+    elif "function" in expression:
+        if expression["function"] not in EXPRESSION_FUNCTIONS:
+            raise PlanError(f"Unsupported function: {expression['function']!r}")
+        validate_expression(expression.get("arg"), available)
+        if not expression_columns(expression["arg"]):
+            raise PlanError(f"'{expression['function']}' needs an argument computed from a column.")
+    elif expression.get("op") in ARITHMETIC:
+        validate_expression(expression.get("left"), available)
+        validate_expression(expression.get("right"), available)
+    else:
+        raise PlanError(f"Unsupported expression: {expression!r}")
+
+
+# Check a step's `key` is a list of column names (or, unless `required`, absent)
+def validate_names(step, key, required=True):
+    names = step.get(key)
+    if names is None and not required:
+        return
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        raise PlanError(f"'{step['op']}' {key} must be a list of column names.")
+
+
+# Check every step against the columns available at that point; raises PlanError
+def validate_plan(plan, columns, resolve_dataset=None):
+    steps = plan.get("steps") if isinstance(plan, dict) else None
+    if not isinstance(steps, list) or not steps:
+        raise PlanError("The plan must contain a non-empty 'steps' list.")
+    available = set(columns)
+    grouped = False
+    for step in steps:
+        op = step.get("op") if isinstance(step, dict) else None
+        if op not in OPERATIONS:
+            raise PlanError(f"Unsupported operation: {op!r}")
+        if grouped and op != "aggregate":
+            raise PlanError("'groupby' must be followed by 'aggregate'.")
+        if op in ("select", "groupby", "sort"):
+            validate_names(step, "columns" if op == "select" else "by")
+        if op in ("aggregate", "describe"):
+            validate_names(step, "by" if op == "aggregate" else "columns", required=False)
+        if op == "join":
+            validate_names(step, "on")
+        if op in ("filter", "value_counts", "histogram") and not isinstance(step.get("column"), str):
+            raise PlanError(f"'{op}' needs a column name.")
+        if op == "aggregate":
+            if not isinstance(step.get("aggregations", []), list) or not all(isinstance(aggregation, dict) for aggregation in step.get("aggregations", [])):
+                raise PlanError("'aggregate' aggregations must be a list of objects.")
+            for aggregation in step.get("aggregations", []):
+                if aggregation.get("function") not in AGGREGATE_FUNCTIONS:
+                    raise PlanError(f"Unsupported aggregate function: {aggregation.get('function')!r}")
+                if aggregation.get("column") != "*" and aggregation.get("column") not in available:
+                    raise PlanError(f"Unknown column: {aggregation.get('column')!r}")
+            if not step.get("aggregations"):
+                raise PlanError("'aggregate' needs at least one aggregation.")
+            keys = grouped or set(step.get("by", []))
+            if keys - available:
+                raise PlanError(f"Unknown columns: {sorted(map(str, keys - available))}")
+            available = set(keys) | {aggregation.get("as") or f"{aggregation['function']}_{aggregation['column']}" for aggregation in step["aggregations"]}
+            grouped = False
+            continue
+        if op == "derive":
+            validate_expression(step.get("expression"), available)
+            if not isinstance(step.get("name"), str):
+                raise PlanError("'derive' needs a column name.")
+            available = available | {step["name"]}
+            continue
+        if op == "filter" and step.get("operator") not in FILTER_OPERATORS:
+            raise PlanError(f"Unsupported filter operator: {step.get('operator')!r}")
+        if op == "limit" and not (isinstance(step.get("n"), int) and step["n"] > 0):
+            raise PlanError("'limit' needs a positive integer 'n'.")
+        if op == "histogram" and not (isinstance(step.get("bins", DEFAULT_BINS), int) and 0 < step.get("bins", DEFAULT_BINS) <= MAX_BINS):
+            raise PlanError(f"'histogram' needs between 1 and {MAX_BINS} bins.")
+        if op == "join":
+            if step.get("how", "inner") not in JOIN_TYPES:
+                raise PlanError(f"Unsupported join type: {step.get('how')!r}")
+            other = resolve_dataset(step.get("dataset_id")) if resolve_dataset else None
+            if other is None:
+                raise PlanError(f"Unknown dataset to join: {step.get('dataset_id')!r}")
+            missing = set(step.get("on", [])) - (available & set(other.columns))
+            if not step.get("on") or missing:
+                raise PlanError(f"Join columns missing on one side: {sorted(missing)}")
+            available = available | set(other.columns)
+        missing = step_inputs(step) - available
+        if missing:
+            raise PlanError(f"Unknown columns: {sorted(map(str, missing))}")
+        if op == "select":
+            available = set(step["columns"])
+        if op == "value_counts":
+            available = {step["column"], "count"}
+        if op == "histogram":
+            available = {"bin_start", "bin_end", "count"}
+        if op == "describe":
+            available = {"statistic"} | (set(step.get("columns") or []) or available)
+        if op == "groupby":
+            grouped = set(step["by"])
+    if grouped:
+        raise PlanError("'groupby' must be followed by 'aggregate'.")
+
+
+# Move filters ahead of steps they commute with, so rows are dropped as early
+# as possible: past sorts, past selects, and past derives they do not read
+def push_down_filters(steps):
+    steps = list(steps)
+    moved = True
+    while moved:
+        moved = False
+        for index in range(1, len(steps)):
+            step, previous = steps[index], steps[index - 1]
+            if step["op"] != "filter":
+                continue
+            commutes = previous["op"] in ("sort", "select") or (previous["op"] == "derive" and previous["name"] != step["column"])
+            if commutes:
+                steps[index - 1], steps[index] = step, previous
+                moved = True
+    return steps
+
+
+# Base-table columns the plan reads anywhere; None when every column is needed
+def required_columns(steps, columns):
+    needed = set()
+    produced = set()
+    for step in steps:
+        needed |= step_inputs(step) - produced
+        if step["op"] == "derive":
+            produced.add(step["name"])
+        if step["op"] == "describe" and not step.get("columns"):
+            return None
+        if step["op"] in ("select", "aggregate", "value_counts", "histogram", "describe"):
+            return [column for column in columns if column in needed]
+    return None
+
+
+def optimize_plan(plan, columns):
+    steps = push_down_filters(plan["steps"])
+    needed = required_columns(steps, columns)
+    if needed is not None and len(needed) < len(columns):
+        # Column pruning: carry only the columns the plan reads
+        steps = [{"op": "select", "columns": needed}] + steps
+    return steps
+
+
+# The filters at the head of the plan (after a leading select) that the table
+# reader can apply, as (column, operator, value), and the step after them
+def scan_filters(steps):
+    start = 1 if steps and steps[0]["op"] == "select" else 0
+    filters = []
+    for step in steps[start:]:
+        if step["op"] != "filter" or step["operator"] not in SCAN_FILTER_OPERATORS:
+            break
+        value = step.get("value")
+        if step["operator"] == "in":
+            value = value if isinstance(value, list) else [value]
+        if value is None or (isinstance(value, list) and any(item is None for item in value)):
+            break
+        filters.append((step["column"], step["operator"], value))
+    return filters, start + len(filters)
+
+
+def load_base(steps, dataset):
+    columns = steps[0]["columns"] if steps[0]["op"] == "select" else None
+    filters, end = scan_filters(steps)
+    if filters:
+        try:
+            frame = dataset.load(columns, filters)
+        except (ValueError, TypeError, NotImplementedError) as e:
+            # Types the reader cannot compare; the filter steps run in pandas instead
+            logging.info(f"Filter pushdown skipped: {e}")
+        else:
+            metrics.increment("query_plan.filters_pushed", len(filters))
+            if columns is not None:
+                frame = frame[columns]
+            return frame, end
+    # Only the columns a leading (pruning) select keeps, in their logical dtypes
+    return dataset.load(columns), 0
+
+
+# Length of the plan prefix that can stream: row-wise steps up to and
+# including the first reducing step; None if there is no such prefix
+def streaming_prefix(steps):
+    for index, step in enumerate(steps):
+        if step["op"] in REDUCING_OPERATIONS:
+            return index + 1
+        if step["op"] not in ROW_OPERATIONS and step["op"] != "groupby":
+            return None
+    return None
+
+
+# Run a streaming prefix chunk by chunk over a dataset too large to load,
+# merging the partial results of its final reducing step
+def stream_steps(steps, dataset, push_filters=True):
+    columns = steps[0]["columns"] if steps[0]["op"] == "select" else None
+    filters, start = scan_filters(steps) if push_filters else ([], 1 if columns is not None else 0)
+    row_steps = [step for step in steps[start:-1] if step["op"] != "groupby"]
+
+    def scan():
+        for chunk in dataset.iter_chunks(columns, filters or None):
+            for step in row_steps:
+                chunk = apply_step(chunk, step, None, None)
+            yield chunk
+
+    step = steps[-1]
+    try:
+        if step["op"] == "value_counts":
+            return out_of_core.value_counts(scan, step["column"])
+        if step["op"] == "histogram":
+            return out_of_core.histogram(scan, step["column"], step.get("bins", DEFAULT_BINS))
+        if step["op"] == "describe":
+            first = next(scan(), None)
+            numeric = describe_columns(first, step).columns if first is not None else []
+            return out_of_core.describe(scan, list(numeric)).rename_axis("statistic").reset_index()
+        by = steps[-2]["by"] if len(steps) > 1 and steps[-2]["op"] == "groupby" else step.get("by") or []
+        return out_of_core.aggregate(scan, by, step_aggregations(step))
+    except (ValueError, TypeError, NotImplementedError) as e:
+        if not filters or isinstance(e, PlanError):
+            raise
+        # Types the reader cannot compare; filter each chunk in pandas instead
+        logging.info(f"Filter pushdown skipped: {e}")
+        return stream_steps(steps, dataset, push_filters=False)
+
+
+# (output, column, function) for each aggregation of an aggregate step
+def step_aggregations(step):
+    return [
+        (aggregation.get("as") or f"{aggregation['function']}_{aggregation['column']}",
+         None if aggregation["column"] == "*" else aggregation["column"],
+         "size" if aggregation["column"] == "*" else aggregation["function"])
+        for aggregation in step["aggregations"]
+    ]
+
+
+# Answer a streaming prefix from the dataset's cube: filters on dimensions,
+# year/month derives of its datetime dimensions, and an aggregate or value
+# count grouped by dimensions. None when the cube does not cover the prefix.
+def answer_from_cube(steps, data_cube):
+    filters, derived, by = [], {}, []
+    for step in steps[:-1]:
+        if step["op"] == "filter":
+            value = step.get("value")
+            if step["column"] in derived or step["operator"] not in cube.FILTER_OPERATORS:
+                return None
+            filters.append((step["column"], step["operator"], (value if isinstance(value, list) else [value]) if step["operator"] == "in" else value))
+        elif step["op"] == "derive":
+            expression = step["expression"]
+            if expression.get("function") not in ("year", "month") or "column" not in expression["arg"]:
+                return None
+            derived[step["name"]] = (expression["arg"]["column"], expression["function"])
+        elif step["op"] == "groupby":
+            by = step["by"]
+        elif step["op"] != "select":
+            return None
+    step = steps[-1]
+    if step["op"] == "value_counts":
+        by, aggregations = [step["column"]], [("count", None, "size")]
+    elif step["op"] == "aggregate":
+        by, aggregations = by or step.get("by") or [], step_aggregations(step)
+    else:
+        return None
+    keys = [(key, *derived[key]) if key in derived else (key, key, None) for key in by]
+    result = data_cube.query(keys, aggregations, filters)
+    if result is not None and step["op"] == "value_counts":
+        result = result.sort_values("count", ascending=False, kind="stable")
+    return result
+
+
+# Estimate a plan's result from the dataset's sample: the streaming prefix runs
+# on the weighted sample rows, its reducing step is estimated (with "_error"
+# columns holding 95% bounds) and the remaining steps run on the estimate.
+# None when the plan has nothing to estimate or cannot run on the sample.
+def execute_plan_approximate(plan, dataset, sample):
+    try:
+        validate_plan(plan, dataset.columns)
+        steps = optimize_plan(plan, dataset.columns)
+        end = streaming_prefix(steps)
+        if not end:
+            return None
+        step = steps[end - 1]
+        by = steps[end - 2]["by"] if end > 1 and steps[end - 2]["op"] == "groupby" else step.get("by") or []
+        if step["op"] == "value_counts":
+            by = [step["column"]]
+        # Stratify by a grouping key, or else by a column the rows are filtered on
+        candidates = list(by) + [row_step["column"] for row_step in steps[:end - 1] if row_step["op"] == "filter"]
+        frame, strata = sample.weighted(next((column for column in candidates if column in sample.counts), None))
+        for row_step in steps[:end - 1]:
+            if row_step["op"] == "select":
+                frame = frame[row_step["columns"] + approximate.META_COLUMNS]
+            elif row_step["op"] != "groupby":
+                frame = apply_step(frame, row_step, None, None)
+        if step["op"] == "value_counts":
+            counts = approximate.aggregate(frame, strata, by, [("count", None, "size")])
+            result = counts.sort_values("count", ascending=False, kind="stable")
+        elif step["op"] == "histogram":
+            result = approximate.histogram(frame, strata, step["column"], step.get("bins", DEFAULT_BINS))
+        elif step["op"] == "describe":
+            numeric = describe_columns(frame.drop(columns=approximate.META_COLUMNS), step).columns
+            result = approximate.describe(frame, list(numeric)).rename_axis("statistic").reset_index()
+        else:
+            result = approximate.aggregate(frame, strata, by, step_aggregations(step))
+        pending_group = None
+        for later in steps[end:]:
+            if later["op"] == "groupby":
+                pending_group = later["by"]
+                continue
+            result = apply_step(result, later, pending_group, None)
+            pending_group = None
+        return result.reset_index(drop=True)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        logging.info(f"No approximate answer for the plan: {e!r}")
+        return None
+
+
+def evaluate_expression(expression, frame):
+    if "column" in expression:
+        return frame[expression["column"]]
+    if "value" in expression:
+        return expression["value"]
+    if "function" in expression:
+        arg = evaluate_expression(expression["arg"], frame)
+        function = expression["function"]
+        if function in ("abs", "round"):
+            return getattr(arg, function)()
+        if function in ("year", "month", "day"):
+            # Numbers would be read as nanoseconds since 1970
+            if pd.api.types.is_numeric_dtype(arg) or pd.api.types.is_bool_dtype(arg):
+                raise PlanError(f"'{function}' needs a date column, not {arg.dtype}.")
+            return getattr(pd.to_datetime(arg).dt, function)
+        if function == "length":
+            return arg.astype(str).str.len()
+        return getattr(arg.astype(str).str, function)()
+    left = evaluate_expression(expression["left"], frame)
+    right = evaluate_expression(expression["right"], frame)
+    if not isinstance(left, pd.Series):
+        left, right = pd.Series(left, index=frame.index), right
+    return getattr(left, ARITHMETIC[expression["op"]])(right)
+
+
+def apply_filter(frame, step):
+    column = frame[step["column"]]
+    operator, value = step["operator"], step.get("value")
+    if operator == "isnull":
+        mask = column.isna()
+    elif operator == "notnull":
+        mask = column.notna()
+    elif operator in ("in", "not in"):
+        mask = column.isin(value if isinstance(value, list) else [value])
+        mask = ~mask if operator == "not in" else mask
+    elif operator == "contains":
+        mask = column.astype(str).str.contains(str(value), case=False, regex=False)
+    else:
+        mask = getattr(column, {"==": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge"}[operator])(value)
+    return frame[mask]
+
+
+# The numeric columns a describe step covers (all numeric columns by default)
+def describe_columns(frame, step):
+    columns = step.get("columns") or list(frame.columns)
+    numeric = [column for column in columns if pd.api.types.is_numeric_dtype(frame[column]) and not pd.api.types.is_bool_dtype(frame[column])]
+    if not numeric:
+        raise PlanError("'describe' needs at least one numeric column.")
+    return frame[numeric]
+
+
+def apply_step(frame, step, pending_group, resolve_dataset):
+    op = step["op"]
+    if op == "select":
+        return frame[step["columns"]]
+    if op == "filter":
+        return apply_filter(frame, step)
+    if op == "derive":
+        return frame.assign(**{step["name"]: evaluate_expression(step["expression"], frame)})
+    if op == "value_counts":
+        counts = frame.groupby(step["column"], sort=False, dropna=False).size()
+        return counts.sort_values(ascending=False, kind="stable").rename_axis(step["column"]).reset_index(name="count")
+    if op == "describe":
+        return describe_columns(frame, step).describe().rename_axis("statistic").reset_index()
+    if op == "histogram":
+        return out_of_core.histogram_frame(frame[step["column"]], step.get("bins", DEFAULT_BINS))
+    if op == "aggregate":
+        named = {}
+        for aggregation in step["aggregations"]:
+            column, function = aggregation["column"], aggregation["function"]
+            output = aggregation.get("as") or f"{function}_{column}"
+            named[output] = (frame.columns[0] if column == "*" else column, "size" if column == "*" else function)
+        by = pending_group or step.get("by") or []
+        if by:
+            return frame.groupby(by, sort=False, dropna=False, observed=True).agg(**named).reset_index()
+        return pd.DataFrame({output: [len(frame) if function == "size" else frame[column].agg(function)]
+                             for output, (column, function) in named.items()})
+    if op == "sort":
+        return frame.sort_values(step["by"], ascending=step.get("ascending", True), kind="stable")
+    if op == "limit":
+        return frame.head(step["n"])
+    if op == "join":
+        other = resolve_dataset(step["dataset_id"])
+        return frame.merge(other.frame, on=step["on"], how=step.get("how", "inner"))
+    return frame
+
+
+# LRU cache of intermediate frames keyed by (dataset hash, joined dataset hashes, canonical step prefix)
+class IntermediateCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry[0]
+        return None
+
+    def put(self, key, frame):
+        nbytes = int(frame.memory_usage(index=True, deep=False).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = (frame, nbytes)
+            self.total_bytes += nbytes
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted
+
+
+intermediate_cache = IntermediateCache(PLAN_CACHE_ENTRIES, PLAN_CACHE_BYTES)
+
+
+def canonical(steps):
+    return json.dumps(steps, sort_keys=True, separators=(",", ":"), default=str)
+
+
+# A prefix is keyed on the contents of every dataset it reads: the base one
+# and any it joins, so re-uploading either misses instead of serving stale rows
+def prefix_key(dataset, steps, resolve_dataset=None):
+    joined = tuple(joined_hash(step["dataset_id"], resolve_dataset) for step in steps if step["op"] == "join")
+    return dataset.content_hash, joined, hashlib.sha256(canonical(steps).encode()).hexdigest()
+
+
+def joined_hash(dataset_id, resolve_dataset):
+    other = resolve_dataset(dataset_id) if resolve_dataset is not None else None
+    return other.content_hash if other is not None else None
+
+
+# Validate, optimise and run a plan on a registered dataset; returns a DataFrame
+# and raises PlanError for anything malformed or failing
+def execute_plan(plan, dataset, resolve_dataset=None):
+    try:
+        validate_plan(plan, dataset.columns, resolve_dataset)
+        steps = optimize_plan(plan, dataset.columns)
+        with cancellable():
+            return run_steps(steps, dataset, resolve_dataset)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        if isinstance(e, PlanError):
+            raise
+        raise PlanError(f"The query plan could not be run: {e!r}")
+
+
+def run_steps(steps, dataset, resolve_dataset):
+    # Resume from the longest prefix any earlier plan already computed
+    start, frame = 0, None
+    for end in range(len(steps), 0, -1):
+        cached = intermediate_cache.get(prefix_key(dataset, steps[:end], resolve_dataset))
+        if cached is not None:
+            start, frame = end, cached
+            metrics.increment("query_plan.prefix_hits")
+            break
+    end = streaming_prefix(steps)
+    data_cube = cube.cube_for(dataset) if frame is None and end else None
+    if data_cube is not None:
+        frame = answer_from_cube(steps[:end], data_cube)
+        if frame is not None:
+            start = end
+            metrics.increment("cube.hits")
+            intermediate_cache.put(prefix_key(dataset, steps[:end], resolve_dataset), frame)
+    if frame is None and end and out_of_core.exceeds_memory(dataset):
+        try:
+            frame = stream_steps(steps[:end], dataset)
+        except NotImplementedError as e:
+            logging.info(f"Streaming skipped, loading the dataset instead: {e}")
+        else:
+            start = end
+            metrics.increment("out_of_core.plans")
+            intermediate_cache.put(prefix_key(dataset, steps[:end], resolve_dataset), frame)
+    if frame is None:
+        # Leading filters are applied by the reader, skipping row groups they rule out
+        frame, start = load_base(steps, dataset)
+        if start:
+            intermediate_cache.put(prefix_key(dataset, steps[:start], resolve_dataset), frame)
+    pending_group = None
+    for index in range(start, len(steps)):
+        step = steps[index]
+        if step["op"] == "groupby":
+            pending_group = step["by"]
+            continue
+        frame = apply_step(frame, step, pending_group, resolve_dataset)
+        pending_group = None
+        intermediate_cache.put(prefix_key(dataset, steps[:index + 1], resolve_dataset), frame)
+    logging.info(f"Executed query plan ({len(steps)} steps, resumed at step {start}).")
+    return frame.reset_index(drop=True)
+
@@ -0,0 +1,167 @@
+import re
+import pandas as pd
+
+# Local relevance filter. Each dataset gets an inverted index from terms to the
+# columns they refer to: the words of each column name, a few common synonyms
+# and the distinct values of categorical columns. Questions with no hit and no
+# data vocabulary are rejected without a model call; for the rest, the matched
+# columns and values let the prompts carry only what the question is about.
+
+# Categorical columns with more distinct values than this are not indexed by value
+MAX_INDEXED_VALUES = 1000
+
+SYNONYMS = {
+    "revenue": {"sales", "income", "earnings", "turnover"},
+    "sales": {"revenue", "income", "turnover"},
+    "price": {"cost", "amount", "value", "expensive", "cheap"},
+    "cost": {"price", "expense", "spend", "spending"},
+    "quantity": {"qty", "units", "volume", "amount"},
+    "date": {"time", "day", "month", "year", "when", "period"},
+    "time": {"date", "day", "month", "year", "when", "period"},
+    "year": {"annual", "yearly", "years"},
+    "month": {"monthly", "months"},
+    "customer": {"client", "buyer", "user"},
+    "region": {"area", "location", "territory", "state", "country"},
+    "country": {"nation", "region", "location"},
+    "city": {"town", "location"},
+    "category": {"type", "kind", "group", "class", "segment"},
+    "product": {"item", "sku", "goods"},
+    "age": {"old", "young", "older", "younger"},
+    "gender": {"sex", "male", "female"},
+    "salary": {"pay", "wage", "income", "earnings"},
+    "score": {"rating", "grade", "points"},
+    "rating": {"score", "stars", "review"},
+}
+# Words that make a question about the dataset as a whole, including data
+# quality questions that name no column ("are there duplicates?")
+DATASET_TERMS = {
+    "data", "dataset", "table", "file", "csv", "rows", "columns", "records", "fields", "entries",
+    "cells", "values", "summary", "summarize", "summarise", "overview", "describe", "statistics",
+    "stats", "size", "shape", "schema", "dtypes", "types", "missing", "null", "nulls", "nan",
+    "blank", "empty", "duplicates", "duplicated", "dupes", "unique", "distinct", "quality",
+    "outliers", "everything", "correlations",
+}
+# Analysis and chart vocabulary: on-topic enough to leave the decision to the model
+ANALYSIS_TERMS = {
+    "average", "mean", "median", "sum", "total", "count", "distribution", "trend", "correlation",
+    "chart", "plot", "graph", "visualize", "visualise", "histogram", "compare", "comparison",
+    "top", "bottom", "highest", "lowest", "maximum", "minimum", "analysis", "analyze", "analyse",
+    "pattern", "relationship", "breakdown", "percentage", "proportion", "growth",
+}
+STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "for", "by", "and", "or", "is", "are", "was", "were",
+    "be", "me", "my", "i", "you", "your", "it", "its", "this", "that", "what", "which", "who", "how",
+    "why", "when", "where", "can", "could", "would", "should", "do", "does", "did", "show", "give",
+    "tell", "please", "with", "from", "as", "at", "about", "there", "their", "them", "between", "vs",
+    "per", "each", "all", "any", "some", "much", "many", "than", "then", "over", "under", "make",
+}
+
+
+def stem(token):
+    if len(token) > 4 and token.endswith("ies"):
+        return token[:-3] + "y"
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+# Lower-case word tokens, splitting snake_case, kebab-case and camelCase
+def tokenize(text):
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    return [stem(token) for token in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+DATASET_STEMS = {stem(term) for term in DATASET_TERMS}
+ANALYSIS_STEMS = {stem(term) for term in ANALYSIS_TERMS}
+
+
+class RelevanceMatch:
+    def __init__(self, columns, values, dataset_wide, analytical):
+        self.columns = columns  # Matched column names, in dataset order
+        self.values = values  # {column: [matched categorical values]}
+        self.dataset_wide = dataset_wide
+        self.analytical = analytical
+
+    # Clearly off-topic: nothing in the question points at the data
+    @property
+    def irrelevant(self):
+        return not self.columns and not self.dataset_wide and not self.analytical
+
+    # Safe to send only the matched columns: the question is about specific
+    # fields rather than the dataset as a whole
+    @property
+    def focused(self):
+        return bool(self.columns) and not self.dataset_wide
+
+
+class RelevanceIndex:
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.terms = {}  # term -> set of columns
+        self.values = {}  # normalised value phrase -> list of (column, value)
+        self.longest_value = 1  # Words in the longest indexed value phrase
+
+    def add_term(self, term, column):
+        self.terms.setdefault(term, set()).add(column)
+
+    def add_column(self, column, distinct_values=None):
+        for token in tokenize(column):
+            if token in STOPWORDS or token.isdigit():
+                continue
+            self.add_term(token, column)
+            for synonym in SYNONYMS.get(token, ()):
+                self.add_term(stem(synonym), column)
+        for value in distinct_values if distinct_values is not None else ():
+            words = tokenize(value)
+            phrase = " ".join(words)
+            if phrase and not phrase.isdigit():
+                self.values.setdefault(phrase, []).append((column, value))
+                self.longest_value = max(self.longest_value, len(words))
+
+    @classmethod
+    def from_frame(cls, frame):
+        index = cls(frame.columns)
+        for column in frame.columns:
+            series = frame[column]
+            distinct = None
+            if not pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_datetime64_any_dtype(series):
+                unique = series.dropna().unique()
+                if len(unique) <= MAX_INDEXED_VALUES:
+                    distinct = unique
+            index.add_column(column, distinct)
+        return index
+
+    # Index built from a stored table without loading it whole: string columns
+    # report their distinct values one projected column at a time
+    @classmethod
+    def from_table(cls, table):
+        index = cls(table.columns)
+        for column in table.columns:
+            index.add_column(column, table.distinct_values(column, MAX_INDEXED_VALUES))
+        return index
+
+    # Index built from the browser's column list and sample rows when no full
+    # dataset has been registered
+    @classmethod
+    def from_sample(cls, columns, sampleData):
+        return cls.from_frame(pd.DataFrame.from_records(sampleData, columns=columns))
+
+    def match(self, user_query):
+        tokens = tokenize(user_query)
+        matched = set()
+        values = {}
+        for token in tokens:
+            matched.update(self.terms.get(token, ()))
+        # Look up every word n-gram of the question that could be a value phrase
+        for size in range(1, min(self.longest_value, len(tokens)) + 1):
+            for start in range(len(tokens) - size + 1):
+                for column, value in self.values.get(" ".join(tokens[start:start + size]), ()):
+                    matched.add(column)
+                    if value not in values.setdefault(column, []):
+                        values[column].append(value)
+        return RelevanceMatch(
+            [column for column in self.columns if column in matched],
+            values,
+            dataset_wide=any(token in DATASET_STEMS for token in tokens),
+            analytical=any(token in ANALYSIS_STEMS for token in tokens),
+        )
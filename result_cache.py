@@ -0,0 +1,214 @@
+import ast
+import builtins
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+import pandas as pd
+import metrics
+from columnar import ColumnarTable, write_table
+
+# Cache of analysis execution results keyed by (dataset content hash,
+# normalised code hash). Identical or near-identical generated code (same AST
+# up to formatting, comments and local variable names) on the same data reuses
+# the earlier result instead of re-running the pandas work. Small results stay
+# in memory under an LRU byte budget; large frames spill to the columnar store
+# on disk and are memory-mapped back on a hit.
+
+RESULT_CACHE_BYTES = int(os.environ.get("RESULT_CACHE_BYTES", str(256 * 1024 * 1024)))
+RESULT_CACHE_SPILL_BYTES = int(os.environ.get("RESULT_CACHE_SPILL_BYTES", str(8 * 1024 * 1024)))
+RESULT_CACHE_DISK_BYTES = int(os.environ.get("RESULT_CACHE_DISK_BYTES", str(2 * 1024 * 1024 * 1024)))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "analysis-result-cache")
+
+# Names whose meaning comes from the execution namespace and must not be renamed
+RESERVED_NAMES = {"df", "pd", "np"} | set(dir(builtins))
+
+
+# Rename every locally assigned variable to v0, v1, ... in order of first
+# assignment, so `result = ...` and `res = ...` normalise to the same tree
+class LocalNameNormalizer(ast.NodeTransformer):
+    def __init__(self, assigned):
+        self.names = {}
+        for name in assigned:
+            self.names.setdefault(name, f"v{len(self.names)}")
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            node.id = self.names[node.id]
+        return node
+
+
+def assigned_names(tree):
+    return [
+        node.id for node in ast.walk(tree)
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store) and node.id not in RESERVED_NAMES
+    ]
+
+
+def normalize_code(code):
+    tree = ast.parse(code)
+    tree = LocalNameNormalizer(assigned_names(tree)).visit(tree)
+    return ast.dump(tree, annotate_fields=False, include_attributes=False)
+
+
+# Variable summaries renamed between `code`'s own names and the normalised
+# v0, v1, ... its cache key was built from, so code reaching the same entry
+# under other names gets summaries in its own
+def normalize_variables(code, variables):
+    names = LocalNameNormalizer(assigned_names(ast.parse(code))).names
+    return [dict(variable, name=names[variable["name"]]) for variable in variables if variable["name"] in names]
+
+
+def restore_variables(code, variables):
+    names = {normalized: name for name, normalized in LocalNameNormalizer(assigned_names(ast.parse(code))).names.items()}
+    return [dict(variable, name=names[variable["name"]]) for variable in variables if variable["name"] in names]
+
+
+# Returns the cache key, or None if the code does not parse (it will fail anyway)
+def make_key(dataset, code):
+    try:
+        normalized = normalize_code(code)
+    except SyntaxError:
+        return None
+    code_hash = hashlib.sha256(normalized.encode()).hexdigest()
+    return (dataset.content_hash if dataset is not None else "no-dataset", code_hash)
+
+
+def result_nbytes(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=True))
+    return len(str(value))
+
+
+# Stored names of a spilled result's index levels, clear of its own column names
+def index_columns(index_names):
+    return [f"__index_{level}__" for level in range(len(index_names))]
+
+
+def default_index(index):
+    return isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1 and index.name is None
+
+
+class CacheEntry:
+    def __init__(self, dataset_id, value=None, path=None, index_names=None, series=False, nbytes=0, variables=None):
+        self.dataset_id = dataset_id
+        self.variables = variables  # Normalised summaries of the DataFrames and Series the code assigned
+        self.value = value  # In-memory result
+        self.path = path  # Spilled result directory
+        self.index_names = index_names  # Index level names of a spilled result; None for a default index
+        self.series = series  # Whether a spilled result was a Series
+        self.nbytes = nbytes
+
+
+class ResultCache:
+    def __init__(self, memory_budget, spill_threshold, disk_budget, directory):
+        self.memory_budget = memory_budget
+        self.spill_threshold = spill_threshold
+        self.disk_budget = disk_budget
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                metrics.increment("result_cache.misses")
+                return None
+            self.entries.move_to_end(key)
+        metrics.increment("result_cache.hits")
+        if entry.path is None:
+            return entry.value
+        try:
+            frame = ColumnarTable(entry.path).read(mmap=True)
+        except (OSError, ValueError):
+            # Evicted by another request between the lookup and the read
+            return None
+        if entry.index_names is not None:
+            frame = frame.set_index(index_columns(entry.index_names)).rename_axis(entry.index_names)
+        return frame.iloc[:, 0] if entry.series else frame
+
+    # Normalised summaries of the variables the cached code assigned; None when unknown
+    def variables(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry.variables if entry is not None else None
+
+    def put(self, key, dataset_id, value, variables=None):
+        nbytes = result_nbytes(value)
+        if nbytes > self.spill_threshold and isinstance(value, (pd.DataFrame, pd.Series)):
+            entry = self.spill(key, dataset_id, value, nbytes)
+        else:
+            entry = CacheEntry(dataset_id, value=value, nbytes=nbytes)
+        if entry is None or (entry.path is None and nbytes > self.memory_budget):
+            return
+        entry.variables = variables
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = entry
+            if entry.path is None:
+                self.memory_bytes += nbytes
+            else:
+                self.disk_bytes += nbytes
+            self.evict()
+
+    # Each spill gets its own directory: concurrent puts of one key must not
+    # write (or, replacing each other, remove) the same files
+    def spill(self, key, dataset_id, value, nbytes):
+        if nbytes > self.disk_budget:
+            return None
+        path = os.path.join(self.directory, f"{'-'.join(key)}-{uuid.uuid4().hex}")
+        series = isinstance(value, pd.Series)
+        index_names = None
+        try:
+            if series:
+                value = value.to_frame(value.name if value.name is not None else "value")
+            if not default_index(value.index):
+                index_names = list(value.index.names)
+                value = value.rename_axis(index_columns(index_names)).reset_index()
+            write_table(value.reset_index(drop=True), path)
+        except Exception as e:
+            logging.warning(f"Could not spill cached result to disk: {e!r}")
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+        metrics.increment("result_cache.spills")
+        return CacheEntry(dataset_id, path=path, index_names=index_names, series=series, nbytes=nbytes)
+
+    # Least recently used entries go first, separately for memory and disk
+    def evict(self):
+        for key in list(self.entries):
+            if self.memory_bytes <= self.memory_budget and self.disk_bytes <= self.disk_budget:
+                break
+            entry = self.entries[key]
+            over_memory = entry.path is None and self.memory_bytes > self.memory_budget
+            over_disk = entry.path is not None and self.disk_bytes > self.disk_budget
+            if over_memory or over_disk:
+                self.discard(key)
+                metrics.increment("result_cache.evictions")
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.path is None:
+            self.memory_bytes -= entry.nbytes
+        else:
+            self.disk_bytes -= entry.nbytes
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    # Drop everything computed from an earlier version of a dataset
+    def invalidate_dataset(self, dataset_id):
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry.dataset_id == dataset_id]:
+                self.discard(key)
+
+
+result_cache = ResultCache(RESULT_CACHE_BYTES, RESULT_CACHE_SPILL_BYTES, RESULT_CACHE_DISK_BYTES, RESULT_CACHE_DIR)
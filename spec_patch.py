@@ -0,0 +1,135 @@
+import copy
+from column_refs import spec_fields
+
+# Chart refinements ("make the bars red", "log scale the y axis") as RFC 6902
+# JSON Patches against the session's previous Vega-Lite spec. The model only
+# writes the few operations that change, instead of re-emitting the whole
+# spec; the patch is applied and checked here, and anything that does not
+# apply cleanly falls back to generating the chart from scratch.
+
+OPERATIONS = {"add", "remove", "replace", "move", "copy", "test"}
+# Top-level keys a patched spec must still have one of
+VIEW_KEYS = {"mark", "layer", "concat", "hconcat", "vconcat", "facet", "repeat"}
+# Rows of the previous chart's data shown to the model
+PROMPT_DATA_ROWS = 3
+
+
+class PatchError(ValueError):
+    pass
+
+
+# RFC 6901 pointer ("/encoding/y/scale") as a list of reference tokens
+def parse_pointer(pointer):
+    if not isinstance(pointer, str) or (pointer and not pointer.startswith("/")):
+        raise PatchError(f"Invalid JSON pointer: {pointer!r}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer.split("/")[1:]]
+
+
+def list_index(container, token, appending=False):
+    if appending and token == "-":
+        return len(container)
+    if not token.isdigit() or (token != "0" and token.startswith("0")):
+        raise PatchError(f"Invalid array index: {token!r}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not appending):
+        raise PatchError(f"Array index out of range: {index}")
+    return index
+
+
+# The container holding the pointer's target and the target's key or index
+def resolve(document, tokens, appending=False):
+    if not tokens:
+        raise PatchError("Operations on the whole spec are not supported.")
+    parent = document
+    for token in tokens[:-1]:
+        if isinstance(parent, dict) and token in parent:
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[list_index(parent, token)]
+        else:
+            raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+    token = tokens[-1]
+    if isinstance(parent, list):
+        return parent, list_index(parent, token, appending)
+    if not isinstance(parent, dict):
+        raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+    if not appending and token not in parent:
+        raise PatchError(f"Path not found: /{'/'.join(tokens)}")
+    return parent, token
+
+
+def get_value(document, tokens):
+    parent, key = resolve(document, tokens)
+    return parent[key]
+
+
+def add_value(document, tokens, value):
+    parent, key = resolve(document, tokens, appending=True)
+    if isinstance(parent, list):
+        parent.insert(key, value)
+    else:
+        parent[key] = value
+
+
+def remove_value(document, tokens):
+    parent, key = resolve(document, tokens)
+    return parent.pop(key)
+
+
+# Apply a JSON Patch to a copy of `document`; raises PatchError on any
+# malformed or failing operation, leaving the document untouched
+def apply_patch(document, patch):
+    if not isinstance(patch, list):
+        raise PatchError("A patch must be a list of operations.")
+    document = copy.deepcopy(document)
+    for operation in patch:
+        if not isinstance(operation, dict) or operation.get("op") not in OPERATIONS:
+            raise PatchError(f"Invalid patch operation: {operation!r}")
+        op, path = operation["op"], parse_pointer(operation.get("path"))
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise PatchError(f"'{op}' needs a value.")
+        if op == "add":
+            add_value(document, path, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            remove_value(document, path)
+        elif op == "replace":
+            parent, key = resolve(document, path)
+            parent[key] = copy.deepcopy(operation["value"])
+        elif op == "test":
+            if get_value(document, path) != operation["value"]:
+                raise PatchError(f"Test failed at {operation['path']}")
+        else:
+            source = parse_pointer(operation.get("from"))
+            if op == "move" and path[:len(source)] == source:
+                raise PatchError("Cannot move a value into itself.")
+            value = remove_value(document, source) if op == "move" else copy.deepcopy(get_value(document, source))
+            add_value(document, path, value)
+    return document
+
+
+# The spec as shown to the model: its data cut down to a few example rows
+def prompt_spec(spec):
+    data = spec.get("data")
+    if isinstance(data, dict) and isinstance(data.get("values"), list):
+        spec = dict(spec, data=dict(data, values=data["values"][:PROMPT_DATA_ROWS]))
+    return spec
+
+
+# Patch the previous chart and check the result is still a chart over fields
+# that exist: in its data rows or among `columns` (the dataset's, which the
+# chart can be re-bound to). The data itself may not be patched.
+def patch_spec(spec, patch, columns=()):
+    if any(isinstance(operation, dict) and str(operation.get(key, "")).split("/")[:2] == ["", "data"] for operation in patch or [] for key in ("path", "from")):
+        raise PatchError("Patches may not change the chart's data.")
+    patched = apply_patch(spec, patch)
+    if not VIEW_KEYS & set(patched) or not isinstance(patched.get("encoding", {}), dict):
+        raise PatchError("The patched spec is not a Vega-Lite view.")
+    found = spec_fields(patched)
+    if found is not None:
+        referenced, created = found
+        values = (patched.get("data") or {}).get("values")
+        known = set(columns) | (set(values[0]) if isinstance(values, list) and values and isinstance(values[0], dict) else set())
+        unknown = referenced - created - known
+        if unknown:
+            raise PatchError(f"The patched spec uses unknown fields: {sorted(unknown)}")
+    return patched
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import metrics
+from llm import estimate_tokens
+
+# Speculative generation starts the chart or analysis call at the same moment as
+# the routing call whenever a cheap local prior is confident about the outcome.
+# The routing decision is still authoritative: a wrong guess is cancelled and
+# its tokens are charged to the speculation budget as waste.
+
+SPECULATIVE_GENERATION = os.environ.get("SPECULATIVE_GENERATION", "0") == "1"
+# Minimum prior confidence before a speculative call is started
+SPECULATION_MIN_CONFIDENCE = float(os.environ.get("SPECULATION_MIN_CONFIDENCE", "0.7"))
+# Tokens that speculative calls may consume per rolling minute
+SPECULATION_TOKEN_BUDGET = int(os.environ.get("SPECULATION_TOKEN_BUDGET", "20000"))
+# Output tokens reserved per speculative call on top of its prompt
+SPECULATION_EXPECTED_OUTPUT = 600
+
+CHART_KEYWORDS = {
+    "chart", "plot", "graph", "visualize", "visualise", "visualization", "bar", "bars",
+    "scatter", "histogram", "line", "pie", "heatmap", "draw", "show",
+}
+ANALYSIS_KEYWORDS = {
+    "average", "mean", "median", "sum", "total", "count", "how", "many", "what", "which",
+    "top", "max", "maximum", "min", "minimum", "correlation", "percentage", "ratio", "calculate",
+    "compute", "std", "variance", "summary", "statistics",
+}
+
+
+# Local prior over the router's answer: returns ("chart" | "analysis" | None, confidence)
+def guess_request_type(user_query):
+    words = re.findall(r"[a-z]+", user_query.lower())
+    chart_hits = sum(word in CHART_KEYWORDS for word in words)
+    analysis_hits = sum(word in ANALYSIS_KEYWORDS for word in words)
+    if not chart_hits and not analysis_hits:
+        return None, 0.0
+    # Laplace-smoothed share of the winning side, so one keyword alone is never certain
+    if chart_hits >= analysis_hits:
+        return "chart", (chart_hits + 1) / (chart_hits + analysis_hits + 2)
+    return "analysis", (analysis_hits + 1) / (chart_hits + analysis_hits + 2)
+
+
+# Rolling one-minute token allowance shared by all speculative calls
+class SpeculationBudget:
+    def __init__(self, tokens_per_minute):
+        self.tokens_per_minute = tokens_per_minute
+        self.reservations = []
+        self.lock = threading.Lock()
+
+    def try_reserve(self, tokens):
+        with self.lock:
+            cutoff = time.monotonic() - 60
+            self.reservations = [(at, spent) for at, spent in self.reservations if at >= cutoff]
+            if sum(spent for _, spent in self.reservations) + tokens > self.tokens_per_minute:
+                return False
+            self.reservations.append((time.monotonic(), tokens))
+            return True
+
+
+budget = SpeculationBudget(SPECULATION_TOKEN_BUDGET)
+
+
+# A generation call started before routing resolved
+class Speculation:
+    def __init__(self, request_type, task, usage):
+        self.request_type = request_type
+        self.task = task
+        self.usage = usage
+        self.started_at = time.monotonic()
+        self.resolved = False
+        task.add_done_callback(lambda _: metrics.increment("speculation.tokens_total", self.tokens()))
+
+    def tokens(self):
+        return self.usage.get("prompt_tokens", 0) + self.usage.get("completion_tokens", 0)
+
+    # Routing agreed with the guess: the generation head start is latency saved
+    def accept(self):
+        self.resolved = True
+        saved = time.monotonic() - self.started_at
+        metrics.increment("speculation.hits")
+        metrics.observe("speculation.latency_saved_seconds", saved)
+        logging.info(f"Speculative {self.request_type} generation accepted, saved {saved:.2f}s.")
+        return self.task
+
+    # Routing disagreed (or gave up): cancel the call and account for its tokens
+    async def reject(self):
+        self.resolved = True
+        self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, Exception):
+            pass
+        metrics.increment("speculation.misses")
+        metrics.increment("speculation.tokens_wasted", self.tokens())
+        logging.info(f"Speculative {self.request_type} generation cancelled after {self.tokens()} tokens.")
+
+
+# Start the generator for the guessed type speculatively if the prior is
+# confident and the budget allows it; returns a Speculation or None
+def start_speculation(user_query, prompt, generators):
+    request_type, confidence = guess_request_type(user_query)
+    if request_type not in generators or confidence < SPECULATION_MIN_CONFIDENCE:
+        return None
+    if not budget.try_reserve(estimate_tokens(prompt) + SPECULATION_EXPECTED_OUTPUT):
+        metrics.increment("speculation.budget_denied")
+        return None
+    usage = {}
+    task = asyncio.create_task(generators[request_type](usage))
+    metrics.increment("speculation.started")
+    return Speculation(request_type, task, usage)
+
+
+# Waste ratio and latency saved, derived from the raw counters
+def speculation_report():
+    total = metrics.get("speculation.tokens_total")
+    wasted = metrics.get("speculation.tokens_wasted")
+    return {
+        "started": metrics.get("speculation.started"),
+        "hits": metrics.get("speculation.hits"),
+        "misses": metrics.get("speculation.misses"),
+        "budget_denied": metrics.get("speculation.budget_denied"),
+        "waste_ratio": wasted / total if total else 0.0,
+        "latency_saved_seconds_mean": metrics.mean("speculation.latency_saved_seconds"),
+    }
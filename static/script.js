@@ -10,6 +10,16 @@ document.getElementById('user-input').addEventListener('keydown', function (even
 const dropArea = document.getElementById('dropArea');
 const fileInput = document.getElementById('fileInput');
 let parsedData = null;
+let datasetId = null;
+// Identifies this page's conversation, so the server keeps its variables across questions
+const sessionId = crypto.randomUUID();
+
+// Files above this size are uploaded in chunks and parsed on the server
+const LARGE_FILE_BYTES = 20 * 1024 * 1024;
+// Bytes read locally from a large file to preview it and sample its rows
+const PREVIEW_BYTES = 256 * 1024;
+// Formats only the server reads; their preview rows come back with the upload status
+const SERVER_FORMATS = ['tsv', 'jsonl', 'ndjson', 'xlsx', 'parquet', 'pq', 'feather', 'arrow', 'ipc'];
 
 // Drag-and-drop handling
 dropArea.addEventListener('dragover', (e) => {
@@ -33,8 +43,15 @@ fileInput.addEventListener('change', (e) => {
 });
 
 function handleFileUpload(file) {
-    if (file.type !== 'text/csv') {
-        alert('Please upload a valid CSV file.');
+    const extension = file.name.split('.').pop().toLowerCase();
+    const isCsv = file.type === 'text/csv' || extension === 'csv';
+    if (!isCsv && !SERVER_FORMATS.includes(extension)) {
+        alert('Please upload a CSV, TSV, JSON Lines, Excel, Parquet or Feather file.');
+        return;
+    }
+
+    if (!isCsv || file.size > LARGE_FILE_BYTES) {
+        uploadToServer(file, isCsv);
         return;
     }
 
@@ -43,10 +60,111 @@ function handleFileUpload(file) {
         const csvData = event.target.result;
         parsedData = d3.csvParse(csvData, d3.autoType);
         showDataPreview(parsedData);
+        registerDataset(parsedData);
     };
     reader.readAsText(file);
 }
 
+// Register the full dataset with the backend so analyses can run on every row
+function registerDataset(rows) {
+    datasetId = null;
+    fetch('http://127.0.0.1:8000/datasets', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ rows: rows }),
+    })
+    .then(response => response.json())
+    .then(data => {
+        datasetId = data.dataset_id;
+    })
+    .catch((error) => {
+        console.error('Error registering dataset:', error);
+    });
+}
+
+// Large CSVs and the other formats: upload the raw file in resumable chunks
+// and let the server parse it, reporting progress as it goes. CSVs are
+// previewed locally straight away; other formats once the server has read them.
+async function uploadToServer(file, isCsv) {
+    datasetId = null;
+    parsedData = null;
+    if (isCsv) {
+        const head = await file.slice(0, PREVIEW_BYTES).text();
+        const lines = head.split('\n');
+        lines.pop();  // The last line is probably cut off
+        parsedData = d3.csvParse(lines.join('\n'), d3.autoType);
+        showDataPreview(parsedData.slice(0, 15));
+    }
+
+    const progressMessage = addLoadingMessage('Uploading the dataset...');
+    const setProgress = (text) => { progressMessage.querySelector('p').textContent = text; };
+    try {
+        let status = await postJson('http://127.0.0.1:8000/uploads', { filename: file.name, size: file.size });
+        if (!status.upload_id) throw new Error(status.detail);
+        const uploadUrl = `http://127.0.0.1:8000/uploads/${status.upload_id}`;
+        let offset = 0;
+        let failures = 0;
+        while (offset < file.size) {
+            try {
+                const response = await fetch(`${uploadUrl}?offset=${offset}`, {
+                    method: 'PUT',
+                    body: file.slice(offset, offset + status.chunk_size),
+                });
+                const data = await response.json();
+                if (response.ok) {
+                    offset = data.received;
+                } else if (response.status === 409) {
+                    offset = data.detail.received;  // Resume from what the server has
+                } else {
+                    throw new Error(data.detail || response.statusText);
+                }
+                failures = 0;
+            } catch (error) {
+                // Network hiccup: ask the server how far it got and carry on from there
+                if (++failures > 5) throw error;
+                await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+                offset = (await (await fetch(uploadUrl)).json()).received;
+            }
+            setProgress(`Uploading the dataset... ${Math.floor(100 * offset / file.size)}%`);
+        }
+
+        status = await postJson(`${uploadUrl}/complete`, {});
+        while (status.state === 'parsing') {
+            setProgress(`Reading the dataset... ${Math.floor(100 * status.progress)}% (${status.rows_parsed.toLocaleString()} rows)`);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            status = await (await fetch(uploadUrl)).json();
+        }
+        removeMessage(progressMessage);
+        if (status.state === 'ready') {
+            datasetId = status.dataset_id;
+            if (!parsedData && status.sample.length) {
+                parsedData = status.sample;
+                showDataPreview(parsedData);
+            }
+            addMessage('bot', `The dataset is ready: ${status.rows_parsed.toLocaleString()} rows.`);
+        } else {
+            addMessage('bot', `The dataset could not be read: ${status.error}`);
+        }
+    } catch (error) {
+        console.error('Error uploading dataset:', error);
+        removeMessage(progressMessage);
+        addMessage('bot', 'The dataset upload failed. Please try again.');
+    }
+}
+
+async function postJson(url, body) {
+    const response = await fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: JSON.stringify(body),
+    });
+    return response.json();
+}
+
 // Show preview of the CSV data
 function showDataPreview(data) {
     const previewData = data;  // Show first 5 rows
@@ -73,8 +191,8 @@ function sendMessage() {
         if (parsedData) {
             const loadingMessageId = addLoadingMessage("Working on it, this may take a few seconds...");
 
-            // Send user input and dataset info to the backend
-            fetch('http://127.0.0.1:8000/query', {
+            // Send user input and dataset info to the backend and render each stage as it streams in
+            fetch('http://127.0.0.1:8000/query/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
@@ -84,37 +202,18 @@ function sendMessage() {
                     columns: Object.keys(parsedData[0]),
                     dataTypes: getDataTypes(parsedData[0]),
                     FullData: parsedData.slice(0, 15),  // Send first 15 rows as sample data
+                    dataset_id: datasetId,
+                    session_id: sessionId,
                 }),
             })
-            .then(response => response.json())
-            .then(data => {
-                removeMessage(loadingMessageId);
-
-                // Log the response from OpenAI to understand its "thinking process"
-                console.log("OpenAI Response:", data);
-
-
-                if (data.description) {
-                    addMessage('bot', data.description);
-                }
-                
-                // Check for the different types of responses
-                if (data.vega_spec) {
-                    addMessage('bot', "Here's the chart based on your request:", data.vega_spec);
-                }
-                
-                if (data.analysis_result.startsWith("<table")) {
-                    // If the response is HTML (like a table), render it using innerHTML
-                    addMessage('bot', `Here is the analysis result: ${data.analysis_result}`, null, true);
-                } else {
-                    // If it's plain text, display it as text content
-                    addMessage('bot', `Here is the analysis result:\n${data.analysis_result}`);
-                }
-                
-
-                if (!data.vega_spec && !data.analysis_result && !data.description) {
-                    addMessage('bot', 'Your question does not seem to be related to the uploaded dataset.');
+            .then(response => {
+                if (response.status === 429) {
+                    // Shed under load: nothing was started, so just ask to come back
+                    removeMessage(loadingMessageId);
+                    addMessage('bot', `The server is busy right now. Please try again in ${response.headers.get('Retry-After') || 'a few'} seconds.`);
+                    return;
                 }
+                return readEventStream(response, (event, data) => handleStreamEvent(event, data, loadingMessageId));
             })
             .catch((error) => {
                 removeMessage(loadingMessageId);
@@ -131,6 +230,99 @@ function sendMessage() {
     }
 }
 
+// Read a Server-Sent Events response body and call onEvent for every frame
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) {
+            break;
+        }
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            let event = 'message';
+            let data = '';
+            frame.split('\n').forEach(line => {
+                if (line.startsWith('event: ')) {
+                    event = line.slice(7);
+                } else if (line.startsWith('data: ')) {
+                    data += line.slice(6);
+                }
+            });
+            onEvent(event, data ? JSON.parse(data) : null);
+        }
+    }
+}
+
+// Render one pipeline stage as soon as the backend reports it
+function handleStreamEvent(event, data, loadingMessageId) {
+    // Log the streamed events to understand the assistant's "thinking process"
+    console.log("Stream event:", event, data);
+
+    if (event === 'route') {
+        const stage = { chart: 'Generating the chart...', analysis: 'Running the analysis...', both: 'Generating the chart and analysis...', dashboard: 'Building the dashboard...', tasks: 'Working through the steps...' }[data.type];
+        if (stage) {
+            loadingMessageId.querySelector('p').textContent = stage;
+        }
+    } else if (event === 'deadline') {
+        loadingMessageId.querySelector('p').textContent = 'Running out of time, preparing a quick answer...';
+    } else if (event === 'description') {
+        addMessage('bot', data.description);
+    } else if (event === 'spec') {
+        addMessage('bot', "Here's the chart based on your request:", data.vega_spec);
+    } else if (event === 'panel' || event === 'task') {
+        // Dashboard panels and the steps of a split question arrive one by one, in whatever order they finish
+        if (data.error) {
+            addMessage('bot', `${data.title}: ${data.error}`);
+        } else if (data.vega_spec) {
+            addMessage('bot', data.title, data.vega_spec);
+        } else {
+            addTitledMessage(data.title, data.analysis_result);
+        }
+    } else if (event === 'result') {
+        const analysisResult = String(data.analysis_result);
+        const label = data.approximate
+            ? `Approximate result (from a ${data.sample_rows.toLocaleString()}-row sample; *_error columns are 95% bounds), the exact one follows:`
+            : 'Here is the analysis result:';
+        // The exact result replaces the estimate streamed before it
+        if (loadingMessageId.estimate) {
+            loadingMessageId.estimate.remove();
+            loadingMessageId.estimate = null;
+        }
+        let message;
+        if (analysisResult.startsWith("<table")) {
+            // If the response is HTML (like a table), render it using innerHTML
+            message = addMessage('bot', `${label} ${analysisResult}`, null, true);
+        } else {
+            // If it's plain text, display it as text content
+            message = addMessage('bot', `${label}\n${analysisResult}`);
+        }
+        if (data.approximate) {
+            loadingMessageId.estimate = message;
+        }
+    } else if (event === 'done') {
+        removeMessage(loadingMessageId);
+        if (data.type === 'none') {
+            addMessage('bot', data.description || 'Your question does not seem to be related to the uploaded dataset.');
+        } else if (data.degraded) {
+            // Best-effort answers are only sent with the final event
+            if (data.vega_spec) {
+                addMessage('bot', data.description, data.vega_spec);
+            } else if (data.analysis_result) {
+                addTitledMessage(data.description, data.analysis_result);
+            }
+        }
+    } else if (event === 'error') {
+        removeMessage(loadingMessageId);
+        addMessage('bot', data.detail || 'Your question does not seem to be related to the uploaded dataset.');
+    }
+}
+
 function clearMessages() {
     const chatHistory = document.getElementById('chat-history');
     while (chatHistory.firstChild) {
@@ -226,6 +418,16 @@ function addMessage(sender, text, chartSpec = null, isHTML = false) {
 
     chatHistory.appendChild(messageElement);
     chatHistory.scrollTop = chatHistory.scrollHeight;
+    return messageElement;
+}
+
+// A result table under a title written by the model: only the table (rendered by the server) goes in as HTML
+function addTitledMessage(title, resultHTML) {
+    const messageElement = addMessage('bot', resultHTML, null, true);
+    const titleElement = document.createElement('p');
+    titleElement.textContent = title;
+    messageElement.querySelector('.message-content').prepend(titleElement);
+    return messageElement;
 }
 
 
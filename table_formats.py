@@ -0,0 +1,93 @@
+import os
+from columnar import META_FILE, ColumnarTable
+
+try:
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet and Arrow uploads need pyarrow; CSV does not
+    ds = None
+
+HAVE_PYARROW = ds is not None
+
+# Uploaded Parquet and Arrow/Feather files are already columnar, so they are
+# registered as-is instead of being converted to the .npy store. A table
+# directory holds either the .npy layout or one of these files; open_table()
+# picks the reader. Both readers share the same interface (columns, num_rows,
+# column_nbytes, schema, distinct_values, read, iter_chunks), and Arrow reads
+# push column projections and row filters down into the file, skipping row
+# groups whose statistics rule the filter out.
+
+ARROW_FILES = {"parquet": "data.parquet", "ipc": "data.arrow"}
+
+
+class ArrowFileTable:
+    def __init__(self, path, file_format):
+        self.path = path
+        self.format = file_format
+        self.file = os.path.join(path, ARROW_FILES[file_format])
+        self.dataset = ds.dataset(self.file, format=file_format)
+        self._num_rows = None
+
+    @property
+    def columns(self):
+        return list(self.dataset.schema.names)
+
+    @property
+    def num_rows(self):
+        if self._num_rows is None:
+            self._num_rows = self.dataset.count_rows()
+        return self._num_rows
+
+    # Compressed size per column for Parquet (from the footer), in-memory size for Arrow
+    def column_nbytes(self):
+        sizes = dict.fromkeys(self.columns, 0)
+        if self.format == "parquet":
+            metadata = pq.ParquetFile(self.file).metadata
+            for group in range(metadata.num_row_groups):
+                row_group = metadata.row_group(group)
+                for index in range(row_group.num_columns):
+                    column = row_group.column(index)
+                    name = column.path_in_schema.split(".")[0]
+                    if name in sizes:
+                        sizes[name] += column.total_compressed_size
+            return sizes
+        for name in self.columns:
+            sizes[name] = self.dataset.to_table(columns=[name]).column(0).nbytes
+        return sizes
+
+    # Logical pandas dtype of each column, as to_pandas() would produce it;
+    # dictionary-encoded strings are plain strings to generated code
+    def schema(self):
+        dtypes = self.dataset.schema.empty_table().to_pandas().dtypes
+        return {name: "object" if str(dtype) == "category" else str(dtype) for name, dtype in dtypes.items()}
+
+    def distinct_values(self, name, limit):
+        field = self.dataset.schema.field(name)
+        value_type = field.type.value_type if hasattr(field.type, "value_type") else field.type
+        if str(value_type) not in ("string", "large_string"):
+            return None
+        unique = pc.unique(self.dataset.to_table(columns=[name]).column(0).combine_chunks()).drop_null()
+        return unique.to_pylist() if len(unique) <= limit else None
+
+    def expression(self, filters):
+        return pq.filters_to_expression([tuple(condition) for condition in filters]) if filters else None
+
+    def iter_chunks(self, columns=None, mmap=True, filters=None):
+        for batch in self.dataset.to_batches(columns=columns, filter=self.expression(filters)):
+            yield batch.to_pandas()
+
+    # Read the whole table, or only the requested columns and matching rows
+    def read(self, columns=None, mmap=True, filters=None):
+        return self.dataset.to_table(columns=columns, filter=self.expression(filters)).to_pandas()
+
+
+def open_table(path):
+    for file_format, name in ARROW_FILES.items():
+        if os.path.exists(os.path.join(path, name)):
+            if not HAVE_PYARROW:
+                raise RuntimeError(f"Reading {name} needs pyarrow, which is not installed.")
+            return ArrowFileTable(path, file_format)
+    if os.path.exists(os.path.join(path, META_FILE)):
+        return ColumnarTable(path)
+    raise FileNotFoundError(f"No table found in {path}.")
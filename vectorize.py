@@ -0,0 +1,398 @@
+import ast
+import logging
+import pandas as pd
+
+# Pre-execution pass over generated analysis code. The model regularly writes
+# row-at-a-time pandas (iterrows loops, apply(lambda ..., axis=1), per-value
+# boolean filters inside loops, chains of == comparisons) that is fine on a
+# 15-row sample but takes minutes on a real dataset. Safe cases are rewritten
+# into vectorised equivalents; the rest are reported as warnings.
+
+BINARY_OPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+COMPARE_OPS = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+FRAME_ATTRIBUTES = set(dir(pd.DataFrame)) | set(dir(pd.Series))
+
+
+def name(identifier):
+    return ast.Name(id=identifier, ctx=ast.Load())
+
+
+def attribute_call(receiver, method, args=(), keywords=()):
+    return ast.Call(func=ast.Attribute(value=receiver, attr=method, ctx=ast.Load()), args=list(args), keywords=list(keywords))
+
+
+def same(a, b):
+    return ast.dump(a) == ast.dump(b)
+
+
+# Receivers we are willing to repeat in the rewritten code: df, df['col'], df.col
+def is_simple_receiver(node):
+    if isinstance(node, ast.Name):
+        return True
+    if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name):
+        return isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str)
+    return isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name)
+
+
+def column_of(node):
+    if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Constant) and isinstance(node.slice.value, str):
+        return node.value, node.slice.value
+    if isinstance(node, ast.Attribute) and node.attr not in FRAME_ATTRIBUTES:
+        return node.value, node.attr
+    return None, None
+
+
+def is_boolean(node):
+    return isinstance(node, (ast.Compare, ast.BoolOp)) or (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not))
+
+
+def uses_name(nodes, identifier):
+    return any(isinstance(node, ast.Name) and node.id == identifier for tree in nodes for node in ast.walk(tree))
+
+
+# Translate an element-wise expression over `var` into a whole-column expression.
+# In row mode `var` is a DataFrame row and var['col'] becomes frame['col'];
+# in element mode `var` is a Series element and becomes the Series itself.
+# Returns None when the expression cannot be vectorised safely.
+class ExpressionVectorizer:
+    def __init__(self, var, source, row_mode):
+        self.var = var
+        self.source = source
+        self.row_mode = row_mode
+        self.touched = False
+
+    def translate(self, node):
+        result = self.visit(node)
+        return result if self.touched else None
+
+    def visit(self, node):
+        if not uses_name([node], self.var):
+            return node  # A scalar from the surrounding code broadcasts
+        if isinstance(node, ast.Name):
+            if self.row_mode:
+                return None
+            self.touched = True
+            return self.source
+        if isinstance(node, ast.Constant):
+            return node
+        if isinstance(node, (ast.Subscript, ast.Attribute)):
+            owner, column = column_of(node)
+            if self.row_mode and isinstance(owner, ast.Name) and owner.id == self.var and column is not None:
+                self.touched = True
+                return ast.Subscript(value=self.source, slice=ast.Constant(value=column), ctx=ast.Load())
+            return None
+        if isinstance(node, ast.BinOp) and isinstance(node.op, BINARY_OPS):
+            left, right = self.visit(node.left), self.visit(node.right)
+            return None if left is None or right is None else ast.BinOp(left=left, op=node.op, right=right)
+        if isinstance(node, ast.UnaryOp):
+            operand = self.visit(node.operand)
+            if operand is None:
+                return None
+            if isinstance(node.op, ast.Not):
+                return ast.UnaryOp(op=ast.Invert(), operand=operand) if is_boolean(node.operand) else None
+            return ast.UnaryOp(op=node.op, operand=operand) if isinstance(node.op, (ast.USub, ast.UAdd)) else None
+        if isinstance(node, ast.Compare) and len(node.ops) == 1:
+            left = self.visit(node.left)
+            comparator = node.comparators[0]
+            if left is None:
+                return None
+            if isinstance(node.ops[0], (ast.In, ast.NotIn)) and isinstance(comparator, (ast.List, ast.Tuple, ast.Set)):
+                if not all(isinstance(item, ast.Constant) for item in comparator.elts):
+                    return None
+                isin = attribute_call(left, "isin", [ast.List(elts=comparator.elts, ctx=ast.Load())])
+                return ast.UnaryOp(op=ast.Invert(), operand=isin) if isinstance(node.ops[0], ast.NotIn) else isin
+            right = self.visit(comparator)
+            if right is None or not isinstance(node.ops[0], COMPARE_OPS):
+                return None
+            return ast.Compare(left=left, ops=node.ops, comparators=[right])
+        if isinstance(node, ast.BoolOp) and all(is_boolean(value) for value in node.values):
+            values = [self.visit(value) for value in node.values]
+            if any(value is None for value in values):
+                return None
+            op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+            combined = values[0]
+            for value in values[1:]:
+                combined = ast.BinOp(left=combined, op=op, right=value)
+            return combined
+        if isinstance(node, ast.IfExp) and is_boolean(node.test):
+            # np.where turns None into NaN and strings into a numpy string array
+            if any(isinstance(branch, ast.Constant) and (branch.value is None or isinstance(branch.value, str)) for branch in (node.body, node.orelse)):
+                return None
+            parts = [self.visit(part) for part in (node.test, node.body, node.orelse)]
+            if any(part is None for part in parts):
+                return None
+            index = ast.Attribute(value=self.frame(), attr="index", ctx=ast.Load())
+            where = attribute_call(name("np"), "where", parts)
+            return attribute_call(name("pd"), "Series", [where], [ast.keyword(arg="index", value=index)])
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in ("abs", "round") and not node.keywords:
+            args = [self.visit(arg) for arg in node.args]
+            if not args or any(arg is None for arg in args):
+                return None
+            if node.func.id == "abs" and len(args) == 1:
+                return attribute_call(args[0], "abs")
+            if node.func.id == "round" and len(args) <= 2 and all(isinstance(arg, ast.Constant) for arg in node.args[1:]):
+                return attribute_call(args[0], "round", args[1:])
+        return None
+
+    # The frame whose index a np.where result must keep
+    def frame(self):
+        if self.row_mode:
+            return self.source
+        owner, _ = column_of(self.source)
+        return owner if owner is not None else self.source
+
+
+class Vectorizer(ast.NodeTransformer):
+    def __init__(self):
+        self.rewrites = []
+        self.warnings = []
+        # Names bound by the enclosing lambdas, loops and comprehensions: rows
+        # or scalar values, never whole frames
+        self.bound = []
+
+    def note(self, node, message):
+        self.rewrites.append(f"line {getattr(node, 'lineno', '?')}: {message}")
+
+    # frame.apply(lambda row: ..., axis=1) and series.apply/map(lambda x: ...)
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if not (isinstance(func, ast.Attribute) and func.attr in ("apply", "map") and is_simple_receiver(func.value)):
+            return node
+        if len(node.args) != 1 or not isinstance(node.args[0], ast.Lambda):
+            return node
+        function = node.args[0]
+        if len(function.args.args) != 1 or function.args.vararg or function.args.kwarg:
+            return node
+        keywords = {keyword.arg: keyword.value for keyword in node.keywords}
+        row_mode = "axis" in keywords
+        if row_mode and not (isinstance(keywords["axis"], ast.Constant) and keywords["axis"].value in (1, "columns")):
+            return node
+        if set(keywords) - {"axis"}:
+            return node
+        var = function.args.args[0].arg
+        body = function.body
+        # series.apply(lambda x: mapping[x]) is a dictionary lookup per element
+        if not row_mode and isinstance(body, ast.Subscript) and isinstance(body.value, (ast.Name, ast.Dict)) \
+                and isinstance(body.slice, ast.Name) and body.slice.id == var:
+            self.note(node, f"{func.attr}(lambda {var}: mapping[{var}]) -> map(mapping)")
+            return attribute_call(func.value, "map", [body.value])
+        vectorized = ExpressionVectorizer(var, func.value, row_mode).translate(body)
+        if vectorized is None:
+            if row_mode:
+                self.warnings.append(f"line {node.lineno}: row-wise apply(..., axis=1) could not be vectorised safely")
+            return node
+        kind = "row-wise apply(axis=1)" if row_mode else f"element-wise {func.attr}(lambda)"
+        self.note(node, f"{kind} -> column expression")
+        return vectorized
+
+    def visit_bound(self, node, targets):
+        names = [target.id for tree in targets for target in ast.walk(tree) if isinstance(target, ast.Name)]
+        self.bound.extend(names)
+        try:
+            return self.generic_visit(node)
+        finally:
+            del self.bound[len(self.bound) - len(names):]
+
+    def visit_Lambda(self, node):
+        arguments = node.args.posonlyargs + node.args.args + node.args.kwonlyargs + [node.args.vararg, node.args.kwarg]
+        names = [ast.Name(id=argument.arg, ctx=ast.Store()) for argument in arguments if argument is not None]
+        return self.visit_bound(node, names)
+
+    def visit_For(self, node):
+        return self.visit_bound(node, [node.target])
+
+    def visit_comprehensions(self, node):
+        return self.visit_bound(node, [generator.target for generator in node.generators])
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_comprehensions
+
+    # (df['s'] == a) | (df['s'] == b) | ... -> df['s'].isin([a, b, ...]), for
+    # columns of a frame only: on a row's value the comparisons are scalars
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.BitOr):
+            return node
+        operands = []
+
+        def collect(part):
+            if isinstance(part, ast.BinOp) and isinstance(part.op, ast.BitOr):
+                return collect(part.left) and collect(part.right)
+            operands.append(part)
+            return True
+
+        collect(node)
+        if len(operands) < 2:
+            return node
+        left = None
+        values = []
+        for operand in operands:
+            if not (isinstance(operand, ast.Compare) and len(operand.ops) == 1 and isinstance(operand.ops[0], ast.Eq)):
+                return node
+            owner, _ = column_of(operand.left)
+            if not isinstance(operand.comparators[0], ast.Constant) or not isinstance(owner, ast.Name) or owner.id in self.bound:
+                return node
+            if left is not None and not same(left, operand.left):
+                return node
+            left = operand.left
+            values.append(operand.comparators[0])
+        self.note(node, "chained == comparisons -> isin")
+        return attribute_call(left, "isin", [ast.List(elts=values, ctx=ast.Load())])
+
+    def generic_visit(self, node):
+        super().generic_visit(node)
+        for field in ("body", "orelse", "finalbody"):
+            statements = getattr(node, field, None)
+            if isinstance(statements, list) and statements and isinstance(statements[0], ast.stmt):
+                setattr(node, field, self.rewrite_block(statements))
+        return node
+
+    def rewrite_block(self, statements):
+        result = []
+        index = 0
+        while index < len(statements):
+            statement = statements[index]
+            following = statements[index + 1] if index + 1 < len(statements) else None
+            if following is not None:
+                replaced = self.rewrite_accumulator(statement, following)
+                if replaced is not None:
+                    result.append(replaced)
+                    index += 2
+                    continue
+            if isinstance(statement, ast.For):
+                statement = self.rewrite_filter_loop(statement)
+                self.warn_loop(statement)
+            result.append(statement)
+            index += 1
+        return result
+
+    # A row loop that only appends to a list or adds to a total, right after the
+    # list/total is initialised:
+    #   out = []                          total = 0
+    #   for _, row in df.iterrows():      for _, row in df.iterrows():
+    #       if cond: out.append(expr)         total += expr
+    def rewrite_accumulator(self, init, loop):
+        if not (isinstance(init, ast.Assign) and len(init.targets) == 1 and isinstance(init.targets[0], ast.Name)):
+            return None
+        if not (isinstance(loop, ast.For) and not loop.orelse and len(loop.body) == 1):
+            return None
+        target = init.targets[0].id
+        frame, row = self.iterrows_loop(loop)
+        if frame is None:
+            return None
+        statement = loop.body[0]
+        condition = None
+        if isinstance(statement, ast.If) and not statement.orelse and len(statement.body) == 1:
+            condition, statement = statement.test, statement.body[0]
+        if isinstance(init.value, ast.List) and not init.value.elts:
+            if not (isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call)):
+                return None
+            call = statement.value
+            if not (isinstance(call.func, ast.Attribute) and call.func.attr == "append" and isinstance(call.func.value, ast.Name)
+                    and call.func.value.id == target and len(call.args) == 1 and not call.keywords):
+                return None
+            reducer, expression = "tolist", call.args[0]
+        elif isinstance(init.value, ast.Constant) and init.value.value == 0:
+            if not (isinstance(statement, ast.AugAssign) and isinstance(statement.op, ast.Add)
+                    and isinstance(statement.target, ast.Name) and statement.target.id == target):
+                return None
+            reducer, expression = "sum", statement.value
+        else:
+            return None
+        if uses_name([expression] + ([condition] if condition is not None else []), target):
+            return None
+        column = ExpressionVectorizer(row, frame, True).translate(expression)
+        if column is None:
+            return None
+        if condition is not None:
+            mask = ExpressionVectorizer(row, frame, True).translate(condition)
+            if mask is None or not is_boolean(condition):
+                return None
+            column = ast.Subscript(value=column, slice=mask, ctx=ast.Load())
+        self.note(loop, f"iterrows() loop building '{target}' -> vectorised {reducer}()")
+        # A running total turns NaN once it adds one; Series.sum() would skip it
+        keywords = [ast.keyword(arg="skipna", value=ast.Constant(value=False))] if reducer == "sum" else []
+        value = attribute_call(column, reducer, keywords=keywords)
+        return ast.Assign(targets=[ast.Name(id=target, ctx=ast.Store())], value=value, lineno=init.lineno)
+
+    # (frame, row name) for `for _, row in frame.iterrows()` when the index is unused
+    def iterrows_loop(self, loop):
+        call = loop.iter
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "iterrows"):
+            return None, None
+        if call.args or call.keywords or not is_simple_receiver(call.func.value):
+            return None, None
+        target = loop.target
+        if not (isinstance(target, ast.Tuple) and len(target.elts) == 2 and all(isinstance(elt, ast.Name) for elt in target.elts)):
+            return None, None
+        index_name, row_name = (elt.id for elt in target.elts)
+        if uses_name(loop.body, index_name):
+            return None, None
+        return call.func.value, row_name
+
+    #   for value in df['col'].unique():        for value, subset in df.groupby('col', sort=False):
+    #       subset = df[df['col'] == value]  ->     ...
+    def rewrite_filter_loop(self, loop):
+        if not (isinstance(loop.target, ast.Name) and loop.body and isinstance(loop.body[0], ast.Assign)):
+            return loop
+        call = loop.iter
+        if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr == "unique" and not call.args):
+            return loop
+        frame, column = column_of(call.func.value)
+        if frame is None or not isinstance(frame, ast.Name):
+            return loop
+        assign = loop.body[0]
+        if not (len(assign.targets) == 1 and isinstance(assign.targets[0], ast.Name) and isinstance(assign.value, ast.Subscript)):
+            return loop
+        subset = assign.value
+        mask = subset.slice
+        if not (same(subset.value, frame) and isinstance(mask, ast.Compare) and len(mask.ops) == 1 and isinstance(mask.ops[0], ast.Eq)):
+            return loop
+        sides = [mask.left, mask.comparators[0]]
+        loop_var = loop.target.id
+        if not any(isinstance(side, ast.Name) and side.id == loop_var for side in sides):
+            return loop
+        other = sides[1] if isinstance(sides[0], ast.Name) and sides[0].id == loop_var else sides[0]
+        owner, other_column = column_of(other)
+        if owner is None or other_column != column or not same(owner, frame):
+            return loop
+        if any(isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store) and node.id in (loop_var, frame.id)
+               for statement in loop.body[1:] for node in ast.walk(statement)):
+            return loop
+        self.note(loop, f"per-value filter on '{column}' inside a loop -> groupby")
+        groupby = attribute_call(frame, "groupby", [ast.Constant(value=column)], [ast.keyword(arg="sort", value=ast.Constant(value=False))])
+        loop.target = ast.Tuple(elts=[ast.Name(id=loop_var, ctx=ast.Store()), assign.targets[0]], ctx=ast.Store())
+        loop.iter = groupby
+        loop.body = loop.body[1:] or [ast.Pass()]
+        return loop
+
+    def warn_loop(self, loop):
+        call = loop.iter
+        if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) and call.func.attr in ("iterrows", "itertuples"):
+            self.warnings.append(f"line {loop.lineno}: {call.func.attr}() loop could not be vectorised safely")
+            return
+        loop_vars = [node.id for node in ast.walk(loop.target) if isinstance(node, ast.Name)]
+        for node in ast.walk(ast.Module(body=loop.body, type_ignores=[])):
+            if isinstance(node, ast.Subscript) and isinstance(node.slice, ast.Compare) and any(uses_name([node.slice], var) for var in loop_vars):
+                self.warnings.append(f"line {node.lineno}: boolean filter repeated for every loop value; consider groupby")
+                return
+
+
+# Returns (code, rewrites, warnings). The original text is returned untouched
+# when nothing was rewritten or the code does not parse.
+def vectorize_code(code):
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code, [], []
+    vectorizer = Vectorizer()
+    tree = vectorizer.visit(tree)
+    if not vectorizer.rewrites:
+        return code, [], vectorizer.warnings
+    ast.fix_missing_locations(tree)
+    rewritten = ast.unparse(tree)
+    for rewrite in vectorizer.rewrites:
+        logging.info(f"Vectorised generated code, {rewrite}")
+    if "np." in rewritten and "import numpy as np" not in rewritten:
+        rewritten = "import numpy as np\n" + rewritten
+    return rewritten, vectorizer.rewrites, vectorizer.warnings